@@ -0,0 +1,94 @@
+"""
+Benchmarks book lookups of book_reader against the size of the book.
+
+Lookups are timed inside book_reader (see its bench command), once with the
+hash-prefix index and once with a binary search of the whole book, for the
+real books and for synthetic books of the given sizes. Synthetic books have
+random hashes with four moves per position, like books built from far more
+games than the current ones.
+
+Arguments:
+  books         names of the real books to benchmark, all books by default
+  --sizes       numbers of entries of the synthetic books
+  --lookups     lookups of known and of random hashes per book
+
+Example usage:
+  python src/benchmark_books.py --sizes 1000000 10000000 ruy_lopez
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import numpy as np
+
+MOVES_PER_POSITION = 4
+
+
+def write_synthetic_book(path: str, size: int):
+    from trainer.mapped_book import BOOK_ENTRY
+    rng = np.random.default_rng(size)
+    positions = np.sort(
+        rng.integers(0, 2**64 - 1, size // MOVES_PER_POSITION,
+                     dtype=np.uint64,
+                     endpoint=True))
+    entries = np.zeros(len(positions) * MOVES_PER_POSITION, dtype=BOOK_ENTRY)
+    entries['hash'] = np.repeat(positions, MOVES_PER_POSITION)
+    entries['src'] = rng.integers(0, 64, len(entries))
+    entries['dst'] = rng.integers(0, 64, len(entries))
+    entries['count'] = rng.integers(1, 1000, len(entries))
+    entries.tofile(path)
+
+
+def bench(book_reader: subprocess.Popen, path: str, lookups: int) -> dict:
+    book_reader.stdin.write(f'bench {path} {lookups}\n')
+    book_reader.stdin.flush()
+    words = book_reader.stdout.readline().split()[1:]
+    return dict(zip(words[::2], words[1::2]))
+
+
+def main():
+    from trainer.views.paths import BOOK_READER_PATH, BOOKS_DIR
+
+    with open(os.path.join(BOOKS_DIR, 'config.json'), encoding='utf-8') as f:
+        all_books = [opening['book'] for opening in json.load(f)]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('books', nargs='*', default=all_books)
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='*',
+                        default=[10**6, 10**7])
+    parser.add_argument('--lookups', type=int, default=10**6)
+    args = parser.parse_args()
+
+    book_reader = subprocess.Popen([BOOK_READER_PATH],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   text=True)
+    print(f'{"book":<40} {"entries":>10} {"bits":>5} '
+          f'{"indexed ns":>11} {"bsearch ns":>11}')
+
+    def report(name: str, path: str):
+        result = bench(book_reader, path, args.lookups)
+        print(f'{name:<40} {result["entries"]:>10} {result["index_bits"]:>5} '
+              f'{float(result["indexed_ns"]):>11.1f} '
+              f'{float(result["binary_search_ns"]):>11.1f}')
+
+    try:
+        for book in args.books:
+            book_path = os.path.join(BOOKS_DIR, book + '.bin')
+            if os.path.exists(book_path):
+                report(book, book_path)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for size in args.sizes:
+                path = os.path.join(tmp_dir, f'synthetic_{size}.bin')
+                write_synthetic_book(path, size)
+                report(f'synthetic, {size} entries', path)
+    finally:
+        book_reader.stdin.write('quit\n')
+        book_reader.stdin.close()
+        book_reader.wait()
+
+
+if __name__ == '__main__':
+    main()
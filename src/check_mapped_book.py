@@ -0,0 +1,185 @@
+"""
+Checks that the in-process book reader agrees with book_reader.
+
+Each book is walked from the starting position following the book moves
+(like evaluate_books.py). Every reached position is looked up by both
+readers, once with the FEN python-chess writes by default and once with
+the en passant square always written, which changes chess-library's hash.
+Moves with the same number of appearances may come in any order, the
+totals of the positions must match. A v1 book is checked again after
+converting it to v3. A small book of castling, promotion and en passant
+moves is written in both formats and checked against its known moves.
+
+Without the book_reader binary the check is skipped. It exits with 1 when
+the readers disagree, so it can run unattended (`make check` in
+tree-generation).
+
+Arguments:
+  books             names of the books to check, all books by default
+  --max-positions   positions checked per book
+  --books-dir       directory of the books
+  --book-reader     book_reader binary, the one of the trainer by default
+
+Example usage (from the src directory):
+  python check_mapped_book.py --max-positions 5000 ruy_lopez
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+import chess
+import chess.polyglot
+
+# Positions of the special book and their moves with the number of
+# appearances, the large counts take several varint bytes in v3
+SPECIAL_POSITIONS = {
+    'r3k2r/pppq1ppp/8/8/8/8/PPPQ1PPP/R3K2R w KQkq - 0 1': [
+        ('e1g1', 40), ('e1c1', 25), ('d2d7', 3_000_000)],
+    'r3k2r/pppq1ppp/8/8/8/8/PPPQ1PPP/R3K2R b KQkq - 0 1': [
+        ('e8g8', 200_000), ('e8c8', 200_000), ('h8g8', 7)],
+    'r3k3/1P6/8/8/8/8/8/4K2R w K - 0 1': [
+        ('b7b8q', 90), ('b7b8n', 12), ('b7a8r', 12), ('b7a8b', 5),
+        ('e1g1', 300)],
+    '4k3/8/8/8/8/8/6p1/4K2R b K - 0 1': [
+        ('g2g1q', 1_000), ('g2h1n', 16_384), ('g2h1q', 16_383)],
+    'rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3': [
+        ('e5f6', 128), ('e5e6', 127), ('g1f3', 5)],
+}
+
+
+def normalized(edges) -> list[tuple[int, str]]:
+    return sorted((-edge.count, edge.move.uci()) for edge in edges)
+
+
+def walk_book(book_reader, book_path: str, max_positions: int) -> list[str]:
+    board = chess.Board()
+    seen = {chess.polyglot.zobrist_hash(board)}
+    boards = collections.deque([board])
+    fens = []
+    while boards and len(fens) < max_positions:
+        board = boards.popleft()
+        fens.append(board.fen())
+        fens.append(board.fen(en_passant='fen'))
+        for edge in book_reader.from_fen(book_path, board.fen()).edges:
+            child = board.copy(stack=False)
+            child.push(edge.move)
+            child_hash = chess.polyglot.zobrist_hash(child)
+            if child_hash not in seen:
+                seen.add(child_hash)
+                boards.append(child)
+    return list(dict.fromkeys(fens))
+
+
+async def mapped_lookups(mapped_reader, book_path: str, fens: list[str]):
+    return [await mapped_reader.from_fen(book_path, fen) for fen in fens]
+
+
+def check_book(book_reader, mapped_reader, book_path: str,
+               fens: list[str]) -> int:
+    start = time.time()
+    expected = [book_reader.from_fen(book_path, fen) for fen in fens]
+    subprocess_time = time.time() - start
+    start = time.time()
+    actual = asyncio.run(mapped_lookups(mapped_reader, book_path, fens))
+    mapped_time = time.time() - start
+    mismatches = 0
+    for fen, want, got in zip(fens, expected, actual):
+        if (normalized(want.edges) != normalized(got.edges) or
+                want.total != got.total):
+            mismatches += 1
+            print(f'{book_path}: mismatch in {fen}')
+    print(f'{book_path}: {len(fens)} positions, {mismatches} mismatches, '
+          f'book_reader {subprocess_time:.2f}s, mapped {mapped_time:.2f}s')
+    return mismatches
+
+
+def write_special_book(path: str, version: int):
+    import numpy as np
+    from trainer.mapped_book import BOOK_ENTRY, book_hash, write_book_v3
+
+    entries = []
+    for fen, moves in SPECIAL_POSITIONS.items():
+        board = chess.Board(fen)
+        for uci, count in moves:
+            move = board.parse_uci(uci)
+            dst = move.to_square
+            # The book stores castling as the king capturing its rook
+            if board.is_castling(move):
+                dst = chess.square(7 if dst > move.from_square else 0,
+                                   chess.square_rank(dst))
+            # chess-library numbers the piece types from 0
+            entries.append((book_hash(board), move.from_square, dst,
+                            move.promotion is not None,
+                            (move.promotion or 1) - 1, count))
+    entries = np.sort(np.array(entries, dtype=BOOK_ENTRY),
+                      order=['hash', 'src', 'dst', 'promotion_piece'])
+    if version == 1:
+        entries.tofile(path)
+    else:
+        write_book_v3(path, entries)
+
+
+def check_special_book(book_reader, mapped_reader, book_path: str) -> int:
+    fens = list(SPECIAL_POSITIONS)
+    mismatches = check_book(book_reader, mapped_reader, book_path, fens)
+    actual = asyncio.run(mapped_lookups(mapped_reader, book_path, fens))
+    for fen, got in zip(fens, actual):
+        want = sorted((-count, uci) for uci, count in SPECIAL_POSITIONS[fen])
+        if normalized(got.edges) != want:
+            mismatches += 1
+            print(f'{book_path}: unexpected moves in {fen}')
+    return mismatches
+
+
+def main():
+    from trainer.book_reader_protocol import BookReader
+    from trainer.mapped_book import VERSION, MappedBook, MappedBookReader, \
+        read_entries, write_book_v3
+    from trainer.views.paths import BOOK_READER_PATH, BOOKS_DIR
+
+    with open(os.path.join(BOOKS_DIR, 'config.json'), encoding='utf-8') as f:
+        all_books = [opening['book'] for opening in json.load(f)]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('books', nargs='*', default=all_books)
+    parser.add_argument('--max-positions', type=int, default=2000)
+    parser.add_argument('--books-dir', default=BOOKS_DIR)
+    parser.add_argument('--book-reader', default=BOOK_READER_PATH)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.book_reader):
+        print(f'{args.book_reader}: missing, skipping the check')
+        return
+    book_reader = BookReader.popen(args.book_reader)
+    mapped_reader = MappedBookReader()
+    mismatches = 0
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for book in args.books:
+                book_path = os.path.join(args.books_dir, book + '.bin')
+                if not os.path.exists(book_path):
+                    print(f'{book_path}: missing, skipping')
+                    continue
+                fens = walk_book(book_reader, book_path, args.max_positions)
+                mismatches += check_book(book_reader, mapped_reader,
+                                         book_path, fens)
+                if MappedBook.open(book_path).version != VERSION:
+                    converted_path = os.path.join(tmp_dir, book + '.bin')
+                    write_book_v3(converted_path, read_entries(book_path))
+                    mismatches += check_book(book_reader, mapped_reader,
+                                             converted_path, fens)
+            for version in (1, VERSION):
+                special_path = os.path.join(tmp_dir, f'special_v{version}.bin')
+                write_special_book(special_path, version)
+                mismatches += check_special_book(book_reader, mapped_reader,
+                                                 special_path)
+    finally:
+        book_reader.quit()
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Converts opening books from format v1 to format v3.
+
+Books already in v3 are skipped. Without --output-dir the books are
+replaced in place, through a temporary file, so a running book_reader never
+sees a partially written book (it keeps the old mapping until it maps the
+book again).
+
+Arguments:
+  books          names of the books to convert, all books by default
+  --output-dir   directory for the converted books
+
+Example usage:
+  python src/convert_books.py --output-dir /tmp/books_v3 ruy_lopez
+"""
+import argparse
+import json
+import os
+
+
+def main():
+    from trainer.mapped_book import VERSION, MappedBook, read_entries, \
+        write_book_v3
+    from trainer.views.paths import BOOKS_DIR
+
+    with open(os.path.join(BOOKS_DIR, 'config.json'), encoding='utf-8') as f:
+        all_books = [opening['book'] for opening in json.load(f)]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('books', nargs='*', default=all_books)
+    parser.add_argument('--output-dir', default=BOOKS_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for book in args.books:
+        book_path = os.path.join(BOOKS_DIR, book + '.bin')
+        if not os.path.exists(book_path):
+            print(f'{book_path}: missing, skipping')
+            continue
+        if MappedBook.open(book_path).version == VERSION:
+            print(f'{book_path}: already v{VERSION}, skipping')
+            continue
+        output_path = os.path.join(args.output_dir, book + '.bin')
+        tmp_path = output_path + '.tmp'
+        write_book_v3(tmp_path, read_entries(book_path))
+        os.replace(tmp_path, output_path)
+        print(f'{book_path}: {os.path.getsize(book_path)} bytes, '
+              f'{output_path}: {os.path.getsize(output_path)} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Evaluates every position of the opening books and writes sidecar files.
+
+Each book is walked from the starting position following the book moves.
+The reached positions are evaluated with Stockfish in parallel, one engine
+per worker process, and written to `<book>.eval` next to `<book>.bin`
+(see trainer/book_evaluations.py for the format).
+
+Arguments:
+  books         names of the books to evaluate, all books by default
+  --depth       depth of the evaluations
+  --processes   number of worker processes, all cores by default
+
+Example usage (from the src directory):
+  python evaluate_books.py --depth 18 ruy_lopez italian_game
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import time
+import chess
+import chess.engine
+import chess.polyglot
+
+ENGINE_MEMORY_LIMIT = 64
+
+# Engine of the worker process
+engine: chess.engine.SimpleEngine | None = None
+
+
+def init_worker(stockfish_path: str):
+    global engine
+    engine = chess.engine.SimpleEngine.popen_uci(stockfish_path)
+    options = {'Hash': ENGINE_MEMORY_LIMIT, 'Threads': 1}
+    if 'UCI_ShowWDL' in engine.options:
+        options['UCI_ShowWDL'] = True
+    engine.configure(options)
+
+
+def evaluate(task: tuple[str, int]):
+    fen, depth = task
+    board = chess.Board(fen)
+    info = engine.analyse(board, chess.engine.Limit(depth=depth))
+    score = info['score']
+    wdl = info.get('wdl') or score.wdl(ply=board.ply())
+    return fen, score, wdl, info.get('pv', [])
+
+
+def walk_book(book_reader, book_path: str) -> list[str]:
+    board = chess.Board()
+    seen = {chess.polyglot.zobrist_hash(board)}
+    boards = collections.deque([board])
+    fens = []
+    while boards:
+        board = boards.popleft()
+        fens.append(board.fen())
+        for edge in book_reader.from_fen(book_path, board.fen()).edges:
+            child = board.copy(stack=False)
+            child.push(edge.move)
+            child_hash = chess.polyglot.zobrist_hash(child)
+            if child_hash not in seen:
+                seen.add(child_hash)
+                boards.append(child)
+    return fens
+
+
+def evaluate_book(pool, book_reader, book_path: str, depth: int):
+    from trainer.book_evaluations import encode_record, sidecar_path, write_sidecar
+    start = time.time()
+    fens = walk_book(book_reader, book_path)
+    print(f'{book_path}: {len(fens)} positions')
+    records = []
+    tasks = [(fen, depth) for fen in fens]
+    for fen, score, wdl, pv in pool.imap_unordered(evaluate, tasks, 16):
+        records.append(encode_record(chess.Board(fen), score, wdl, pv))
+        if len(records) % 1000 == 0:
+            print(f'\r{book_path}: {len(records)}/{len(fens)}', end='')
+    write_sidecar(sidecar_path(book_path), depth, records)
+    print(f'\r{book_path}: evaluated {len(records)} positions '
+          f'in {time.time() - start:.1f}s')
+
+
+def main():
+    from trainer.book_reader_protocol import BookReader
+    from trainer.views.paths import BOOK_READER_PATH, BOOKS_DIR, STOCKFISH_PATH
+
+    with open(os.path.join(BOOKS_DIR, 'config.json'), encoding='utf-8') as f:
+        all_books = [opening['book'] for opening in json.load(f)]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('books', nargs='*', default=all_books)
+    parser.add_argument('--depth', type=int, default=15)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    book_reader = BookReader.popen(BOOK_READER_PATH)
+    with multiprocessing.Pool(args.processes,
+                              initializer=init_worker,
+                              initargs=(STOCKFISH_PATH,)) as pool:
+        for book in args.books:
+            book_path = os.path.join(BOOKS_DIR, book + '.bin')
+            if not os.path.exists(book_path):
+                print(f'{book_path}: missing, skipping')
+                continue
+            evaluate_book(pool, book_reader, book_path, args.depth)
+    book_reader.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Writes the manifest of make_book for the books of config.json.
+
+make_book builds all books of a manifest in one pass over the PGN dump (see
+tree-generation/make_book.cc). A book is built from the games of its ECO
+codes (the `eco` range of config.json). The seed of every book is derived
+from the seed and the name of the book, so adding or dropping a book does
+not change the sample of the others.
+
+Arguments:
+  books         names of the books, all books by default
+  --games       maximum number of games sampled into a book
+  --max-depth   max depth of the books in halfmoves
+  --seed        random generator seed
+  --output-dir  directory of the books written by make_book
+
+Example usage (from the src directory):
+  python make_manifest.py --output-dir ../tree-generation/books > books.txt
+  zstdcat lichess_db_standard_rated_2024-04.pgn.zst | \\
+  ../tree-generation/make_book --manifest books.txt 91383489 --threads 8
+"""
+import argparse
+import json
+import os
+import zlib
+
+
+def book_seed(seed: int, book: str) -> int:
+    # make_book reads the seeds as ints
+    return (seed ^ zlib.crc32(book.encode())) & 0x7fffffff
+
+
+def main():
+    from trainer.views.paths import BOOKS_DIR
+
+    with open(os.path.join(BOOKS_DIR, 'config.json'), encoding='utf-8') as f:
+        openings = {opening['book']: opening for opening in json.load(f)}
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('books', nargs='*', default=list(openings))
+    parser.add_argument('--games', type=int, default=1000000)
+    parser.add_argument('--max-depth', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=73632)
+    parser.add_argument('--output-dir', default='')
+    args = parser.parse_args()
+
+    lines = ['# <book> <accepted games> <max depth> <first eco> <last eco> '
+             '<seed>']
+    for book in args.books:
+        if book not in openings:
+            parser.error(f'unknown book {book}')
+        eco = openings[book].get('eco')
+        if not eco:
+            parser.error(f'no eco range for {book} in config.json')
+        first_eco, _, last_eco = eco.partition('-')
+        lines.append(f'{os.path.join(args.output_dir, book)} {args.games} '
+                     f'{args.max_depth} {first_eco} {last_eco or first_eco} '
+                     f'{book_seed(args.seed, book)}')
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,7 @@
-from flask import Flask
-from flask_session import Session
-from .views import index
-from .views import play
-from .views import explore
-from .views import beginner
-from .views import medium
-from .views import advanced
-from .views import expert
-
-app = Flask(__name__, instance_relative_config=True)
-try:
-    app.config.from_object('config.default')
-except Exception:
-    pass
-try:
-    app.config.from_pyfile('config.py')
-except Exception:
-    pass
-
-Session(app)
-
-play.mod.register_blueprint(explore.mod, url_prefix='/explore')
-play.mod.register_blueprint(beginner.mod, url_prefix='/beginner')
-play.mod.register_blueprint(medium.mod, url_prefix='/medium')
-play.mod.register_blueprint(advanced.mod, url_prefix='/advanced')
-play.mod.register_blueprint(expert.mod, url_prefix='/expert')
-index.mod.register_blueprint(play.mod, url_prefix='/play')
-app.register_blueprint(index.mod, url_prefix='/')
+# The app is built on first access, so the scripts can import the modules of
+# the package without starting the app and its shared jobs
+def __getattr__(name):
+    if name == 'app':
+        from .application import app
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,87 @@
+"""
+This module contains time, node and depth budgets for engine analysis.
+
+A fixed search depth takes unpredictable time in sharp positions. A budget
+caps the search by time, nodes and depth, whichever is reached first, and
+the result of the deepest iteration the engine completed is returned.
+
+The module defines the following classes:
+- AnalysisBudget: Data class representing the limits of one search.
+
+Example usage:
+budget = AnalysisBudget(time=0.5, depth=18, min_depth=12)
+lines = await analyse_with_budget(engine, board, budget, multipv=3)
+print(lines[0]['depth'], lines[0]['score'])
+"""
+import dataclasses
+from typing import Any, Callable
+import chess
+import chess.engine
+
+
+@dataclasses.dataclass(frozen=True)
+class AnalysisBudget:
+    """
+    Limits of one search.
+
+    Attributes:
+        time (float | None): Maximal search time in seconds.
+        nodes (int | None): Maximal number of searched nodes.
+        depth (int): Maximal search depth.
+        min_depth (int): Cached evaluations at least this deep are reused
+                         instead of searching again.
+    """
+    time: float | None = None
+    nodes: int | None = None
+    depth: int = 15
+    min_depth: int = 15
+
+    def limit(self) -> chess.engine.Limit:
+        return chess.engine.Limit(time=self.time,
+                                  nodes=self.nodes,
+                                  depth=self.depth)
+
+
+def is_complete(info: chess.engine.InfoDict) -> bool:
+    # Bounds are reported by fail high/low of an unfinished iteration
+    return ('score' in info and 'pv' in info and 'depth' in info and
+            not info.get('lowerbound') and not info.get('upperbound'))
+
+
+async def analyse_with_budget(
+        engine: chess.engine.Protocol,
+        board: chess.Board,
+        budget: AnalysisBudget,
+        multipv: int = 1,
+        root_moves: list[chess.Move] | None = None,
+        on_depth: Callable[[list[chess.engine.InfoDict]], Any] | None = None
+) -> list[chess.engine.InfoDict]:
+    """
+    Deepens the search until the budget is exhausted.
+
+    Returns the lines of the deepest iteration for which the engine reported
+    all `multipv` lines, ordered by rank. Falls back to the latest reported
+    lines when not even the first iteration completed. `on_depth` is called
+    with the lines of every completed iteration.
+    """
+    expected = min(multipv,
+                   len(root_moves) if root_moves else board.legal_moves.count())
+    lines_by_depth: dict[int, dict[int, chess.engine.InfoDict]] = {}
+    complete: list[chess.engine.InfoDict] = []
+    with await engine.analysis(board,
+                               budget.limit(),
+                               multipv=multipv,
+                               root_moves=root_moves) as analysis:
+        async for info in analysis:
+            if not is_complete(info):
+                continue
+            lines = lines_by_depth.setdefault(info['depth'], {})
+            lines[info.get('multipv', 1)] = info
+            if len(lines) >= expected and info['depth'] >= max(
+                    lines_by_depth):
+                complete = [lines[rank] for rank in sorted(lines)]
+                if on_depth is not None:
+                    on_depth(complete)
+        if not complete:
+            complete = [info for info in analysis.multipv if 'score' in info]
+    return complete
@@ -0,0 +1,71 @@
+"""
+This module contains the cursors of the games being played.
+
+Consecutive book lookups of one game differ by a move or two. A cursor per
+game and book lets the book reader keep the board of the game, instead of
+receiving and parsing a FEN for every lookup. The game states of the views
+are rebuilt from the session on every request, so the cursors are kept
+here, by game, across requests. Only the most recently used cursors are
+kept, the book reader closes idle ones on its own.
+
+The module defines the following classes:
+- BookCursors: Cursors of the most recently used games.
+
+Example usage:
+book_cursors = BookCursors(book_reader, maxsize=1024)
+result = await book_cursors.get(session.sid, 'tree.bin').edges(board)
+"""
+import collections
+import logging
+import threading
+from typing import Any, Hashable
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+
+class BookCursors:
+    """
+    Cursors of the most recently used games.
+
+    Attributes:
+        book_reader: Reader creating the cursors (BookReaderPool or
+                     MappedBookReader).
+        maxsize (int): Number of cursors kept, the least recently used ones
+                       are closed.
+        cursors (collections.OrderedDict): Cursors by game and book, the
+                                           most recently used last.
+        lock (threading.Lock): The lock guarding `cursors`.
+    """
+
+    def __init__(self, book_reader, maxsize: int):
+        self.book_reader = book_reader
+        self.maxsize = maxsize
+        self.cursors: collections.OrderedDict[tuple[Hashable, str],
+                                              Any] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, game: Hashable, filename: str):
+        """Cursor of the game on the book, created on first use."""
+        key = (game, filename)
+        with self.lock:
+            if key in self.cursors:
+                self.cursors.move_to_end(key)
+                return self.cursors[key]
+            cursor = self.book_reader.cursor(filename)
+            self.cursors[key] = cursor
+            evicted = []
+            while len(self.cursors) > self.maxsize:
+                evicted.append(self.cursors.popitem(last=False)[1])
+        for old_cursor in evicted:
+            old_cursor.close()
+        return cursor
+
+    def close(self):
+        with self.lock:
+            cursors = list(self.cursors.values())
+            self.cursors.clear()
+        for cursor in cursors:
+            cursor.close()
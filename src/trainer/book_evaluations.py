@@ -0,0 +1,170 @@
+"""
+This module contains the sidecar evaluation files of opening books.
+
+Every position of a book is known ahead of time, so it can be evaluated
+offline (see evaluate_books.py) and stored next to the book. The sidecar of
+`books/ruy_lopez.bin` is `books/ruy_lopez.eval`. The format of the file is:
+A 12 byte header:
+4 byte magic b'CTEV'
+1 byte format version
+1 byte depth of the evaluations
+1 byte number of PV moves stored per position
+1 byte padding
+4 byte number of records
+The sequence of records sorted by hash. One record consists of:
+8 byte polyglot zobrist hash of the position
+1 byte score kind (0 - centipawns, 1 - mate in n)
+4 byte score from the point of view of the side to move
+3 x 2 byte win/draw/loss permille from the point of view of the side to move
+PV length x 2 byte moves (from | to << 6 | promotion << 12, 0 is no move)
+
+The module defines the following classes:
+- BookEvaluation: Cached evaluation read from a sidecar file.
+- BookEvaluations: Evaluations of the positions of one book.
+- BookEvaluationStore: Lazily loaded sidecar files of all books.
+
+Example usage:
+store = BookEvaluationStore()
+evaluation = store.get('books/ruy_lopez.bin', board)
+"""
+import array
+import bisect
+import dataclasses
+import logging
+import os
+import struct
+import threading
+import chess
+import chess.engine
+import chess.polyglot
+from .evaluation_cache import CachedEvaluation, score_from_row, score_to_row
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CTEV'
+VERSION = 1
+PV_LENGTH = 4
+HEADER = struct.Struct('<4sBBBxI')
+RECORD = struct.Struct(f'<QBi3H{PV_LENGTH}H')
+SCORE_CP = 0
+SCORE_MATE = 1
+
+
+@dataclasses.dataclass
+class BookEvaluation(CachedEvaluation):
+    wdl: chess.engine.PovWdl | None = None
+
+
+def sidecar_path(book_path: str) -> str:
+    return os.path.splitext(book_path)[0] + '.eval'
+
+
+def encode_move(move: chess.Move) -> int:
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> chess.Move:
+    promotion = code >> 12
+    return chess.Move(code & 63, code >> 6 & 63, promotion or None)
+
+
+def encode_record(board: chess.Board, score: chess.engine.PovScore,
+                  wdl: chess.engine.PovWdl, pv: list[chess.Move]) -> bytes:
+    cp, mate = score_to_row(score)
+    kind, value = (SCORE_MATE, mate) if mate is not None else (SCORE_CP, cp)
+    relative_wdl = wdl.relative
+    moves = [encode_move(move) for move in pv[:PV_LENGTH]]
+    moves += [0] * (PV_LENGTH - len(moves))
+    return RECORD.pack(chess.polyglot.zobrist_hash(board), kind, value,
+                       relative_wdl.wins, relative_wdl.draws,
+                       relative_wdl.losses, *moves)
+
+
+def write_sidecar(path: str, depth: int, records: list[bytes]):
+    """Writes records produced by `encode_record` to a sidecar file."""
+    records = sorted(records, key=lambda record: RECORD.unpack_from(record)[0])
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, depth, PV_LENGTH, len(records)))
+        for record in records:
+            f.write(record)
+
+
+class BookEvaluations:
+    """
+    Evaluations of the positions of one book.
+
+    Attributes:
+        path (str): Path to the sidecar file.
+        depth (int): Depth of the stored evaluations.
+        data (bytes): Records of the sidecar file.
+        hashes (array.array): Sorted hashes of the records.
+    """
+
+    def __init__(self, path: str, depth: int = 0, data: bytes = b''):
+        self.path = path
+        self.depth = depth
+        self.data = data
+        self.hashes = array.array(
+            'Q', (record[0] for record in RECORD.iter_unpack(data)))
+
+    @classmethod
+    def load(cls, path: str) -> 'BookEvaluations':
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, depth, pv_length, count = HEADER.unpack_from(data)
+        if (magic != MAGIC or version != VERSION or pv_length != PV_LENGTH or
+                len(data) != HEADER.size + count * RECORD.size):
+            logger.warning('Ignoring malformed evaluation file %s', path)
+            return cls(path)
+        return cls(path, depth, data[HEADER.size:])
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def get(self, board: chess.Board) -> BookEvaluation | None:
+        pos_hash = chess.polyglot.zobrist_hash(board)
+        idx = bisect.bisect_left(self.hashes, pos_hash)
+        if idx == len(self.hashes) or self.hashes[idx] != pos_hash:
+            return None
+        _, kind, value, wins, draws, losses, *moves = RECORD.unpack_from(
+            self.data, idx * RECORD.size)
+        if kind == SCORE_MATE:
+            score = score_from_row(None, value, board.turn)
+        else:
+            score = score_from_row(value, None, board.turn)
+        wdl = chess.engine.PovWdl(chess.engine.Wdl(wins, draws, losses),
+                                  board.turn)
+        pv = [decode_move(code) for code in moves if code]
+        return BookEvaluation(score, pv, self.depth, wdl)
+
+
+class BookEvaluationStore:
+    """
+    Sidecar evaluation files of all books, loaded on first use.
+
+    Attributes:
+        books (dict[str, BookEvaluations]): Loaded files by book path.
+        lock (threading.Lock): The lock guarding `books`.
+    """
+
+    def __init__(self):
+        self.books: dict[str, BookEvaluations] = {}
+        self.lock = threading.Lock()
+
+    def book(self, book_path: str) -> BookEvaluations:
+        with self.lock:
+            if book_path not in self.books:
+                self.books[book_path] = BookEvaluations.load(
+                    sidecar_path(book_path))
+                logger.info('Loaded %d book evaluations for %s',
+                            len(self.books[book_path]), book_path)
+            return self.books[book_path]
+
+    def get(self, book_path: str,
+            board: chess.Board) -> BookEvaluation | None:
+        return self.book(book_path).get(board)
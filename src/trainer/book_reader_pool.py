@@ -0,0 +1,268 @@
+"""
+This module contains a pool of book_reader processes.
+
+A single book_reader serves every request of the application, which makes
+it a bottleneck and a single point of failure. The pool runs several
+readers and routes every lookup by the book it reads, so each reader keeps
+its own books resident in its LRU. When the reader of a book is busy with
+`hot_load` lookups, further lookups of that book go to the least loaded
+reader instead. Readers that exited are respawned on their next lookup.
+With `binary` the readers answer in the binary response mode.
+
+Cursors of a game always go to the reader of their book, which keeps the
+board of the game, so a lookup only sends the moves since the previous one.
+
+The module defines the following classes:
+- BookReaderPool: Pool of AsyncBookReader processes with per-book routing.
+- BookCursor: Game kept open in a reader of the pool.
+
+Example usage:
+book_reader = await BookReaderPool.popen('./book_reader', 2, binary=True)
+result = await book_reader.from_fen('tree.bin', chess.STARTING_FEN)
+results = await book_reader.from_fens([('tree.bin', fen) for fen in fens])
+await book_reader.preload('tree.bin')
+cursor = book_reader.cursor('tree.bin')
+result = await cursor.edges(board)
+cursor.close()
+await book_reader.quit()
+"""
+import asyncio
+import contextlib
+import itertools
+import logging
+import zlib
+from typing import AsyncIterator
+import chess
+from .book_reader_protocol import AsyncBookReader, BookReaderStats, EdgeResult
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+
+class BookReaderPool:
+    """
+    Pool of AsyncBookReader processes with per-book routing.
+
+    Offers the same `from_fen`, `from_fens`, `exit` and `quit` as
+    AsyncBookReader, so it can be used in place of a single reader,
+    `preload` of a book into the reader it is routed to and `stats` of every
+    reader. Lookups can be awaited from any event loop, the readers live on
+    the loop that spawned the pool.
+
+    Attributes:
+        command (str): Path to the book_reader binary.
+        args (tuple[str, ...]): Arguments passed to every reader.
+        loop (asyncio.AbstractEventLoop): Event loop owning the readers.
+        readers (list[AsyncBookReader]): The reader processes.
+        load (list[int]): Number of lookups in flight per reader.
+        hot_load (int): Lookups in flight above which a book spills over to
+                        the least loaded reader.
+        binary (bool): Whether the readers use the binary response mode.
+        respawned (int): Number of readers that were respawned.
+        cursor_ids (itertools.count): Source of cursor names.
+    """
+
+    def __init__(self, command: str, args: tuple[str, ...],
+                 readers: list[AsyncBookReader], hot_load: int,
+                 binary: bool):
+        self.command = command
+        self.args = args
+        self.binary = binary
+        self.loop = asyncio.get_running_loop()
+        self.readers = readers
+        self.load = [0] * len(readers)
+        self.hot_load = hot_load
+        self.respawned = 0
+        self.cursor_ids = itertools.count(1)
+
+    @classmethod
+    async def popen(cls,
+                    command: str,
+                    size: int,
+                    *args: str,
+                    hot_load: int = 8,
+                    binary: bool = False) -> 'BookReaderPool':
+        if size < 1:
+            raise ValueError(f'Pool size must be positive, got {size}')
+        readers = await asyncio.gather(
+            *(cls._spawn(command, args, binary) for _ in range(size)))
+        return cls(command, args, list(readers), hot_load, binary)
+
+    @staticmethod
+    async def _spawn(command: str, args: tuple[str, ...],
+                     binary: bool) -> AsyncBookReader:
+        reader = await AsyncBookReader.popen(command, *args)
+        if binary:
+            await reader.set_binary(True)
+        return reader
+
+    def route(self, filename: str) -> int:
+        home = zlib.crc32(filename.encode('utf-8')) % len(self.readers)
+        if self.load[home] < self.hot_load:
+            return home
+        return min(range(len(self.readers)), key=self.load.__getitem__)
+
+    async def _reader(self, idx: int) -> AsyncBookReader:
+        reader = self.readers[idx]
+        if reader.returncode.done():
+            logger.warning('Book reader %d exited with %s, respawning', idx,
+                           reader.returncode.result())
+            reader = await self._spawn(self.command, self.args, self.binary)
+            self.readers[idx] = reader
+            self.respawned += 1
+        return reader
+
+    @contextlib.asynccontextmanager
+    async def _loaded(self, idx: int) -> AsyncIterator[AsyncBookReader]:
+        self.load[idx] += 1
+        try:
+            yield await self._reader(idx)
+        finally:
+            self.load[idx] -= 1
+
+    async def _from_fen(self, filename: str, fen: str) -> EdgeResult:
+        async with self._loaded(self.route(filename)) as reader:
+            return await reader.from_fen(filename, fen)
+
+    async def _from_fens(
+            self, positions: list[tuple[str, str]]) -> list[EdgeResult]:
+        # One batch per reader, each position goes where from_fen sends it
+        batches: dict[int, list[int]] = {}
+        for pos_idx, (filename, _) in enumerate(positions):
+            batches.setdefault(self.route(filename), []).append(pos_idx)
+        results: list[EdgeResult | None] = [None] * len(positions)
+
+        async def run_batch(idx: int, pos_indices: list[int]):
+            async with self._loaded(idx) as reader:
+                batch = await reader.from_fens(
+                    [positions[pos_idx] for pos_idx in pos_indices])
+            for pos_idx, result in zip(pos_indices, batch):
+                results[pos_idx] = result
+
+        await asyncio.gather(*(run_batch(idx, pos_indices)
+                               for idx, pos_indices in batches.items()))
+        return results
+
+    async def from_fen(self, filename: str, fen: str) -> EdgeResult:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._from_fen(filename, fen),
+                                             self.loop))
+
+    async def from_fens(
+            self, positions: list[tuple[str, str]]) -> list[EdgeResult]:
+        """Looks up many positions with one round trip per reader."""
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._from_fens(positions),
+                                             self.loop))
+
+    async def preload(self, filename: str):
+        """Maps and indexes the book in the reader of the book."""
+        await self.from_fen(filename, chess.STARTING_FEN)
+
+    async def _stats(self) -> list[BookReaderStats]:
+        return await asyncio.gather(
+            *(reader.stats() for reader in self.readers))
+
+    async def stats(self) -> list[BookReaderStats]:
+        """Book cache statistics of every reader."""
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._stats(), self.loop))
+
+    def cursor(self, filename: str) -> 'BookCursor':
+        """New cursor on the book, opened by its first lookup."""
+        home = zlib.crc32(filename.encode('utf-8')) % len(self.readers)
+        return BookCursor(self, home, filename, f'c{next(self.cursor_ids)}')
+
+    async def exit(self) -> list[int]:
+        return await asyncio.gather(
+            *(reader.exit() for reader in self.readers))
+
+    async def quit(self) -> list[int]:
+        return await asyncio.gather(
+            *(reader.quit() for reader in self.readers))
+
+
+class BookCursor:
+    """
+    Game kept open in a reader of the pool.
+
+    `edges` brings the cursor to the board by taking back and making the
+    moves that differ from the previous lookup, the reader then updates the
+    hash move by move. A cursor the reader lost (idle timeout, respawn) is
+    opened again on the whole game. The lookups of one cursor run one after
+    another on the loop of the pool.
+
+    Attributes:
+        pool (BookReaderPool): The pool of the reader.
+        reader (int): Index of the reader keeping the cursor.
+        filename (str): The book.
+        name (str): Name of the cursor in the reader.
+        moves (list[chess.Move] | None): Moves the cursor made from the
+                                         root, None until it is opened.
+        lock (asyncio.Lock | None): Lock of the lookups, created on the loop
+                                    of the pool.
+    """
+
+    def __init__(self, pool: BookReaderPool, reader: int, filename: str,
+                 name: str):
+        self.pool = pool
+        self.reader = reader
+        self.filename = filename
+        self.name = name
+        self.moves: list[chess.Move] | None = None
+        self.lock: asyncio.Lock | None = None
+
+    async def _move_to(self, reader: AsyncBookReader,
+                       board: chess.Board) -> EdgeResult | None:
+        if self.moves is None:
+            return None
+        stack = board.move_stack
+        common = 0
+        for old, new in zip(self.moves, stack):
+            if old != new:
+                break
+            common += 1
+        pushes = stack[common:]
+        if len(self.moves) > common:
+            # The response is only read for the position after the pushes
+            popped = board.copy()
+            for _ in pushes:
+                popped.pop()
+            result = await reader.pop_cursor(self.name,
+                                             len(self.moves) - common, popped)
+            if result is None or not pushes:
+                return result
+        return await reader.push_cursor(self.name, pushes, board)
+
+    async def _edges(self, board: chess.Board) -> EdgeResult:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock, self.pool._loaded(self.reader) as reader:
+            result = await self._move_to(reader, board)
+            if result is None:
+                result = await reader.open_cursor(self.name, self.filename,
+                                                  board)
+            if result is None:
+                self.moves = None
+                return EdgeResult(board)
+            self.moves = list(board.move_stack)
+            return result
+
+    async def edges(self, board: chess.Board) -> EdgeResult:
+        """Edges of the board, the game of the cursor."""
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._edges(board.copy()),
+                                             self.pool.loop))
+
+    async def _close(self):
+        if self.moves is not None:
+            self.moves = None
+            reader = self.pool.readers[self.reader]
+            if not reader.returncode.done():
+                await reader.close_cursor(self.name)
+
+    def close(self):
+        """Closes the cursor in the background."""
+        asyncio.run_coroutine_threadsafe(self._close(), self.pool.loop)
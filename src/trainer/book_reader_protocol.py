@@ -1,25 +1,56 @@
 """
 This module contains the implementation of a book reader protocol.
 
+Commands are tagged with request ids and many of them can be in flight at
+once. book_reader answers them out of order and tags the first line of
+every response with the id of its command.
+
+A cursor keeps the board of a game open in book_reader, so consecutive
+lookups send the moves played since the last one instead of a FEN. Cursor
+commands answer None when book_reader no longer has the cursor (it timed
+out or the process was restarted), the caller then opens it again.
+
+In the binary response mode (see `set_binary`) the edges of a position are
+sent as a "positionbytes <n> total <t>" line followed by n bytes of
+fixed-size records, which are decoded in bulk without building a board.
+
 The module defines the following classes:
 - BaseCommand: Base class for commands used by the book reader agent.
+- CommandRouter: Matches tagged responses to the commands in flight.
 - BaseProtocol: Base class representing a protocol for interacting with a subprocess.
+- AsyncBaseProtocol: Asyncio flavour of BaseProtocol.
 - ExitCommand: Command class for exiting the book reader.
 - QuitCommand: Command class for quitting the book reader.
 - Edge: Data class representing an edge in the book reader.
 - EdgeResult: Data class representing the result of generating edges from a FEN position.
 - FromFenCommand: Command class for generating edges from a given FEN position.
+- FromFensCommand: Command class for generating edges from many positions at once.
+- CursorCommand: Command class for moving a cursor and generating edges from its position.
+- CloseCursorCommand: Command class for closing a cursor.
+- BinaryCommand: Command class for switching the binary response mode.
+- BookReaderStats: Data class representing the book cache of book_reader.
+- StatsCommand: Command class for reading the book cache statistics.
 - BookReader: Class representing the book reader protocol.
+- AsyncBookReader: Asyncio flavour of BookReader.
 
 Example usage:
 book_reader = BookReader.popen('./book_reader', 'tree.bin')
 result = book_reader.from_fen('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
 logger.debug('\n'.join(map(str, result.edges)))
+
+book_reader = await AsyncBookReader.popen('./book_reader')
+result = await book_reader.from_fen('tree.bin', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
+results = await book_reader.from_fens([('tree.bin', fen) for fen in fens])
+result = await book_reader.open_cursor('game-1', 'tree.bin', board)
+board.push(move)
+result = await book_reader.push_cursor('game-1', [move], board)
 """
+import asyncio
+import itertools
 import threading
-import queue
 import concurrent.futures as cf
 import logging
+import struct
 import subprocess
 import abc
 from typing import TypeVar, Generic
@@ -32,7 +63,11 @@ logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
 logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
-ProtocolT = TypeVar('ProtocolT', bound='BaseProtocol')
+
+# Record of the binary response mode: from square, to square, promotion
+# piece type or 0, padding and the number of appearances
+BINARY_EDGE = struct.Struct('<BBBxI')
+ProtocolT = TypeVar('ProtocolT', bound='BaseProtocol | AsyncBaseProtocol')
 
 
 class BaseCommand(Generic[ProtocolT, T], metaclass=abc.ABCMeta):
@@ -43,10 +78,16 @@ class BaseCommand(Generic[ProtocolT, T], metaclass=abc.ABCMeta):
     Attributes:
         result (concurrent.futures.Future): The future object representing
                                             the result of the command.
+        id (int | None): Request id the command is tagged with.
+        expected_bytes (int): Raw bytes the command is waiting for before its
+                              next line.
     """
 
+    expected_bytes = 0
+
     def __init__(self) -> None:
         self.result: cf.Future[T] = cf.Future()
+        self.id: int | None = None
 
     @abc.abstractmethod
     def start(self, protocol: ProtocolT) -> None:
@@ -56,6 +97,14 @@ class BaseCommand(Generic[ProtocolT, T], metaclass=abc.ABCMeta):
     def on_line(self, protocol: ProtocolT, line: str) -> None:
         """Process the command line received from the book reader."""
 
+    def on_bytes(self, protocol: ProtocolT, data: bytes) -> None:
+        """Process the raw bytes announced by the previous line."""
+
+    def send_line(self, protocol: ProtocolT, line: str) -> None:
+        if self.id is not None:
+            line = f'#{self.id} {line}'
+        protocol.send_line(line)
+
     def set_done(self, value: T | None) -> None:
         if not self.result.done():
             self.result.set_result(value)
@@ -67,7 +116,64 @@ class BaseCommand(Generic[ProtocolT, T], metaclass=abc.ABCMeta):
         return self.result.done()
 
     def __repr__(self) -> str:
-        return f'<{type(self).__name__}, result={self.result}>'
+        return f'<{type(self).__name__}, id={self.id}, result={self.result}>'
+
+
+class CommandRouter:
+    """
+    Matches tagged responses of book_reader to the commands in flight.
+
+    A line starting with "#<id>" begins the response of the command with
+    that id, untagged lines continue the current response. The lines of one
+    response are never interleaved with another response.
+
+    Attributes:
+        ids (itertools.count): Source of request ids.
+        pending (dict[int, BaseCommand]): Commands waiting for a response.
+        current (BaseCommand | None): Command whose response is being read.
+    """
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.pending: dict[int, BaseCommand] = {}
+        self.current: BaseCommand | None = None
+
+    def register(self, command: BaseCommand):
+        command.id = next(self.ids)
+        self.pending[command.id] = command
+
+    def discard(self, command: BaseCommand):
+        self.pending.pop(command.id, None)
+        if self.current is command:
+            self.current = None
+
+    def route(self, protocol: 'BaseProtocol | AsyncBaseProtocol', line: str):
+        if line.startswith('#'):
+            tag, _, line = line.partition(' ')
+            self.current = self.pending.get(int(tag[1:]))
+        command = self.current
+        if command is None:
+            logger.warning('%s: Unexpected line: %s', protocol, line.rstrip())
+            return
+        command.on_line(protocol, line)
+        if command.is_done():
+            self.discard(command)
+
+    def expected_bytes(self) -> int:
+        return self.current.expected_bytes if self.current else 0
+
+    def route_bytes(self, protocol: 'BaseProtocol | AsyncBaseProtocol',
+                    data: bytes):
+        command = self.current
+        command.on_bytes(protocol, data)
+        if command.is_done():
+            self.discard(command)
+
+    def terminate_all(self):
+        for command in self.pending.values():
+            command.terminate()
+        self.pending.clear()
+        self.current = None
 
 
 class BaseProtocol():
@@ -77,8 +183,7 @@ class BaseProtocol():
     Attributes:
         proc (subprocess.Popen): The subprocess instance.
         thread (threading.Thread): The thread used to run the protocol.
-        queue (queue.Queue): The queue used to store commands.
-        curr_command (BaseCommand | None): The current command being executed.
+        router (CommandRouter): The commands in flight.
         terminate_event (threading.Event): The event used to signal termination.
         lock (threading.Lock): The lock used for thread synchronization.
         stdin_lock (threading.Lock): The lock used for stdin synchronization.
@@ -87,24 +192,12 @@ class BaseProtocol():
     def __init__(self, proc: subprocess.Popen):
         self.proc = proc
         self.thread = threading.Thread(target=self.run)
-        self.queue: queue.Queue[BaseCommand] = queue.Queue()
-        self.curr_command: BaseCommand | None = None
+        self.router = CommandRouter()
         self.terminate_event = threading.Event()
         self.lock = threading.Lock()
         self.stdin_lock = threading.Lock()
         self.thread.start()
 
-    def _update_curr_command(self):
-        with self.lock:
-            logger.debug('_update_curr_command')
-            if self.curr_command is None or self.curr_command.is_done():
-                try:
-                    self.curr_command = self.queue.get_nowait()
-                    logger.debug('Starting command: %s', self.curr_command)
-                    self.curr_command.start(self)
-                except queue.Empty:
-                    self.curr_command = None
-
     def send_line(self, line: str):
         with self.stdin_lock:
             logger.debug('%s: Send line: %s', self, line)
@@ -113,22 +206,35 @@ class BaseProtocol():
 
     def line_received(self, line: str):
         logger.debug('%s: Received line: %s', self, line)
-        self._update_curr_command()
-        if self.curr_command is not None:
-            self.curr_command.on_line(self, line)
+        with self.lock:
+            self.router.route(self, line)
+            return self.router.expected_bytes()
+
+    def bytes_received(self, data: bytes):
+        logger.debug('%s: Received %d bytes', self, len(data))
+        with self.lock:
+            self.router.route_bytes(self, data)
 
     def run(self):
         while not self.terminate_event.is_set():
             line = self.proc.stdout.readline().decode('utf-8')
             if not line:
                 break
-            self.line_received(line)
+            if expected_bytes := self.line_received(line):
+                data = self.proc.stdout.read(expected_bytes)
+                if len(data) < expected_bytes:
+                    break
+                self.bytes_received(data)
         self._clean_up()
 
     def add_command(self, command: BaseCommand[ProtocolT, T]) -> T:
         logger.debug('%s: Command added: %s', self, command)
-        self.queue.put(command)
-        self._update_curr_command()
+        with self.lock:
+            self.router.register(command)
+            command.start(self)
+            # Commands like exit are done as soon as they are started
+            if command.is_done():
+                self.router.discard(command)
         return command.result.result()
 
     @classmethod
@@ -144,22 +250,107 @@ class BaseProtocol():
         return self.proc.wait()
 
     def _clean_up(self):
-        while True:
-            try:
-                command = self.queue.get_nowait()
-                command.start(self)
-                command.terminate()
-            except queue.Empty:
-                break
+        with self.lock:
+            self.router.terminate_all()
         self.proc.terminate()
         return self.proc.wait()
 
 
+class AsyncBaseProtocol(asyncio.SubprocessProtocol):
+    """
+    Asyncio flavour of BaseProtocol.
+
+    Runs the same commands as BaseProtocol, but reads the subprocess output
+    on an event loop instead of a dedicated thread. `add_command` can be
+    awaited from any event loop, the command is always run on the loop
+    that spawned the subprocess.
+
+    Attributes:
+        loop (asyncio.AbstractEventLoop): The loop owning the subprocess.
+        transport (asyncio.SubprocessTransport | None): The subprocess transport.
+        buffer (bytearray): Received output that is not a full line yet.
+        router (CommandRouter): The commands in flight.
+        returncode (concurrent.futures.Future): Exit code of the subprocess.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport: asyncio.SubprocessTransport | None = None
+        self.buffer = bytearray()
+        self.router = CommandRouter()
+        self.returncode: cf.Future[int] = cf.Future()
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        self.transport = transport
+
+    def pipe_data_received(self, fd: int, data: bytes):
+        if fd == 2:
+            logger.warning('%s: %s', self, data.decode('utf-8').rstrip())
+            return
+        self.buffer.extend(data)
+        while True:
+            if expected_bytes := self.router.expected_bytes():
+                if len(self.buffer) < expected_bytes:
+                    return
+                chunk = bytes(self.buffer[:expected_bytes])
+                del self.buffer[:expected_bytes]
+                self.router.route_bytes(self, chunk)
+                continue
+            end = self.buffer.find(b'\n')
+            if end == -1:
+                return
+            line = self.buffer[:end + 1].decode('utf-8')
+            del self.buffer[:end + 1]
+            self.line_received(line)
+
+    def process_exited(self):
+        self.router.terminate_all()
+        self.returncode.set_result(self.transport.get_returncode())
+
+    def send_line(self, line: str):
+        logger.debug('%s: Send line: %s', self, line)
+        self.transport.get_pipe_transport(0).write(
+            (line + '\n').encode('utf-8'))
+
+    def line_received(self, line: str):
+        logger.debug('%s: Received line: %s', self, line)
+        self.router.route(self, line)
+
+    def _add_command(self, command: BaseCommand):
+        if self.returncode.done():
+            command.terminate()
+            return
+        self.router.register(command)
+        command.start(self)
+        # Commands like exit are done as soon as they are started
+        if command.is_done():
+            self.router.discard(command)
+
+    async def add_command(self, command: BaseCommand[ProtocolT, T]) -> T:
+        logger.debug('%s: Command added: %s', self, command)
+        self.loop.call_soon_threadsafe(self._add_command, command)
+        return await asyncio.wrap_future(command.result)
+
+    @classmethod
+    async def popen(cls, command: str, *args):
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.subprocess_exec(cls,
+                                                 command,
+                                                 *args,
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE,
+                                                 stderr=subprocess.PIPE)
+        return protocol
+
+    async def wait(self) -> int:
+        return await asyncio.wrap_future(self.returncode)
+
+
 class ExitCommand(BaseCommand[BaseProtocol, None]):
 
     def start(self, protocol: BaseProtocol):
         logger.debug('Exitting')
-        protocol.send_line('exit')
+        self.send_line(protocol, 'exit')
         self.set_done(None)
 
     def on_line(self, protocol: BaseProtocol, line: str):
@@ -170,7 +361,27 @@ class QuitCommand(BaseCommand[BaseProtocol, None]):
 
     def start(self, protocol: BaseProtocol):
         logger.debug('Quitting')
-        protocol.send_line('quit')
+        self.send_line(protocol, 'quit')
+        self.set_done(None)
+
+    def on_line(self, protocol: BaseProtocol, line: str):
+        pass
+
+
+class BinaryCommand(BaseCommand[BaseProtocol, None]):
+    """
+    Switches the binary response mode for the commands sent after it.
+
+    Attributes:
+        enabled (bool): Whether responses are binary from now on.
+    """
+
+    def __init__(self, enabled: bool) -> None:
+        super().__init__()
+        self.enabled = enabled
+
+    def start(self, protocol: BaseProtocol):
+        self.send_line(protocol, 'binary on' if self.enabled else 'binary off')
         self.set_done(None)
 
     def on_line(self, protocol: BaseProtocol, line: str):
@@ -185,8 +396,11 @@ class Edge:
 
 @dataclasses.dataclass
 class EdgeResult:
-    board: chess.Board = dataclasses.field(default_factory=chess.Board)
+    # Only built for text responses
+    board: chess.Board | None = None
     edges: list[Edge] = dataclasses.field(default_factory=list)
+    # Number of appearances of the position in the book
+    total: int = 0
 
 
 class FromFenCommand(BaseCommand[BaseProtocol, EdgeResult]):
@@ -204,16 +418,26 @@ class FromFenCommand(BaseCommand[BaseProtocol, EdgeResult]):
         super().__init__()
         self.filename = filename
         self.fen = fen
-        self.edge_result = EdgeResult(board=chess.Board(fen))
+        self.edge_result = EdgeResult()
         self.expected_lines = None
         self.processed_lines = 0
 
     def start(self, protocol: BaseProtocol) -> None:
-        protocol.send_line(f'fromfen {self.filename} {self.fen}')
+        self.send_line(protocol, f'fromfen {self.filename} {self.fen}')
 
     def on_line(self, _: BaseProtocol, line: str) -> None:
         words = line.strip().split()
+        if (words[0] in ('positionbytes', 'positionmoves') and
+                len(words) >= 4 and words[2] == 'total'):
+            # positionbytes|positionmoves <n> total <t>
+            self.edge_result.total = int(words[3])
+        if words[0] == 'positionbytes':
+            self.expected_bytes = int(words[1])
+            if self.expected_bytes == 0:
+                self.set_done(self.edge_result)
+            return
         if words[0] == 'positionmoves':
+            self.edge_result.board = self.make_board()
             self.expected_lines = int(words[1])
             if self.expected_lines == 0:
                 self.set_done(self.edge_result)
@@ -229,6 +453,154 @@ class FromFenCommand(BaseCommand[BaseProtocol, EdgeResult]):
         if self.processed_lines == self.expected_lines:
             self.set_done(self.edge_result)
 
+    def make_board(self) -> chess.Board:
+        return chess.Board(self.fen)
+
+    def on_bytes(self, _: BaseProtocol, data: bytes) -> None:
+        # Castling is already sent in the python-chess convention
+        self.expected_bytes = 0
+        self.edge_result.edges = [
+            Edge(chess.Move(src, dst, promotion or None), count)
+            for src, dst, promotion, count in BINARY_EDGE.iter_unpack(data)
+        ]
+        self.set_done(self.edge_result)
+
+
+class FromFensCommand(BaseCommand[BaseProtocol, list[EdgeResult]]):
+    """
+    Represents a command to generate edges from many positions in one round
+    trip.
+
+    Attributes:
+        positions (list[tuple[str, str]]): Pairs of book and FEN position.
+        commands (list[FromFenCommand]): Parsers of the single responses.
+        processed_positions (int): The number of positions processed so far.
+    """
+
+    def __init__(self, positions: list[tuple[str, str]]) -> None:
+        super().__init__()
+        self.positions = positions
+        self.commands = [
+            FromFenCommand(filename, fen) for filename, fen in positions
+        ]
+        self.processed_positions = 0
+
+    def start(self, protocol: BaseProtocol) -> None:
+        args = ' '.join(f'{filename} {fen}'
+                        for filename, fen in self.positions)
+        self.send_line(protocol, f'fromfens {len(self.positions)} {args}')
+
+    @property
+    def expected_bytes(self) -> int:
+        if self.processed_positions == len(self.commands):
+            return 0
+        return self.commands[self.processed_positions].expected_bytes
+
+    def on_line(self, protocol: BaseProtocol, line: str) -> None:
+        words = line.strip().split()
+        if words[0] == 'positions':
+            if not self.commands:
+                self.set_done([])
+            return
+        self._feed(self.commands[self.processed_positions].on_line, protocol,
+                   line)
+
+    def on_bytes(self, protocol: BaseProtocol, data: bytes) -> None:
+        self._feed(self.commands[self.processed_positions].on_bytes,
+                   protocol, data)
+
+    def _feed(self, handler, protocol: BaseProtocol, data: str | bytes):
+        handler(protocol, data)
+        if self.commands[self.processed_positions].is_done():
+            self.processed_positions += 1
+        if self.processed_positions == len(self.commands):
+            self.set_done(
+                [command.result.result() for command in self.commands])
+
+
+class CursorCommand(FromFenCommand):
+    """
+    Represents a command on a cursor, answered with the edges of the
+    position the cursor reaches, or None if book_reader has no such cursor.
+
+    Attributes:
+        line (str): The command line, without the request id.
+        board (chess.Board): The position the cursor reaches, only read for
+                             text responses.
+    """
+
+    def __init__(self, line: str, board: chess.Board) -> None:
+        super().__init__('', '')
+        self.line = line
+        self.board = board
+
+    def start(self, protocol: BaseProtocol) -> None:
+        self.send_line(protocol, self.line)
+
+    def make_board(self) -> chess.Board:
+        return self.board.copy(stack=False)
+
+    def on_line(self, protocol: BaseProtocol, line: str) -> None:
+        if line.startswith('nocursor'):
+            self.set_done(None)
+            return
+        super().on_line(protocol, line)
+
+
+class CloseCursorCommand(BaseCommand[BaseProtocol, None]):
+    """
+    Closes a cursor, book_reader does not answer.
+
+    Attributes:
+        cursor (str): Name of the cursor.
+    """
+
+    def __init__(self, cursor: str) -> None:
+        super().__init__()
+        self.cursor = cursor
+
+    def start(self, protocol: BaseProtocol):
+        self.send_line(protocol, f'close {self.cursor}')
+        self.set_done(None)
+
+    def on_line(self, protocol: BaseProtocol, line: str):
+        pass
+
+
+def open_cursor_line(cursor: str, filename: str, board: chess.Board) -> str:
+    # The cursor starts from the root, so later pops reach the whole game
+    moves = ' '.join(move.uci() for move in board.move_stack)
+    return f'open {cursor} {filename} {board.root().fen()} {moves}'.rstrip()
+
+
+def push_cursor_line(cursor: str, moves: list[chess.Move]) -> str:
+    return ' '.join([f'push {cursor}', *(move.uci() for move in moves)])
+
+
+@dataclasses.dataclass
+class BookReaderStats:
+    books: int = 0
+    bytes: int = 0
+    budget: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class StatsCommand(BaseCommand[BaseProtocol, BookReaderStats]):
+
+    def start(self, protocol: BaseProtocol) -> None:
+        self.send_line(protocol, 'stats')
+
+    def on_line(self, _: BaseProtocol, line: str) -> None:
+        # stats books <n> bytes <n> budget <n> hits <n> ...
+        words = line.split()[1:]
+        self.set_done(
+            BookReaderStats(**{
+                name: int(value)
+                for name, value in zip(words[::2], words[1::2])
+            }))
+
 
 class BookReader(BaseProtocol):
     """
@@ -246,6 +618,80 @@ class BookReader(BaseProtocol):
     def from_fen(self, filename: str, fen: str):
         return self.add_command(FromFenCommand(filename, fen))
 
+    def from_fens(self, positions: list[tuple[str, str]]) -> list[EdgeResult]:
+        return self.add_command(FromFensCommand(positions))
+
+    def set_binary(self, enabled: bool):
+        self.add_command(BinaryCommand(enabled))
+
+    def stats(self) -> BookReaderStats:
+        return self.add_command(StatsCommand())
+
+    def open_cursor(self, cursor: str, filename: str,
+                    board: chess.Board) -> EdgeResult | None:
+        return self.add_command(
+            CursorCommand(open_cursor_line(cursor, filename, board), board))
+
+    def push_cursor(self, cursor: str, moves: list[chess.Move],
+                    board: chess.Board) -> EdgeResult | None:
+        return self.add_command(
+            CursorCommand(push_cursor_line(cursor, moves), board))
+
+    def pop_cursor(self, cursor: str, n: int,
+                   board: chess.Board) -> EdgeResult | None:
+        return self.add_command(CursorCommand(f'pop {cursor} {n}', board))
+
+    def close_cursor(self, cursor: str):
+        self.add_command(CloseCursorCommand(cursor))
+
+
+class AsyncBookReader(AsyncBaseProtocol):
+    """
+    Wrapper around AsyncBaseProtocol to interact with book_reader.cc.
+    """
+
+    async def exit(self) -> int:
+        await self.add_command(ExitCommand())
+        return await self.wait()
+
+    async def quit(self) -> int:
+        await self.add_command(QuitCommand())
+        return await self.wait()
+
+    async def from_fen(self, filename: str, fen: str) -> EdgeResult:
+        return await self.add_command(FromFenCommand(filename, fen))
+
+    async def from_fens(
+            self, positions: list[tuple[str, str]]) -> list[EdgeResult]:
+        return await self.add_command(FromFensCommand(positions))
+
+    async def set_binary(self, enabled: bool):
+        await self.add_command(BinaryCommand(enabled))
+
+    async def stats(self) -> BookReaderStats:
+        return await self.add_command(StatsCommand())
+
+    async def open_cursor(self, cursor: str, filename: str,
+                          board: chess.Board) -> EdgeResult | None:
+        """Opens the cursor on the board, replacing an open one."""
+        return await self.add_command(
+            CursorCommand(open_cursor_line(cursor, filename, board), board))
+
+    async def push_cursor(self, cursor: str, moves: list[chess.Move],
+                          board: chess.Board) -> EdgeResult | None:
+        """Makes the moves on the cursor, `board` is the position after."""
+        return await self.add_command(
+            CursorCommand(push_cursor_line(cursor, moves), board))
+
+    async def pop_cursor(self, cursor: str, n: int,
+                         board: chess.Board) -> EdgeResult | None:
+        """Takes back n moves, `board` is the position after."""
+        return await self.add_command(CursorCommand(f'pop {cursor} {n}',
+                                                    board))
+
+    async def close_cursor(self, cursor: str):
+        await self.add_command(CloseCursorCommand(cursor))
+
 
 #######################################################
 # Example usage
@@ -0,0 +1,111 @@
+"""
+This module contains the warm-up of the opening books at startup.
+
+The first lookup of a book pays for mapping and indexing a file of several
+megabytes, so on a fresh deploy the first move of every opening is slow.
+The warm-up preloads the books of config.json (or a subset of them) into
+the book reader before any request needs them, a few books at a time, and
+reports whether they are loaded, so a load balancer only sends traffic to
+warm workers (see views/health.py). Books of config.json that are not built
+are reported as missing, they do not keep a worker out of rotation.
+
+The module defines the following classes:
+- BookWarmUp: Preloading of books into a book reader.
+
+Example usage:
+warm_up = BookWarmUp.from_config(BOOKS_DIR, ['ruy_lopez', 'semi_slav'])
+event_loop.submit(warm_up.run(book_reader, parallelism=2))
+warm_up.ready
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+
+class BookWarmUp:
+    """
+    Preloading of books into a book reader.
+
+    The state is only changed on the loop running `run`, other threads may
+    read it.
+
+    Attributes:
+        paths (list[str]): Paths of the books to preload.
+        loaded (list[str]): Paths of the preloaded books.
+        missing (list[str]): Paths of the books that do not exist.
+        failed (dict[str, str]): Errors of the books that failed to load.
+        started (float | None): Time the warm-up started.
+        finished (float | None): Time the warm-up finished.
+    """
+
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+        self.loaded: list[str] = []
+        self.missing: list[str] = []
+        self.failed: dict[str, str] = {}
+        self.started: float | None = None
+        self.finished: float | None = None
+
+    @classmethod
+    def from_config(cls,
+                    books_dir: str,
+                    books: list[str] | None = None) -> 'BookWarmUp':
+        """Warm-up of the given books, all books of config.json by default."""
+        if books is None:
+            with open(os.path.join(books_dir, 'config.json'),
+                      encoding='utf-8') as f:
+                books = [opening['book'] for opening in json.load(f)]
+        return cls([os.path.join(books_dir, book + '.bin') for book in books])
+
+    @property
+    def ready(self) -> bool:
+        # Missing books are not built, no worker could serve them. A book
+        # that exists but failed to load is a broken worker.
+        return self.finished is not None and not self.failed
+
+    async def _preload(self, book_reader, path: str,
+                       semaphore: asyncio.Semaphore):
+        if not os.path.exists(path):
+            self.missing.append(path)
+            return
+        async with semaphore:
+            try:
+                await book_reader.preload(path)
+            except Exception as e:
+                logger.exception('Cannot preload book %s', path)
+                self.failed[path] = repr(e)
+                return
+        self.loaded.append(path)
+
+    async def run(self, book_reader, parallelism: int = 1):
+        """Preloads the books, at most `parallelism` at once."""
+        self.started = time.time()
+        semaphore = asyncio.Semaphore(max(parallelism, 1))
+        await asyncio.gather(*(self._preload(book_reader, path, semaphore)
+                               for path in self.paths))
+        self.finished = time.time()
+        logger.info('Preloaded %d books in %.2fs, %d missing, %d failed',
+                    len(self.loaded), self.finished - self.started,
+                    len(self.missing), len(self.failed))
+
+    def status(self) -> dict[str, Any]:
+        elapsed = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        return {
+            'ready': self.ready,
+            'finished': self.finished is not None,
+            'books': len(self.paths),
+            'loaded': len(self.loaded),
+            'missing': list(self.missing),
+            'failed': dict(self.failed),
+            'elapsed': elapsed,
+        }
@@ -0,0 +1,341 @@
+"""
+This module contains a pool of long-lived UCI engine processes.
+
+Spawning and initialising a Stockfish process per analysis dominates the
+latency of a request and throws away the engine's hash table every time.
+The pool keeps a bounded number of engines alive for the whole lifetime of
+the application and hands them out to requests.
+
+Engines have an affinity to the game they analysed last. Consecutive
+positions of a game share most of their search tree, so the engine that
+analysed the previous position gets the next one and reuses its hash
+table. The affinity is dropped when the engine is handed to another game.
+Positions are sent as `position startpos moves ...` as long as the board
+keeps its move stack, and `ucinewgame` is never sent between games, so the
+hash table is never cleared.
+
+Every search has a deadline: its time limit plus the pool timeout. An
+engine that misses it, because it stalls or because python-chess rejected
+its reply and keeps waiting, is discarded like a crashed one, so a stalled
+search cannot hold an engine forever.
+
+Background work (see prefetcher.py) acquires engines with lower priority:
+it waits while any request is waiting and never takes the last `reserve`
+free engines.
+
+Engines are asyncio engines (`chess.engine.popen_uci`) living on the event
+loop given to the pool. `analyse`, `play` and `run` can be awaited from any
+event loop; `checkout` must be used on the pool's loop.
+
+The module defines the following classes:
+- EngineProfile: Named set of UCI options an engine is configured with.
+- PooledEngine: Engine process owned by the pool together with its profile.
+- EnginePool: Process-wide pool of engines with checkout/checkin semantics.
+
+Example usage:
+engine_pool = EnginePool('./stockfish', 4, event_loop.loop)
+info = await engine_pool.analyse(EngineProfile('analysis', {'Hash': 128}),
+                                 board, chess.engine.Limit(depth=15))
+"""
+import asyncio
+import contextlib
+import dataclasses
+import logging
+from typing import (Any, AsyncIterator, Awaitable, Callable, Coroutine,
+                    Hashable, TypeVar)
+import chess
+import chess.engine
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+ENGINE_ERRORS = (chess.engine.EngineError, chess.engine.EngineTerminatedError,
+                 asyncio.TimeoutError)
+
+
+@dataclasses.dataclass
+class EngineProfile:
+    """
+    Named set of UCI options.
+
+    Engines remember the last profile they were configured with, so checking
+    out an engine with the same profile again does not send any options.
+
+    Attributes:
+        name (str): Unique name of the profile.
+        options (dict): UCI options passed to `engine.configure`.
+    """
+    name: str
+    options: dict[str, chess.engine.ConfigValue] = dataclasses.field(
+        default_factory=dict)
+
+
+class PooledEngine:
+    """
+    Engine process owned by the pool.
+
+    Attributes:
+        transport (asyncio.SubprocessTransport): Transport of the process.
+        engine (chess.engine.Protocol): The engine protocol.
+        profile (EngineProfile | None): Profile the engine is configured with.
+        game (Hashable | None): Game the engine analysed last.
+        broken (bool): Set when the engine failed while checked out.
+    """
+
+    def __init__(self, transport: asyncio.SubprocessTransport,
+                 engine: chess.engine.Protocol):
+        self.transport = transport
+        self.engine = engine
+        self.profile: EngineProfile | None = None
+        self.game: Hashable | None = None
+        self.broken = False
+
+    async def apply_profile(self, profile: EngineProfile):
+        if self.profile is not None and self.profile.name == profile.name:
+            return
+        options: dict[str, chess.engine.ConfigValue] = {}
+        if self.profile is not None:
+            # Options of the previous profile go back to engine defaults
+            for name in self.profile.options.keys() - profile.options.keys():
+                options[name] = self.engine.options[name].default
+        options.update(profile.options)
+        await self.engine.configure(options)
+        self.profile = profile
+
+    async def is_alive(self, timeout: float | None) -> bool:
+        if self.broken or self.engine.returncode.done():
+            return False
+        try:
+            await asyncio.wait_for(self.engine.ping(), timeout)
+        except ENGINE_ERRORS:
+            return False
+        return True
+
+    async def quit(self, timeout: float | None):
+        try:
+            await asyncio.wait_for(self.engine.quit(), timeout)
+        except ENGINE_ERRORS:
+            self.transport.close()
+
+    def __repr__(self) -> str:
+        profile = self.profile.name if self.profile else None
+        return f'<{type(self).__name__}, profile={profile}, game={self.game}>'
+
+
+class EnginePool:
+    """
+    Process-wide pool of UCI engines.
+
+    Engines are spawned lazily up to `size`. A checked out engine is
+    exclusively owned by the caller until it is checked in again. Idle
+    engines are health checked before they are handed out and crashed
+    engines are replaced by fresh processes.
+
+    Attributes:
+        command (str): Path to the engine binary.
+        size (int): Maximal number of engine processes.
+        loop (asyncio.AbstractEventLoop): Event loop owning the engines.
+        timeout (float | None): Timeout for engine startup and health checks,
+                                and the time a search may take beyond its
+                                time limit.
+        idle (list[PooledEngine]): Engines that are not checked out.
+        spawned (int): Number of engine processes owned by the pool.
+        replaced (int): Number of crashed engines that were replaced.
+        reserve (int): Free engines background work does not take.
+        waiting (int): Number of requests waiting for an engine.
+        condition (asyncio.Condition): Guards the pool state.
+    """
+
+    def __init__(self,
+                 command: str,
+                 size: int,
+                 loop: asyncio.AbstractEventLoop,
+                 timeout: float | None = 10.0,
+                 reserve: int = 1):
+        if size < 1:
+            raise ValueError(f'Pool size must be positive, got {size}')
+        self.command = command
+        self.size = size
+        self.loop = loop
+        self.timeout = timeout
+        self.idle: list[PooledEngine] = []
+        self.spawned = 0
+        self.replaced = 0
+        self.reserve = reserve
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+
+    async def _spawn(self) -> PooledEngine:
+        logger.debug('Spawning engine %s', self.command)
+        transport, engine = await asyncio.wait_for(
+            chess.engine.popen_uci(self.command), self.timeout)
+        return PooledEngine(transport, engine)
+
+    def _take_idle(self, profile: EngineProfile,
+                   game: Hashable | None) -> PooledEngine:
+
+        # Prefer the engine of the game, then engines of no game, then
+        # engines that do not have to be reconfigured. Ties go to the
+        # least recently used engine.
+        def rank(pooled: PooledEngine) -> tuple[bool, bool, bool]:
+            return (game is not None and pooled.game == game, pooled.game
+                    is None, pooled.profile is not None and
+                    pooled.profile.name == profile.name)
+
+        return self.idle.pop(
+            max(range(len(self.idle)), key=lambda idx: rank(self.idle[idx])))
+
+    async def _discard(self, pooled: PooledEngine):
+        await pooled.quit(self.timeout)
+        async with self.condition:
+            self.spawned -= 1
+            self.condition.notify_all()
+
+    def available(self) -> int:
+        return len(self.idle) + self.size - self.spawned
+
+    def _background_ready(self) -> bool:
+        # Keep engines free for requests, unless the pool has only one
+        return (not self.waiting and
+                self.available() > min(self.reserve, self.size - 1))
+
+    async def acquire(self,
+                      profile: EngineProfile,
+                      background: bool = False,
+                      game: Hashable | None = None) -> PooledEngine:
+        pooled = None
+        async with self.condition:
+            if background:
+                await self.condition.wait_for(self._background_ready)
+            else:
+                self.waiting += 1
+                try:
+                    await self.condition.wait_for(self.available)
+                finally:
+                    self.waiting -= 1
+                    # Background waiters may be unblocked now
+                    self.condition.notify_all()
+            if self.idle:
+                pooled = self._take_idle(profile, game)
+            else:
+                self.spawned += 1
+        try:
+            if pooled is None:
+                pooled = await self._spawn()
+            elif not await pooled.is_alive(self.timeout):
+                logger.warning('Replacing crashed engine %s', pooled)
+                await pooled.quit(self.timeout)
+                self.replaced += 1
+                pooled = await self._spawn()
+            await pooled.apply_profile(profile)
+            pooled.game = game
+        except ENGINE_ERRORS:
+            if pooled is not None:
+                await pooled.quit(self.timeout)
+            async with self.condition:
+                self.spawned -= 1
+                self.condition.notify_all()
+            raise
+        return pooled
+
+    async def release(self, pooled: PooledEngine):
+        if pooled.broken:
+            logger.warning('Discarding broken engine %s', pooled)
+            await self._discard(pooled)
+            return
+        async with self.condition:
+            self.idle.append(pooled)
+            # Waiters of both priorities have to recheck
+            self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def checkout(
+            self,
+            profile: EngineProfile,
+            background: bool = False,
+            game: Hashable | None = None
+    ) -> AsyncIterator[chess.engine.Protocol]:
+        pooled = await self.acquire(profile, background, game)
+        try:
+            yield pooled.engine
+        except (*ENGINE_ERRORS, asyncio.CancelledError):
+            # The engine may be left in the middle of a search
+            pooled.broken = True
+            raise
+        finally:
+            await self.release(pooled)
+
+    async def _on_loop(self, coro: Coroutine[Any, Any, T]) -> T:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def _search(self, awaitable: Awaitable[T],
+                      time: float | None) -> T:
+        # A timeout breaks the engine in checkout, it is discarded
+        if self.timeout is None:
+            return await awaitable
+        deadline = (time or 0) + self.timeout
+        try:
+            return await asyncio.wait_for(awaitable, deadline)
+        except asyncio.TimeoutError:
+            logger.warning('Engine search missed its deadline of %.1fs',
+                           deadline)
+            raise
+
+    async def _run(self, profile: EngineProfile,
+                   func: Callable[..., Awaitable[T]], args: tuple,
+                   time: float | None, background: bool,
+                   game: Hashable | None) -> T:
+        async with self.checkout(profile, background, game) as engine:
+            return await self._search(func(engine, *args), time)
+
+    async def _analyse(self, profile: EngineProfile, board: chess.Board,
+                       limit: chess.engine.Limit, kwargs: dict[str, Any]):
+        async with self.checkout(profile) as engine:
+            return await self._search(engine.analyse(board, limit, **kwargs),
+                                      limit.time)
+
+    async def _play(self, profile: EngineProfile, board: chess.Board,
+                    limit: chess.engine.Limit) -> chess.engine.PlayResult:
+        async with self.checkout(profile) as engine:
+            return await self._search(engine.play(board, limit), limit.time)
+
+    async def analyse(self, profile: EngineProfile, board: chess.Board,
+                      limit: chess.engine.Limit, **kwargs: Any):
+        return await self._on_loop(
+            self._analyse(profile, board.copy(), limit, kwargs))
+
+    async def play(self, profile: EngineProfile, board: chess.Board,
+                   limit: chess.engine.Limit) -> chess.engine.PlayResult:
+        return await self._on_loop(self._play(profile, board.copy(), limit))
+
+    async def run(self,
+                  profile: EngineProfile,
+                  func: Callable[..., Awaitable[T]],
+                  *args: Any,
+                  time: float | None = None,
+                  background: bool = False,
+                  game: Hashable | None = None) -> T:
+        """
+        Awaits `func(engine, *args)` with a checked out engine.
+
+        `time` is the time limit of the search `func` runs, the call fails
+        with asyncio.TimeoutError once it is exceeded by the pool timeout.
+        """
+        return await self._on_loop(
+            self._run(profile, func, args, time, background, game))
+
+    async def _close(self):
+        async with self.condition:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            await self._discard(pooled)
+
+    def close(self):
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._close(),
+                                             self.loop).result()
@@ -0,0 +1,212 @@
+"""
+This module contains a two-tier cache of engine evaluations.
+
+Evaluations are keyed by (position hash, depth, engine profile). A lookup
+returns the deepest evaluation of the position that is at least as deep as
+requested. The first tier is an in-memory LRU shared by the threads of one
+process, it keeps only the deepest evaluation of every position. The second
+tier is an SQLite database that survives restarts and can be shared by
+several worker processes.
+
+The module defines the following classes:
+- CachedEvaluation: Data class representing a cached engine evaluation.
+- CacheStats: Data class representing hit/miss counters of the cache.
+- EvaluationCache: Two-tier cache of engine evaluations.
+
+Example usage:
+cache = EvaluationCache('evaluations.sqlite3', capacity=10000)
+evaluation = cache.get(board, 15, 'analysis')
+if evaluation is None:
+    info = engine.analyse(board, chess.engine.Limit(depth=15))
+    cache.put(board, 'analysis', CachedEvaluation(info['score'], info['pv'], 15))
+"""
+import collections
+import dataclasses
+import logging
+import os
+import sqlite3
+import threading
+import chess
+import chess.engine
+import chess.polyglot
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+CacheKey = tuple[int, str]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS evaluations (
+    hash INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    profile TEXT NOT NULL,
+    cp INTEGER,
+    mate INTEGER,
+    pv TEXT NOT NULL,
+    PRIMARY KEY (hash, depth, profile)
+) WITHOUT ROWID
+'''
+
+
+@dataclasses.dataclass
+class CachedEvaluation:
+    score: chess.engine.PovScore
+    pv: list[chess.Move] = dataclasses.field(default_factory=list)
+    depth: int = 0
+
+
+@dataclasses.dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def score_to_row(score: chess.engine.PovScore) -> tuple[int | None, int | None]:
+    """Returns (cp, mate) from the point of view of the side to move."""
+    relative = score.relative
+    return relative.score(), relative.mate()
+
+
+def score_from_row(cp: int | None, mate: int | None,
+                   turn: chess.Color) -> chess.engine.PovScore:
+    if mate is not None:
+        # Side to move can only be mated, it cannot have given mate
+        return chess.engine.PovScore(chess.engine.Mate(mate), turn)
+    return chess.engine.PovScore(chess.engine.Cp(cp), turn)
+
+
+def _signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class EvaluationCache:
+    """
+    Two-tier cache of engine evaluations.
+
+    Attributes:
+        path (str | None): Path to the SQLite database, None disables the
+                           disk tier.
+        capacity (int): Maximal number of evaluations kept in memory.
+        memory (collections.OrderedDict): The in-memory LRU tier.
+        lock (threading.Lock): The lock guarding the memory tier and stats.
+    """
+
+    def __init__(self, path: str | None, capacity: int = 100000):
+        self.path = path
+        self.capacity = capacity
+        self.memory: collections.OrderedDict[
+            CacheKey, CachedEvaluation] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._stats = CacheStats()
+        self._local = threading.local()
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection().execute(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=5.0,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def key(board: chess.Board, profile: str) -> CacheKey:
+        return chess.polyglot.zobrist_hash(board), profile
+
+    def _remember(self, key: CacheKey, evaluation: CachedEvaluation):
+        with self.lock:
+            known = self.memory.get(key)
+            if known is None or known.depth <= evaluation.depth:
+                self.memory[key] = evaluation
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.capacity:
+                self.memory.popitem(last=False)
+                self._stats.evictions += 1
+
+    def _read_disk(self, key: CacheKey, depth: int,
+                   turn: chess.Color) -> CachedEvaluation | None:
+        if self.path is None:
+            return None
+        try:
+            row = self._connection().execute(
+                'SELECT cp, mate, pv, depth FROM evaluations '
+                'WHERE hash = ? AND profile = ? AND depth >= ? '
+                'ORDER BY depth DESC LIMIT 1',
+                (_signed(key[0]), key[1], depth)).fetchone()
+        except sqlite3.Error:
+            logger.exception('Cannot read evaluation cache %s', self.path)
+            return None
+        if row is None:
+            return None
+        cp, mate, pv, depth = row
+        return CachedEvaluation(score_from_row(cp, mate, turn),
+                                [chess.Move.from_uci(m) for m in pv.split()],
+                                depth)
+
+    def _write_disk(self, key: CacheKey, evaluation: CachedEvaluation):
+        if self.path is None:
+            return
+        cp, mate = score_to_row(evaluation.score)
+        pv = ' '.join(move.uci() for move in evaluation.pv)
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?)',
+                (_signed(key[0]), evaluation.depth, key[1], cp, mate, pv))
+        except sqlite3.Error:
+            logger.exception('Cannot write evaluation cache %s', self.path)
+
+    def get(self, board: chess.Board, depth: int,
+            profile: str) -> CachedEvaluation | None:
+        """Returns the deepest evaluation searched to at least `depth`."""
+        key = self.key(board, profile)
+        with self.lock:
+            evaluation = self.memory.get(key)
+            if evaluation is not None and evaluation.depth >= depth:
+                self.memory.move_to_end(key)
+                self._stats.memory_hits += 1
+                return evaluation
+        evaluation = self._read_disk(key, depth, board.turn)
+        if evaluation is None:
+            with self.lock:
+                self._stats.misses += 1
+            return None
+        with self.lock:
+            self._stats.disk_hits += 1
+        self._remember(key, evaluation)
+        return evaluation
+
+    def put(self, board: chess.Board, profile: str,
+            evaluation: CachedEvaluation):
+        key = self.key(board, profile)
+        self._remember(key, evaluation)
+        self._write_disk(key, evaluation)
+
+    def stats(self) -> CacheStats:
+        with self.lock:
+            return dataclasses.replace(self._stats)
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,59 @@
+"""
+This module contains an asyncio event loop running in a background thread.
+
+Asyncio engines and book readers are bound to the loop that spawned them,
+while Flask runs every async view in a short-lived loop of its own. The
+long-lived subprocesses therefore live on one shared loop and views submit
+work to it.
+
+The module defines the following classes:
+- EventLoopThread: Event loop running forever in a daemon thread.
+
+Example usage:
+event_loop = EventLoopThread()
+result = event_loop.run_sync(some_coroutine())  # from a plain thread
+result = await event_loop.run(some_coroutine())  # from any other loop
+"""
+import asyncio
+import concurrent.futures as cf
+import threading
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar('T')
+
+
+class EventLoopThread:
+    """
+    Event loop running forever in a daemon thread.
+
+    Attributes:
+        loop (asyncio.AbstractEventLoop): The event loop.
+        thread (threading.Thread): The thread running the loop.
+    """
+
+    def __init__(self, name: str = 'EventLoopThread'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_forever,
+                                       name=name,
+                                       daemon=True)
+        self.thread.start()
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> cf.Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def run_sync(self,
+                 coro: Coroutine[Any, Any, T],
+                 timeout: float | None = None) -> T:
+        return self.submit(coro).result(timeout)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
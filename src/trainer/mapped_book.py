@@ -0,0 +1,337 @@
+"""
+This module contains an in-process reader of the opening books.
+
+Books come in two formats (see book_reader.cc): v1 is a sorted array of
+16 byte entries, v3 has a header, a position table with the total and the
+offset of the moves of every position and a move table with the moves of
+every position sorted by popularity. Instead of asking a book_reader
+subprocess, the book is mapped into memory as a NumPy structured array and
+the entries (v1) or the position (v3) are found with a binary search on the
+hash column. The mapped pages live in the OS page cache, so every process of
+the application shares them.
+
+The hash of a position is the hash of chess-library's `board.hash()`: the
+polyglot Zobrist keys, except that the en passant square is hashed whenever
+the FEN has one, not only when the capture is possible. check_mapped_book.py
+checks that both readers agree.
+
+The module defines the following classes:
+- MappedBook: One book mapped into memory.
+- MappedBookReader: Mapped books of all openings behind the book reader
+                    interface.
+- MappedBookCursor: Cursor of a game on a mapped book.
+
+Example usage:
+book_reader = MappedBookReader()
+result = await book_reader.from_fen('tree.bin', chess.STARTING_FEN)
+results = await book_reader.from_fens([('tree.bin', fen) for fen in fens])
+await book_reader.preload('tree.bin')
+result = await book_reader.cursor('tree.bin').edges(board)
+
+write_book_v3('tree_v3.bin', read_entries('tree.bin'))
+"""
+import asyncio
+import logging
+import os
+import struct
+import threading
+import chess
+import chess.polyglot
+import numpy as np
+from .book_reader_protocol import Edge, EdgeResult
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+BOOK_ENTRY = np.dtype([
+    ('hash', '<u8'),
+    ('src', 'u1'),
+    ('dst', 'u1'),
+    ('promotion', 'u1'),
+    ('promotion_piece', 'u1'),
+    ('count', '<u4'),
+])
+
+MAGIC = b'CTBK'
+VERSION = 3
+HEADER = struct.Struct('<4sB3xQQ')
+# The moves of a position end at the offset of the next one
+POSITION_ENTRY = np.dtype([
+    ('hash', '<u8'),
+    ('offset', '<u4'),
+    ('total', '<u4'),
+])
+
+_HASHER = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+_EP_KEYS = chess.polyglot.POLYGLOT_RANDOM_ARRAY[772:780]
+
+
+def book_hash(board: chess.Board) -> int:
+    """Hash of the board as computed by chess-library's `board.hash()`."""
+    pos_hash = (_HASHER.hash_board(board) ^ _HASHER.hash_castling(board) ^
+                _HASHER.hash_turn(board))
+    if board.ep_square is not None:
+        pos_hash ^= _EP_KEYS[chess.square_file(board.ep_square)]
+    return pos_hash
+
+
+def move_hash(board: chess.Board) -> int:
+    """
+    Hash of the board reached by moves, as chess-library's `makeMove` (and
+    so make_book) computes it: the en passant square only counts when an
+    enemy pawn attacks it.
+    """
+    pos_hash = book_hash(board)
+    if board.ep_square is not None and not board.has_pseudo_legal_en_passant():
+        pos_hash ^= _EP_KEYS[chess.square_file(board.ep_square)]
+    return pos_hash
+
+
+def make_move(board: chess.Board, src: int, dst: int,
+              promotion: int | None) -> chess.Move:
+    # The book stores castling as the king capturing its rook
+    if (board.piece_type_at(src) == chess.KING and
+            abs(chess.square_file(src) - chess.square_file(dst)) > 1):
+        dst = chess.square(6 if dst > src else 2, chess.square_rank(src))
+    return chess.Move(src, dst, promotion)
+
+
+def read_entries(path: str) -> np.ndarray:
+    """Entries of a book in either format as v1 entries sorted by hash."""
+    book = MappedBook.open(path)
+    if book.version == 1:
+        return np.array(book.entries)
+    entries = []
+    for index, pos_hash in enumerate(book.entries['hash'].tolist()):
+        for move, count in book.decode_moves(index):
+            entries.append((pos_hash, move.from_square, move.to_square,
+                            move.promotion is not None,
+                            (move.promotion or 1) - 1, count))
+    return np.array(entries, dtype=BOOK_ENTRY)
+
+
+def write_book_v3(path: str, entries: np.ndarray):
+    """Writes v1 entries as a v3 book."""
+    # By hash, then by count descending, then by move like make_book
+    entries = entries[np.lexsort((entries['dst'], entries['src'],
+                                  -entries['count'].astype(np.int64),
+                                  entries['hash']))]
+    hashes, starts = np.unique(entries['hash'], return_index=True)
+    counts = entries['count'].astype(np.uint64)
+    codes = (entries['src'].astype(np.uint16) |
+             entries['dst'].astype(np.uint16) << 6 |
+             np.where(entries['promotion'] != 0,
+                      entries['promotion_piece'].astype(np.uint16) + 1, 0) <<
+             12)
+    varint_bytes = 1 + sum((counts >= 1 << (7 * k)).astype(np.int64)
+                           for k in range(1, 5))
+    ends = np.cumsum(2 + varint_bytes)
+    offsets = ends - (2 + varint_bytes)
+    moves = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    if len(moves) > np.iinfo(np.uint32).max:
+        raise ValueError(f'Move table of {len(moves)} bytes does not fit the '
+                         f'v{VERSION} format')
+    moves[offsets] = codes & 0xff
+    moves[offsets + 1] = codes >> 8
+    for k in range(5):
+        has_byte = varint_bytes > k
+        byte = (counts >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(varint_bytes > k + 1, np.uint64(0x80), np.uint64(0))
+        moves[(offsets + 2 + k)[has_byte]] = byte[has_byte]
+
+    positions = np.zeros(len(hashes), dtype=POSITION_ENTRY)
+    positions['hash'] = hashes
+    positions['offset'] = offsets[starts] if len(starts) else []
+    positions['total'] = (np.add.reduceat(entries['count'].astype(np.uint64),
+                                          starts) if len(starts) else [])
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(positions), len(moves)))
+        f.write(positions.tobytes())
+        f.write(moves.tobytes())
+
+
+class MappedBook:
+    """
+    One book mapped into memory.
+
+    Attributes:
+        path (str): Path to the book.
+        version (int): Format of the book.
+        entries (numpy.ndarray): Entries (v1) or positions (v3) of the book
+                                 sorted by hash.
+        moves (numpy.ndarray | None): Move table of a v3 book.
+    """
+
+    def __init__(self,
+                 path: str,
+                 entries: np.ndarray,
+                 version: int = 1,
+                 moves: np.ndarray | None = None):
+        self.path = path
+        self.version = version
+        self.entries = entries
+        self.moves = moves
+
+    @classmethod
+    def open(cls, path: str) -> 'MappedBook':
+        # Missing books have no moves, like in book_reader
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            logger.warning('Cannot map book %s', path)
+            return cls(path, np.empty(0, dtype=BOOK_ENTRY))
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(data) < HEADER.size or bytes(data[:len(MAGIC)]) != MAGIC:
+            usable = len(data) - len(data) % BOOK_ENTRY.itemsize
+            return cls(path, data[:usable].view(BOOK_ENTRY))
+        _, version, positions, move_bytes = HEADER.unpack_from(data)
+        moves_start = HEADER.size + positions * POSITION_ENTRY.itemsize
+        if version != VERSION or len(data) < moves_start + move_bytes:
+            logger.warning('Malformed book %s', path)
+            return cls(path, np.empty(0, dtype=BOOK_ENTRY))
+        return cls(path, data[HEADER.size:moves_start].view(POSITION_ENTRY),
+                   VERSION, data[moves_start:moves_start + move_bytes])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def touch(self):
+        """Reads every page of the book into the page cache."""
+        for table in (self.entries, self.moves):
+            if table is not None and len(table):
+                table.view(np.uint8).max()
+
+    def decode_moves(self, index: int) -> list[tuple[chess.Move, int]]:
+        """
+        Moves of the v3 position at the index as stored, castling is not
+        normalised.
+        """
+        offsets = self.entries['offset']
+        end = (int(offsets[index + 1])
+               if index + 1 < len(offsets) else len(self.moves))
+        data = bytes(self.moves[int(offsets[index]):end])
+        moves = []
+        pos = 0
+        while pos + 2 <= len(data):
+            code = data[pos] | data[pos + 1] << 8
+            pos += 2
+            count = shift = 0
+            while True:
+                if pos == len(data):
+                    break
+                byte = data[pos]
+                pos += 1
+                count |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            promotion = code >> 12
+            moves.append((chess.Move(code & 63, code >> 6 & 63, promotion or
+                                     None), count))
+        return moves
+
+    def find(self,
+             board: chess.Board,
+             pos_hash: int | None = None) -> EdgeResult:
+        """Moves of the position sorted by the number of appearances."""
+        if pos_hash is None:
+            pos_hash = book_hash(board)
+        pos_hash = np.uint64(pos_hash)
+        hashes = self.entries['hash']
+        begin = np.searchsorted(hashes, pos_hash, 'left')
+        if self.version == VERSION:
+            if begin == len(hashes) or hashes[begin] != pos_hash:
+                return EdgeResult(board)
+            edges = [
+                Edge(make_move(board, move.from_square, move.to_square,
+                               move.promotion), count)
+                for move, count in self.decode_moves(begin)
+            ]
+            return EdgeResult(board, edges, int(self.entries['total'][begin]))
+        end = np.searchsorted(hashes, pos_hash, 'right')
+        entries = self.entries[begin:end]
+        entries = entries[np.argsort(-entries['count'].astype(np.int64),
+                                     kind='stable')]
+        edges = []
+        for _, src, dst, promotion, piece, count in entries.tolist():
+            # chess-library numbers the piece types from 0
+            edges.append(
+                Edge(make_move(board, src, dst,
+                               piece + 1 if promotion else None), count))
+        return EdgeResult(board, edges, sum(edge.count for edge in edges))
+
+
+class MappedBookReader:
+    """
+    Mapped books of all openings, mapped on first use.
+
+    Offers the same `from_fen`, `from_fens`, `preload`, `cursor`, `exit`
+    and `quit` as BookReaderPool, so it can be used in place of the book_reader
+    processes. Lookups run in the calling thread.
+
+    Attributes:
+        books (dict[str, MappedBook]): Mapped books by path.
+        lock (threading.Lock): The lock guarding `books`.
+    """
+
+    def __init__(self):
+        self.books: dict[str, MappedBook] = {}
+        self.lock = threading.Lock()
+
+    def book(self, path: str) -> MappedBook:
+        with self.lock:
+            if path not in self.books:
+                self.books[path] = MappedBook.open(path)
+                logger.info('Mapped %d book entries of %s',
+                            len(self.books[path]), path)
+            return self.books[path]
+
+    def lookup(self, filename: str, fen: str) -> EdgeResult:
+        return self.book(filename).find(chess.Board(fen))
+
+    async def from_fen(self, filename: str, fen: str) -> EdgeResult:
+        return self.lookup(filename, fen)
+
+    async def from_fens(
+            self, positions: list[tuple[str, str]]) -> list[EdgeResult]:
+        return [self.lookup(filename, fen) for filename, fen in positions]
+
+    def cursor(self, filename: str) -> 'MappedBookCursor':
+        return MappedBookCursor(self, filename)
+
+    async def preload(self, filename: str):
+        """Maps the book and reads it, in a thread of its own."""
+        await asyncio.to_thread(lambda: self.book(filename).touch())
+
+    async def exit(self) -> int:
+        return await self.quit()
+
+    async def quit(self) -> int:
+        with self.lock:
+            self.books.clear()
+        return 0
+
+
+class MappedBookCursor:
+    """
+    Cursor of a game on a mapped book.
+
+    Offers the same `edges` and `close` as the cursors of BookReaderPool.
+    The book is searched by the hash of the board directly, so there is no
+    FEN to render or parse and no state to keep. The hash is the one of
+    book_reader's cursors, see `move_hash`.
+
+    Attributes:
+        reader (MappedBookReader): The reader of the book.
+        filename (str): The book.
+    """
+
+    def __init__(self, reader: MappedBookReader, filename: str):
+        self.reader = reader
+        self.filename = filename
+
+    async def edges(self, board: chess.Board) -> EdgeResult:
+        return self.reader.book(self.filename).find(board, move_hash(board))
+
+    def close(self):
+        pass
@@ -0,0 +1,131 @@
+"""
+This module contains a background prefetcher of speculative analyses.
+
+While the player thinks the engines are idle, but the positions the player
+is likely to reach next are known from the book. The prefetcher runs jobs
+analysing them so that the results are already cached when the player
+moves.
+
+Jobs are grouped by a key (the session). Scheduling new jobs for a key or
+cancelling the key drops its queued jobs. Jobs that already started are
+left to finish, they are bounded by the analysis budget and cancelling an
+engine in the middle of a search would cost a new engine process.
+
+The module defines the following classes:
+- PrefetchStats: Data class representing counters of the prefetcher.
+- Prefetcher: Bounded queue of background jobs run on an event loop.
+
+Example usage:
+prefetcher = Prefetcher(event_loop.loop, maxsize=64, workers=2)
+prefetcher.schedule(session.sid, [functools.partial(evaluate, board)])
+prefetcher.cancel(session.sid)
+"""
+import asyncio
+import dataclasses
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+logging.basicConfig(format='%(asctime)s:%(threadName)s:%(message)s',
+                    level=logging.INFO,
+                    datefmt="%H:%M:%S")
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Any]]
+
+
+@dataclasses.dataclass
+class PrefetchStats:
+    scheduled: int = 0
+    completed: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    dropped: int = 0
+
+
+class Prefetcher:
+    """
+    Bounded queue of background jobs run on an event loop.
+
+    All methods are thread-safe, the state is only touched on the loop.
+
+    Attributes:
+        loop (asyncio.AbstractEventLoop): Event loop running the jobs.
+        maxsize (int): Maximal number of queued jobs, further jobs are dropped.
+        workers (int): Number of jobs run concurrently.
+        queue (asyncio.Queue): Queued (key, generation, job) triples.
+        generations (dict): Generation of the queued jobs of every key, jobs
+                            of other generations are skipped.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 maxsize: int = 64,
+                 workers: int = 1):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.workers = workers
+        self.queue: asyncio.Queue[tuple[Hashable, int, Job]] | None = None
+        self.generations: dict[Hashable, int] = {}
+        self._generation = 0
+        self._pending: dict[int, int] = {}
+        self._stats = PrefetchStats()
+        self._tasks: list[asyncio.Task] = []
+        self.loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self._tasks = [
+            self.loop.create_task(self._work()) for _ in range(self.workers)
+        ]
+
+    def _cancel(self, key: Hashable):
+        # Queued jobs of the key become stale
+        self.generations.pop(key, None)
+
+    def _schedule(self, key: Hashable, jobs: list[Job]):
+        self._generation += 1
+        generation = self.generations[key] = self._generation
+        for job in jobs:
+            try:
+                self.queue.put_nowait((key, generation, job))
+            except asyncio.QueueFull:
+                self._stats.dropped += 1
+                continue
+            self._stats.scheduled += 1
+            self._pending[generation] = self._pending.get(generation, 0) + 1
+
+    async def _work(self):
+        while True:
+            key, generation, job = await self.queue.get()
+            try:
+                if self.generations.get(key) != generation:
+                    self._stats.cancelled += 1
+                    continue
+                await job()
+                self._stats.completed += 1
+            except Exception:
+                logger.exception('Prefetch job of %s failed', key)
+                self._stats.failed += 1
+            finally:
+                self._pending[generation] -= 1
+                if not self._pending[generation]:
+                    # Forget keys of finished sessions
+                    del self._pending[generation]
+                    if self.generations.get(key) == generation:
+                        del self.generations[key]
+                self.queue.task_done()
+
+    def schedule(self, key: Hashable, jobs: list[Job]):
+        """Replaces the queued jobs of the key with new jobs."""
+        self.loop.call_soon_threadsafe(self._schedule, key, jobs)
+
+    def cancel(self, key: Hashable):
+        """Drops the queued jobs of the key."""
+        self.loop.call_soon_threadsafe(self._cancel, key)
+
+    def stats(self) -> PrefetchStats:
+        return dataclasses.replace(self._stats)
+
+    def close(self):
+        for task in self._tasks:
+            self.loop.call_soon_threadsafe(task.cancel)
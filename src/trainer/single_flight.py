@@ -0,0 +1,72 @@
+"""
+This module contains single-flight deduplication of concurrent calls.
+
+Many players train the same opening, so identical positions are often
+analysed at the same time. Concurrent calls with the same key share one
+in-flight call and its result instead of starting their own.
+
+The module defines the following classes:
+- SingleFlightStats: Data class representing counters of the calls.
+- SingleFlight: Deduplication of concurrent calls running on an event loop.
+
+Example usage:
+flights = SingleFlight(event_loop.loop)
+lines = await flights.run((pos_hash, budget), engine_pool.run, profile,
+                          analyse_with_budget, board, budget)
+print(flights.stats().saved)
+"""
+import asyncio
+import dataclasses
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclasses.dataclass
+class SingleFlightStats:
+    started: int = 0
+    saved: int = 0
+
+
+class SingleFlight:
+    """
+    Deduplication of concurrent calls running on an event loop.
+
+    A call that is cancelled by one of its waiters keeps running for the
+    others.
+
+    Attributes:
+        loop (asyncio.AbstractEventLoop): Event loop running the calls.
+        in_flight (dict[Hashable, asyncio.Task]): Running calls by key.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.in_flight: dict[Hashable, asyncio.Task] = {}
+        self._stats = SingleFlightStats()
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+
+    async def _run(self, key: Hashable, func: Callable[..., Awaitable[T]],
+                   args: tuple) -> T:
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.loop.create_task(func(*args))
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.in_flight[key] = task
+            self._stats.started += 1
+        else:
+            self._stats.saved += 1
+        return await asyncio.shield(task)
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable[T]],
+                  *args: Any) -> T:
+        """Awaits `func(*args)` or the running call with the same key."""
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._run(key, func, args),
+                                             self.loop))
+
+    def stats(self) -> SingleFlightStats:
+        return dataclasses.replace(self._stats)
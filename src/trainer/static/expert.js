@@ -108,7 +108,14 @@ function updateSite(data) {
   board.position(game.fen(), false);
   updatePlayerCardBorder(game);
   $('#pgn').html(data.pgn);
-  updateEvalBar(data.score);
+  // The move is answered before it is evaluated, the score then comes
+  // from the analysis stream
+  if (data.score !== null) {
+    updateEvalBar(data.score);
+  }
+  if (data.active_bar) {
+    streamEvalBar(data.fen);
+  }
   if (data.active_bar) {
     $('#eval-bar-top').attr('display', 'block');
     $('#eval-bar-bot').attr('display', 'block');
@@ -10,6 +10,7 @@ $('#eval-bar-on').on('click', async function () {
 });
 $('#eval-bar-off').on('click', async function () {
   $.get('/play/eval_bar_off');
+  closeEvalStream();
   $('#eval-bar-top').attr('display', 'none');
   $('#eval-bar-bot').attr('display', 'none');
 });
@@ -160,6 +161,27 @@ async function updateEvalBar(score) {
   $('#eval-bar-top').attr('height', (100 - score) + '%');
 }
 
+var evalStream = null;
+
+function closeEvalStream() {
+  if (evalStream) {
+    evalStream.close();
+    evalStream = null;
+  }
+}
+
+// Updates the eval bar with deeper scores as the server finds them
+function streamEvalBar(fen) {
+  closeEvalStream();
+  evalStream = new EventSource('analysis_stream?fen=' + encodeURIComponent(fen));
+  evalStream.onmessage = function (event) {
+    updateEvalBar(JSON.parse(event.data).score);
+  };
+  // The browser would reconnect and restart the search otherwise
+  evalStream.addEventListener('done', closeEvalStream);
+  evalStream.onerror = closeEvalStream;
+}
+
 
 /* **************************************
 * Player cards utilities
@@ -8,12 +8,18 @@ import logging
 import datetime
 from .index import OPENINGS
 from .play_utilities import PositionAssessment
-from .play_utilities import assess_position, find_best_move, get_absolute_score
+from .play_utilities import ANALYSIS_BUDGETS, assess_position, find_best_move, get_absolute_score
+from .play_utilities import assess_position_from_book
+from .play_utilities import analysis_stream_response
+from .play_utilities import cancel_prefetch, prefetch_replies
+from .play_utilities import parse_legal_move
 from typing import Any
 import dataclasses
 
 mod = Blueprint('expert', __name__)
 
+ANALYSIS_BUDGET = ANALYSIS_BUDGETS['expert']
+
 logging.basicConfig(
     format='%(asctime)s:%(threadName)s: %(filename)s:%(lineno)d %(message)s',
     level=logging.INFO,
@@ -99,14 +105,17 @@ def save_game_state(game_state: GameState):
     session['game'] = str(game_state)
 
 
-def first_phase(move_uci: str):
-    move = chess.Move.from_uci(move_uci)
+async def first_phase(move_uci: str):
+    cancel_prefetch(session.sid)
     game_state = restore_game_state()
+    move = parse_legal_move(game_state.board, move_uci)
     game_state.make_move(move)
     save_game_state(game_state)
     if game_state.board.is_game_over():
         game_state.game.headers['Result'] = game_state.board.result()
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position_from_book(game_state.board,
+                                               session['current_book_path'],
+                                               ANALYSIS_BUDGET, session.sid)
 
     data = {
         'player_color':
@@ -118,6 +127,7 @@ def first_phase(move_uci: str):
         'moves': [move.uci() for move in game_state.board.move_stack],
         'score':
             get_absolute_score(game_state.board, pos_info, session['color']),
+        'depth': pos_info.depth,
         'active_bar':
             session['active_bar'],
         'result':
@@ -138,6 +148,7 @@ def get_render_data_second_phase(
         'pgn': str(game_state.game.mainline_moves()),
         'moves': moves,
         'score': score,
+        'depth': pos_info.depth,
         'active_bar': session['active_bar'],
         'result': game_state.game.headers['Result'],
         'lock_board': False,
@@ -145,61 +156,74 @@ def get_render_data_second_phase(
     }
 
 
-def second_phase():
+async def second_phase():
     game_state = restore_game_state()
     move = None
     if game_state.board.is_game_over():
         game_state.game.headers['Result'] = game_state.board.result()
     elif not session.get('lock_board', False):
-        move = find_best_move(game_state.board,
-                              session['bot_lvl'],
-                              session['current_book_path'],
-                              can_sideline=True)
+        move = await find_best_move(game_state.board,
+                                    session['bot_lvl'],
+                                    session['current_book_path'],
+                                    can_sideline=True)
     if move:
         game_state.make_move(move)
     save_game_state(game_state)
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position(game_state.board,
+                                     session['current_book_path'],
+                                     ANALYSIS_BUDGET, session.sid)
+    # The player's likely replies are analysed while the player thinks
+    prefetch_replies(session.sid, game_state.board, pos_info,
+                     session['current_book_path'], ANALYSIS_BUDGET)
     return {
         'bot_move': move.uci() if move else None
     } | get_render_data_second_phase(game_state, pos_info)
 
 
 @mod.route('/make_move', methods=['POST'])
-def make_move():
+async def make_move():
     move_uci = request.form.get('move_uci')
     phase = request.form.get('phase')
     if phase == 'first':
-        data = first_phase(move_uci)
+        data = await first_phase(move_uci)
     else:
-        data = second_phase()
+        data = await second_phase()
     session['lock_board'] = data.get('lock_board', False)
     return {'data': data}
 
 
-def get_render_data(game_state: GameState,
-                    pos_info: PositionAssessment) -> dict[str, Any]:
+async def get_render_data(game_state: GameState,
+                          pos_info: PositionAssessment) -> dict[str, Any]:
     if (game_state.board.turn == chess.WHITE and session['color']
             == 'white') or (game_state.board.turn == chess.BLACK and
                             session['color'] == 'black'):
         return get_render_data_second_phase(game_state, pos_info)
-    return second_phase()
+    return await second_phase()
 
 
 @mod.route('/prev_move', methods=['POST'])
-def prev_move():
+async def prev_move():
     game_state = restore_game_state()
     session['lock_board'] = False
     if game_state.prev():
         save_game_state(game_state)
-        pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
-        return {'data': get_render_data(game_state, pos_info)}
+        pos_info = await assess_position(game_state.board,
+                                         session['current_book_path'],
+                                         ANALYSIS_BUDGET, session.sid)
+        return {'data': await get_render_data(game_state, pos_info)}
     save_game_state(game_state)
     return {'data': None}
 
 
+@mod.route('/analysis_stream')
+def analysis_stream():
+    return analysis_stream_response(restore_game_state().board,
+                                    ANALYSIS_BUDGET)
+
+
 @mod.route('/new_game')
 def expert_new_game():
+    cancel_prefetch(session.sid)
     game_state = GameState.initialize(session['color'], session['nickname'],
                                       session['current_book'])
     session['active_bar'] = True
@@ -217,9 +241,11 @@ def set_bot_lvl():
 
 
 @mod.route('/')
-def expert():
+async def expert():
     game_state = restore_game_state()
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position(game_state.board,
+                                     session['current_book_path'],
+                                     ANALYSIS_BUDGET, session.sid)
     logger.debug('Rendering')
     print(session['color'])
     print(game_state.board.fen())
@@ -227,4 +253,4 @@ def expert():
     print(pos_info.sidelines)
     print(pos_info.score.relative.wdl().expectation())
     return render_template('expert.html',
-                           **get_render_data(game_state, pos_info))
+                           **await get_render_data(game_state, pos_info))
@@ -8,13 +8,17 @@ import logging
 import datetime
 from .index import OPENINGS
 from .play_utilities import PositionAssessment, MoveAssessment, LineType, MoveType
-from .play_utilities import assess_move, assess_position, get_absolute_score
+from .play_utilities import ANALYSIS_BUDGETS, assess_position_and_moves, assess_position, get_absolute_score
+from .play_utilities import assess_reached_position, analysis_stream_response
+from .play_utilities import parse_legal_move
 from typing import Any
 import dataclasses
 import json
 
 mod = Blueprint('explore', __name__)
 
+ANALYSIS_BUDGET = ANALYSIS_BUDGETS['explore']
+
 logging.basicConfig(
     format='%(asctime)s:%(threadName)s: %(filename)s:%(lineno)d %(message)s',
     level=logging.INFO,
@@ -142,6 +146,7 @@ def get_render_data(game_state: GameState,
         'mainline': mainline,
         'sidelines': sidelines,
         'score': score,
+        'depth': pos_info.depth,
         'active_bar': session['active_bar'],
         'refutation': '',
         'move_message': '',
@@ -163,16 +168,18 @@ def save_game_state(game_state: GameState):
 
 
 @mod.route('/make_move', methods=['POST'])
-def make_move():
-    move_uci = request.form.get('move_uci')
-    move = chess.Move.from_uci(move_uci)
+async def make_move():
     game_state = restore_game_state()
-    old_pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
-    move_info = assess_move(game_state.board, move, old_pos_info)
+    move = parse_legal_move(game_state.board, request.form.get('move_uci'))
+    old_pos_info, (move_info,) = await assess_position_and_moves(
+        game_state.board, session['current_book_path'], [move],
+        ANALYSIS_BUDGET, session.sid)
     game_state.make_move(move)
     save_game_state(game_state)
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_reached_position(game_state.board,
+                                             session['current_book_path'],
+                                             move_info, ANALYSIS_BUDGET,
+                                             session.sid)
     data = {'data': get_render_data(game_state, pos_info)}
     if move_info.move_type == MoveType.OK:
         if move_info.line_type == LineType.MAIN:
@@ -223,30 +230,38 @@ def make_move():
 
 
 @mod.route('/next_move', methods=['POST'])
-def next_move():
+async def next_move():
     game_state = restore_game_state()
     if game_state.next():
         save_game_state(game_state)
 
-        pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
+        pos_info = await assess_position(game_state.board,
+                                         session['current_book_path'],
+                                         ANALYSIS_BUDGET, session.sid)
         return {'data': get_render_data(game_state, pos_info)}
     save_game_state(game_state)
     return {'data': None}
 
 
 @mod.route('/prev_move', methods=['POST'])
-def prev_move():
+async def prev_move():
     game_state = restore_game_state()
     if game_state.prev():
         save_game_state(game_state)
-        pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
+        pos_info = await assess_position(game_state.board,
+                                         session['current_book_path'],
+                                         ANALYSIS_BUDGET, session.sid)
         return {'data': get_render_data(game_state, pos_info)}
     save_game_state(game_state)
     return {'data': None}
 
 
+@mod.route('/analysis_stream')
+def analysis_stream():
+    return analysis_stream_response(restore_game_state().board,
+                                    ANALYSIS_BUDGET)
+
+
 @mod.route('/new_game')
 def explore_new_game():
     print("Endpoint explore")
@@ -259,9 +274,11 @@ def explore_new_game():
 
 
 @mod.route('/')
-def explore():
+async def explore():
     game_state = restore_game_state()
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position(game_state.board,
+                                     session['current_book_path'],
+                                     ANALYSIS_BUDGET, session.sid)
     logger.debug('Rendering')
     print(session['color'])
     print(game_state.board.fen())
@@ -0,0 +1,28 @@
+from flask import Blueprint
+import logging
+from .shared_jobs import book_warm_up
+
+mod = Blueprint('health', __name__)
+
+logging.basicConfig(
+    format='%(asctime)s:%(threadName)s: %(filename)s:%(lineno)d %(message)s',
+    level=logging.INFO,
+    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+# Health checks live outside of the index blueprint, so they do not create
+# sessions
+
+
+@mod.route('/health')
+def health():
+    # The process is up, whether or not the books are warm
+    return {'status': 'ok'}
+
+
+@mod.route('/ready')
+def ready():
+    # Load balancers only send traffic once the books are preloaded, a book
+    # that failed to load keeps the worker out of rotation
+    status = book_warm_up.status()
+    return status, 200 if status['ready'] else 503
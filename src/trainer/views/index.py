@@ -20,6 +20,7 @@ logger = logging.getLogger(__name__)
 class Opening:
     book: str
     name: str
+    eco: str = ''
     games: int = 0
     moves: int = 0
     img: str | None = None
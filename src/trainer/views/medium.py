@@ -8,13 +8,18 @@ import logging
 import datetime
 from .index import OPENINGS
 from .play_utilities import PositionAssessment, MoveAssessment, LineType, MoveType
-from .play_utilities import assess_move, assess_position, find_best_move, get_absolute_score
+from .play_utilities import ANALYSIS_BUDGETS, assess_position_and_moves, assess_position, find_best_move, get_absolute_score
+from .play_utilities import assess_reached_position, analysis_stream_response
+from .play_utilities import cancel_prefetch, prefetch_replies
+from .play_utilities import parse_legal_move
 from typing import Any
 import dataclasses
 import json
 
 mod = Blueprint('medium', __name__)
 
+ANALYSIS_BUDGET = ANALYSIS_BUDGETS['medium']
+
 logging.basicConfig(
     format='%(asctime)s:%(threadName)s: %(filename)s:%(lineno)d %(message)s',
     level=logging.INFO,
@@ -149,17 +154,21 @@ def get_move_render_data(game_state: GameState,
     }
 
 
-def first_phase(move_uci: str):
-    move = chess.Move.from_uci(move_uci)
+async def first_phase(move_uci: str):
+    cancel_prefetch(session.sid)
     game_state = restore_game_state()
-    old_pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
-    move_info = assess_move(game_state.board, move, old_pos_info)
+    move = parse_legal_move(game_state.board, move_uci)
+    old_pos_info, (move_info,) = await assess_position_and_moves(
+        game_state.board, session['current_book_path'], [move],
+        ANALYSIS_BUDGET, session.sid)
     game_state.make_move(move)
     save_game_state(game_state)
     if game_state.board.is_game_over():
         game_state.game.headers['Result'] = game_state.board.result()
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_reached_position(game_state.board,
+                                             session['current_book_path'],
+                                             move_info, ANALYSIS_BUDGET,
+                                             session.sid)
 
     data = {
         'player_color':
@@ -171,6 +180,7 @@ def first_phase(move_uci: str):
         'moves': [move.uci() for move in game_state.board.move_stack],
         'score':
             get_absolute_score(game_state.board, pos_info, session['color']),
+        'depth': pos_info.depth,
         'active_bar':
             session['active_bar'],
         'result':
@@ -189,6 +199,7 @@ def get_render_data_second_phase(
         'pgn': str(game_state.game.mainline_moves()),
         'moves': moves,
         'score': score,
+        'depth': pos_info.depth,
         'active_bar': session['active_bar'],
         'refutation': '',
         'icon': None,
@@ -197,59 +208,72 @@ def get_render_data_second_phase(
     }
 
 
-def second_phase():
+async def second_phase():
     game_state = restore_game_state()
     move = None
     if game_state.board.is_game_over():
         game_state.game.headers['Result'] = game_state.board.result()
     elif not session.get('lock_board', False):
-        move = find_best_move(game_state.board, 1400, session['current_book_path'])
+        move = await find_best_move(game_state.board, 1400,
+                                        session['current_book_path'])
     if move:
         game_state.make_move(move)
     save_game_state(game_state)
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position(game_state.board,
+                                     session['current_book_path'],
+                                     ANALYSIS_BUDGET, session.sid)
+    # The player's likely replies are analysed while the player thinks
+    prefetch_replies(session.sid, game_state.board, pos_info,
+                     session['current_book_path'], ANALYSIS_BUDGET)
     return {
         'bot_move': move.uci() if move else None
     } | get_render_data_second_phase(game_state, pos_info)
 
 
 @mod.route('/make_move', methods=['POST'])
-def make_move():
+async def make_move():
     move_uci = request.form.get('move_uci')
     phase = request.form.get('phase')
-    move = chess.Move.from_uci(move_uci)
     if phase == 'first':
-        data = first_phase(move_uci)
+        data = await first_phase(move_uci)
     else:
-        data = second_phase()
+        data = await second_phase()
     session['lock_board'] = data.get('lock_board', False)
     return {'data': data}
 
 
-def get_render_data(game_state: GameState,
-                    pos_info: PositionAssessment) -> dict[str, Any]:
+async def get_render_data(game_state: GameState,
+                          pos_info: PositionAssessment) -> dict[str, Any]:
     if (game_state.board.turn == chess.WHITE and session['color']
             == 'white') or (game_state.board.turn == chess.BLACK and
                             session['color'] == 'black'):
         return get_render_data_second_phase(game_state, pos_info)
-    return second_phase()
+    return await second_phase()
 
 
 @mod.route('/prev_move', methods=['POST'])
-def prev_move():
+async def prev_move():
     game_state = restore_game_state()
     session['lock_board'] = False
     if game_state.prev():
         save_game_state(game_state)
-        pos_info = assess_position(game_state.board,
-                                   session['current_book_path'])
-        return {'data': get_render_data(game_state, pos_info)}
+        pos_info = await assess_position(game_state.board,
+                                         session['current_book_path'],
+                                         ANALYSIS_BUDGET, session.sid)
+        return {'data': await get_render_data(game_state, pos_info)}
     save_game_state(game_state)
     return {'data': None}
 
 
+@mod.route('/analysis_stream')
+def analysis_stream():
+    return analysis_stream_response(restore_game_state().board,
+                                    ANALYSIS_BUDGET)
+
+
 @mod.route('/new_game')
 def medium_new_game():
+    cancel_prefetch(session.sid)
     logger.debug('Endpoint explore')
     game_state = GameState.initialize(session['color'], session['nickname'],
                                       session['current_book'])
@@ -261,9 +285,11 @@ def medium_new_game():
 
 
 @mod.route('/')
-def medium():
+async def medium():
     game_state = restore_game_state()
-    pos_info = assess_position(game_state.board, session['current_book_path'])
+    pos_info = await assess_position(game_state.board,
+                                     session['current_book_path'],
+                                     ANALYSIS_BUDGET, session.sid)
     logger.debug('Rendering')
     print(session['color'])
     print(game_state.board.fen())
@@ -271,4 +297,4 @@ def medium():
     print(pos_info.sidelines)
     print(pos_info.score.relative.wdl().expectation())
     return render_template('medium.html',
-                           **get_render_data(game_state, pos_info))
+                           **await get_render_data(game_state, pos_info))
@@ -1,8 +1,15 @@
 import os
 import glob
 
-PROJECT_DIR = os.path.join('trainer')
+# Paths do not depend on the working directory, the scripts of src use them
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 BOOK_READER_PATH = os.path.join(PROJECT_DIR, 'static', 'book_reader')
-STOCKFISH_PATH = glob.glob(
-    os.path.join(PROJECT_DIR, 'static', 'stockfish', 'stockfish*'))[0]
+# The engine pool fails to start when there is no Stockfish binary
+STOCKFISH_PATH = next(
+    iter(
+        glob.glob(
+            os.path.join(PROJECT_DIR, 'static', 'stockfish', 'stockfish*'))),
+    os.path.join(PROJECT_DIR, 'static', 'stockfish', 'stockfish'))
 BOOKS_DIR = os.path.join(PROJECT_DIR, 'static', 'books')
+EVALUATION_CACHE_PATH = os.path.join(PROJECT_DIR, 'cache',
+                                     'evaluations.sqlite3')
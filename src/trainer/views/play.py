@@ -6,8 +6,8 @@ import chess.engine
 import chess.pgn
 import io
 import logging
-from .paths import STOCKFISH_PATH
-from .shared_jobs import book_reader
+from .shared_jobs import book_reader, engine_pool
+from ..engine_pool import EngineProfile
 from .index import OPENINGS
 
 mod = Blueprint('play', __name__)
@@ -78,18 +78,18 @@ def set_freedom_degree():
     return {'freedom_degree': deg}
 
 
-def choose_engine_move(board: chess.Board):
-    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-    engine.configure({'Skill Level': session['bot_lvl']})
-    result = engine.play(board, chess.engine.Limit(time=ENGINE_THINKING_TIME))
-    engine.quit()
+async def choose_engine_move(board: chess.Board):
+    profile = EngineProfile(f'skill-{session["bot_lvl"]}',
+                            {'Skill Level': session['bot_lvl']})
+    result = await engine_pool.play(
+        profile, board, chess.engine.Limit(time=ENGINE_THINKING_TIME))
     board.push(result.move)
     return board.fen()
 
 
-def choose_move(board: chess.Board) -> chess.Move:
-    edge_result = book_reader.from_fen(session['current_book_path'],
-                                       board.fen())
+async def choose_move(board: chess.Board) -> chess.Move:
+    edge_result = await book_reader.from_fen(session['current_book_path'],
+                                             board.fen())
     if not edge_result.edges:
         logger.info('No edges found')
         return None
@@ -112,7 +112,7 @@ def game_state_info(board: chess.Board, game: chess.pgn.Game):
 
 # use streams
 @mod.route('/make_move', methods=['POST'])
-def make_move():
+async def make_move():
     """
     Makes a move a and returns current game state.
     The only route that can modify the game state.
@@ -140,7 +140,7 @@ def make_move():
         resp = game_state_info(current_board, current_game)
         resp['ask_again'] = not current_board.is_game_over()
         return resp
-    move = choose_move(current_board)
+    move = await choose_move(current_board)
     if move is not None:
         current_board.push(move)
         current_node = current_node.add_variation(current_board.peek())
@@ -1,18 +1,55 @@
+import asyncio
+import functools
+import json
+import queue
+from typing import Iterator
+from flask import Response, abort, request, session
 import chess
 import chess.pgn
 import chess.engine
-from .paths import STOCKFISH_PATH
-from .shared_jobs import book_reader
+import chess.polyglot
+from .shared_jobs import analysis_flights, book_reader, book_evaluations
+from .shared_jobs import book_cursors
+from .shared_jobs import engine_pool
+from .shared_jobs import evaluation_cache, event_loop, prefetcher
 import enum
 import dataclasses
+from ..analysis_budget import AnalysisBudget, analyse_with_budget
 from ..book_reader_protocol import EdgeResult
+from ..engine_pool import EngineProfile
+from ..evaluation_cache import CachedEvaluation
+import logging
 import random
 
+logging.basicConfig(
+    format='%(asctime)s:%(threadName)s: %(filename)s:%(lineno)d %(message)s',
+    level=logging.INFO,
+    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
 # Might be a good idea to make it opening dependent
 START_HALFMOVES_LENGTH = 0
 SIDELINE_ACCEPT_THRESHOLD = 10
 ENGINE_DEPTH = 15
 ENGINE_MEMORY_LIMIT = 128
+# Lines searched when assessing moves and the best move is not known yet
+MULTIPV_LINES = 3
+# Replies of the player analysed in the background
+PREFETCH_REPLIES = 4
+
+# Full-strength engine used to evaluate positions and moves
+ANALYSIS_PROFILE = EngineProfile('analysis', {'Hash': ENGINE_MEMORY_LIMIT})
+
+# Limits of one search in every training mode. A move is assessed by up to
+# two searches, so the time of a request stays below twice the budget.
+DEFAULT_BUDGET = AnalysisBudget(depth=ENGINE_DEPTH, min_depth=ENGINE_DEPTH)
+ANALYSIS_BUDGETS = {
+    'explore': AnalysisBudget(time=1.0, depth=20, min_depth=14),
+    'beginner': AnalysisBudget(time=0.4, depth=16, min_depth=12),
+    'medium': AnalysisBudget(time=0.4, depth=16, min_depth=12),
+    'advanced': AnalysisBudget(time=0.6, depth=18, min_depth=13),
+    'expert': AnalysisBudget(time=0.6, depth=18, min_depth=13),
+}
 
 MoveType = enum.Enum('MoveScore', ['OK', 'INACCURACY', 'BLUNDER'])
 LineType = enum.Enum('LineType', ['MAIN', 'SIDELINE', 'UNKNOWN'])
@@ -20,24 +57,38 @@ LineType = enum.Enum('LineType', ['MAIN', 'SIDELINE', 'UNKNOWN'])
 
 @dataclasses.dataclass
 class PositionAssessment:
-    score: chess.engine.PovScore
+    # None when the position is not evaluated yet, see `stream_analysis`
+    score: chess.engine.PovScore | None
     mainline: tuple[chess.Move, int] | None = None
     sidelines: list[tuple[chess.Move,
                           int]] = dataclasses.field(default_factory=list)
     pv: list[chess.Move] = dataclasses.field(default_factory=list)
+    depth: int = 0
 
 
 @dataclasses.dataclass
 class MoveAssessment:
     move_type: MoveType
     line_type: LineType
-    score: chess.engine.PovScore
+    # None for a book move that was not searched
+    score: chess.engine.PovScore | None
     pv: list[chess.Move]
+    depth: int = 0
+    # Book moves of the position reached by the move, if looked up already
+    book_result: EdgeResult | None = None
+
+
+def bot_profile(lvl: int) -> EngineProfile:
+    return EngineProfile(f'bot-{lvl}', {
+        'UCI_LimitStrength': True,
+        'UCI_Elo': lvl,
+        'Hash': ENGINE_MEMORY_LIMIT
+    })
 
 
 def get_sidelines(result: EdgeResult) -> list[tuple[chess.Move, int]]:
     sidelines = []
-    total_count = sum(edge.count for edge in result.edges)
+    total_count = result.total
 
     for edge in result.edges[1:]:
         if edge.count * SIDELINE_ACCEPT_THRESHOLD < total_count:
@@ -46,26 +97,222 @@ def get_sidelines(result: EdgeResult) -> list[tuple[chess.Move, int]]:
     return sidelines
 
 
-def assess_position(board: chess.Board, opening: str) -> PositionAssessment:
-    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-    engine.configure({'Hash': ENGINE_MEMORY_LIMIT})
-    info = engine.analyse(board, chess.engine.Limit(depth=ENGINE_DEPTH))
-    engine.quit()
-    print(opening, board.fen())
-    result = book_reader.from_fen(opening, board.fen())
+def lookup_evaluation(
+        board: chess.Board,
+        opening: str,
+        budget: AnalysisBudget = DEFAULT_BUDGET) -> CachedEvaluation | None:
+    # Book positions are evaluated offline, see evaluate_books.py
+    evaluation = book_evaluations.get(opening, board)
+    if evaluation is not None and evaluation.depth >= budget.min_depth:
+        return evaluation
+    return evaluation_cache.get(board, budget.min_depth, ANALYSIS_PROFILE.name)
+
+
+async def lookup_evaluations(
+        boards: list[chess.Board],
+        opening: str,
+        budget: AnalysisBudget = DEFAULT_BUDGET
+) -> list[CachedEvaluation | None]:
+    # The cache reads SQLite and the first lookup of a book loads its
+    # sidecar file, they would block the event loop
+    return await asyncio.to_thread(
+        lambda: [lookup_evaluation(board, opening, budget)
+                 for board in boards])
+
+
+async def store_evaluation(board: chess.Board, evaluation: CachedEvaluation):
+    await asyncio.to_thread(evaluation_cache.put, board,
+                            ANALYSIS_PROFILE.name, evaluation)
+
+
+def parse_legal_move(board: chess.Board, move_uci: str | None) -> chess.Move:
+    # Moves of the client reach the engine's searchmoves, an illegal one
+    # would make it answer with a move python-chess rejects
+    try:
+        move = chess.Move.from_uci(move_uci or '')
+    except ValueError:
+        abort(400)
+    if move not in board.legal_moves:
+        abort(400)
+    return move
+
+
+async def search_lines(
+        board: chess.Board,
+        root_moves: list[chess.Move] | None,
+        multipv: int,
+        budget: AnalysisBudget = DEFAULT_BUDGET,
+        background: bool = False,
+        game: str | None = None) -> list[chess.engine.InfoDict]:
+    """
+    Searches the position with the analysis engine.
+
+    `game` identifies the game the position comes from, its consecutive
+    positions are searched by the same engine when it is free. The board
+    should keep its move stack, so the engine gets the moves of the game.
+    """
+    # Background searches are not shared, requests would wait on their
+    # lower priority
+    key = (chess.polyglot.zobrist_hash(board), budget, ANALYSIS_PROFILE.name,
+           multipv, tuple(root_moves or ()), background)
+    return await analysis_flights.run(
+        key,
+        functools.partial(engine_pool.run,
+                          time=budget.time,
+                          background=background,
+                          game=game),
+        ANALYSIS_PROFILE, analyse_with_budget, board.copy(), budget, multipv,
+        root_moves)
+
+
+def evaluation_from_line(line: chess.engine.InfoDict) -> CachedEvaluation:
+    return CachedEvaluation(line['score'], line.get('pv', []),
+                            line.get('depth', 0))
+
+
+async def evaluate_position(board: chess.Board,
+                            opening: str,
+                            budget: AnalysisBudget = DEFAULT_BUDGET,
+                            background: bool = False,
+                            game: str | None = None) -> CachedEvaluation:
+    evaluation, = await lookup_evaluations([board], opening, budget)
+    if evaluation is None:
+        lines = await search_lines(board, None, 1, budget, background, game)
+        evaluation = evaluation_from_line(lines[0])
+        await store_evaluation(board, evaluation)
+    logger.debug('Evaluation cache: %s, searches: %s',
+                 evaluation_cache.stats(), analysis_flights.stats())
+    return evaluation
+
+
+def evaluation_after_move(board: chess.Board,
+                          line: chess.engine.InfoDict) -> CachedEvaluation:
+    # Same point of view as if the position after the move was analysed
+    turn = not board.turn
+    return CachedEvaluation(chess.engine.PovScore(line['score'].pov(turn), turn),
+                            line.get('pv', [])[1:],
+                            max(line.get('depth', 0) - 1, 0))
+
+
+async def evaluate_candidates(
+    board: chess.Board,
+    opening: str,
+    moves: list[chess.Move],
+    budget: AnalysisBudget = DEFAULT_BUDGET,
+    game: str | None = None
+) -> tuple[CachedEvaluation, dict[chess.Move, CachedEvaluation]]:
+    """
+    Evaluates the position and the positions after the candidate moves.
+
+    Known evaluations are taken from the book files and the cache. Everything
+    else comes from one MultiPV search of the position. When the best move
+    is known the search is restricted to it and the candidates, otherwise
+    the top MULTIPV_LINES moves are searched and candidates outside of them
+    are scored by a second search restricted to these candidates.
+    """
+    boards = [board.copy(stack=False)]
+    for move in moves:
+        boards.append(boards[0].copy(stack=False))
+        boards[-1].push(move)
+    position, *evaluations = await lookup_evaluations(boards, opening, budget)
+    children: dict[chess.Move, CachedEvaluation] = {}
+    for move, evaluation in zip(moves, evaluations):
+        if evaluation is not None:
+            children[move] = evaluation
+    missing = [move for move in dict.fromkeys(moves) if move not in children]
+    if position is not None and not missing:
+        return position, children
+
+    if position is not None and position.pv:
+        root_moves = list(dict.fromkeys([position.pv[0], *missing]))
+        lines = await search_lines(board,
+                                   root_moves,
+                                   len(root_moves),
+                                   budget,
+                                   game=game)
+    else:
+        lines = await search_lines(board,
+                                   None,
+                                   MULTIPV_LINES,
+                                   budget,
+                                   game=game)
+    if position is None:
+        position = evaluation_from_line(lines[0])
+        await store_evaluation(board, position)
+    for line in lines:
+        if line.get('pv') and line['pv'][0] in missing:
+            children[line['pv'][0]] = evaluation_after_move(board, line)
+
+    missing = [move for move in missing if move not in children]
+    if missing:
+        for line in await search_lines(board,
+                                       missing,
+                                       len(missing),
+                                       budget,
+                                       game=game):
+            if line.get('pv'):
+                children[line['pv'][0]] = evaluation_after_move(board, line)
+    return position, children
+
+
+def get_position_assessment(board: chess.Board,
+                            evaluation: CachedEvaluation | None,
+                            result: EdgeResult) -> PositionAssessment:
+    score, pv, depth = None, [], 0
+    if evaluation is not None:
+        score, pv, depth = evaluation.score, evaluation.pv, evaluation.depth
     if not result.edges:
-        return PositionAssessment(pv=info.get('pv', []), score=info['score'])
+        return PositionAssessment(pv=pv, score=score, depth=depth)
     sidelines = get_sidelines(result)
     if len(board.move_stack) < START_HALFMOVES_LENGTH:
         sidelines = []
     assert result.edges[0].count != 0
     mainline = (result.edges[0].move,
-                int(100 * result.edges[0].count /
-                    sum(edge.count for edge in result.edges)))
-    return PositionAssessment(score=info['score'],
+                int(100 * result.edges[0].count / result.total))
+    return PositionAssessment(score=score,
                               mainline=mainline,
                               sidelines=sidelines,
-                              pv=info.get('pv', []))
+                              pv=pv,
+                              depth=depth)
+
+
+async def lookup_book(board: chess.Board,
+                      opening: str,
+                      game: str | None = None) -> EdgeResult:
+    # A game moves its cursor by the moves since its previous lookup
+    if game is None:
+        return await book_reader.from_fen(opening, board.fen())
+    return await book_cursors.get(game, opening).edges(board)
+
+
+async def assess_position_from_book(
+        board: chess.Board,
+        opening: str,
+        budget: AnalysisBudget = DEFAULT_BUDGET,
+        game: str | None = None) -> PositionAssessment:
+    """
+    Assesses the position without searching it.
+
+    The score is the one evaluated already, if any. Deeper scores are sent by
+    `stream_analysis`.
+    """
+    (evaluation,), result = await asyncio.gather(
+        lookup_evaluations([board], opening, budget),
+        lookup_book(board, opening, game))
+    return get_position_assessment(board, evaluation, result)
+
+
+async def assess_position(
+        board: chess.Board,
+        opening: str,
+        budget: AnalysisBudget = DEFAULT_BUDGET,
+        game: str | None = None) -> PositionAssessment:
+    logger.debug('Assessing %s in %s', board.fen(), opening)
+    # The book lookup runs while the engine searches
+    evaluation, result = await asyncio.gather(
+        evaluate_position(board, opening, budget, game=game),
+        lookup_book(board, opening, game))
+    return get_position_assessment(board, evaluation, result)
 
 
 def get_move_type(expectation: float, new_expectation: float) -> MoveType:
@@ -76,53 +323,255 @@ def get_move_type(expectation: float, new_expectation: float) -> MoveType:
     return MoveType.OK
 
 
-def assess_move(board: chess.Board, move: chess.Move,
-                position_assessment: PositionAssessment) -> MoveAssessment:
-    board.push(move)
-    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-    engine.configure({'Hash': ENGINE_MEMORY_LIMIT})
-    info = engine.analyse(board, chess.engine.Limit(depth=ENGINE_DEPTH))
-    engine.quit()
-    board.pop()
-    old_expectation = position_assessment.score.relative.wdl().expectation()
-    new_expectation = (-info['score'].relative).wdl(
-        ply=ENGINE_DEPTH).expectation()
-    move_type = get_move_type(old_expectation, new_expectation)
+def get_line_type(move: chess.Move,
+                  position_assessment: PositionAssessment) -> LineType:
     line_type = LineType.UNKNOWN
     if move in list(map(lambda x: x[0], position_assessment.sidelines)):
         line_type = LineType.SIDELINE
     if position_assessment.mainline and move == position_assessment.mainline[0]:
         line_type = LineType.MAIN
-    return MoveAssessment(move_type, line_type, info['score'],
-                          info.get('pv', []))
+    return line_type
+
+
+def get_move_assessment(
+        move: chess.Move,
+        position_assessment: PositionAssessment,
+        evaluation: CachedEvaluation,
+        book_result: EdgeResult | None = None) -> MoveAssessment:
+    old_expectation = position_assessment.score.relative.wdl().expectation()
+    new_expectation = (-evaluation.score.relative).wdl(
+        ply=ENGINE_DEPTH).expectation()
+    move_type = get_move_type(old_expectation, new_expectation)
+    line_type = get_line_type(move, position_assessment)
+    return MoveAssessment(move_type, line_type, evaluation.score,
+                          evaluation.pv, evaluation.depth, book_result)
+
+
+async def assess_move(
+        board: chess.Board,
+        move: chess.Move,
+        position_assessment: PositionAssessment,
+        opening: str,
+        budget: AnalysisBudget = DEFAULT_BUDGET,
+        game: str | None = None) -> MoveAssessment:
+    board.push(move)
+    evaluation = await evaluate_position(board, opening, budget, game=game)
+    board.pop()
+    return get_move_assessment(move, position_assessment, evaluation)
+
+
+async def assess_position_and_moves(
+    board: chess.Board,
+    opening: str,
+    moves: list[chess.Move],
+    budget: AnalysisBudget = DEFAULT_BUDGET,
+    game: str | None = None
+) -> tuple[PositionAssessment, list[MoveAssessment]]:
+    """
+    Assesses the position and the given moves played from it.
+
+    Equivalent to `assess_position` followed by `assess_move` for every
+    move, but served by a single engine search in the common case. The book
+    moves of the position and of the positions reached by the moves are
+    looked up first, in one round trip. When every move is a book move the
+    position is not searched: the moves are judged by the evaluations known
+    already, or taken as OK with no score, and deeper scores are sent by
+    `stream_analysis`.
+    """
+    logger.debug('Assessing the moves of %s in %s', board.fen(), opening)
+    boards = [board.copy(stack=False)]
+    for move in moves:
+        boards.append(boards[0].copy(stack=False))
+        boards[-1].push(move)
+    results = await book_reader.from_fens([(opening, child.fen())
+                                           for child in boards])
+    book_assessment = get_position_assessment(board, None, results[0])
+    if all(
+            get_line_type(move, book_assessment) != LineType.UNKNOWN
+            for move in moves):
+        position, *evaluations = await lookup_evaluations(
+            boards, opening, budget)
+        position_assessment = get_position_assessment(board, position,
+                                                      results[0])
+        move_assessments = []
+        for move, evaluation, book_result in zip(moves, evaluations,
+                                                 results[1:]):
+            if position is not None and evaluation is not None:
+                move_assessments.append(
+                    get_move_assessment(move, position_assessment, evaluation,
+                                        book_result))
+            else:
+                move_assessments.append(
+                    MoveAssessment(MoveType.OK,
+                                   get_line_type(move, position_assessment),
+                                   None, [], 0, book_result))
+        return position_assessment, move_assessments
+
+    evaluation, children = await evaluate_candidates(board, opening, moves,
+                                                     budget, game)
+    position_assessment = get_position_assessment(board, evaluation,
+                                                  results[0])
+    return position_assessment, [
+        get_move_assessment(move, position_assessment, children[move],
+                            book_result)
+        for move, book_result in zip(moves, results[1:])
+    ]
+
+
+def prefetch_replies(key: str, board: chess.Board,
+                     position_assessment: PositionAssessment, opening: str,
+                     budget: AnalysisBudget):
+    """
+    Analyses the positions after the likely replies in the background.
 
+    The replies are the book moves and the engine's best move. Positions
+    that are already evaluated are skipped.
+    """
+    replies = []
+    if position_assessment.mainline:
+        replies.append(position_assessment.mainline[0])
+    replies += [move for move, _ in position_assessment.sidelines]
+    replies += position_assessment.pv[:1]
+    jobs = []
+    for move in list(dict.fromkeys(replies))[:PREFETCH_REPLIES]:
+        child = board.copy()
+        child.push(move)
+        if lookup_evaluation(child, opening, budget) is None:
+            jobs.append(
+                functools.partial(evaluate_position,
+                                  child,
+                                  opening,
+                                  budget,
+                                  background=True,
+                                  game=key))
+    prefetcher.schedule(key, jobs)
 
-def find_best_move(board: chess.Board,
-                   lvl: int,
-                   opening: str,
-                   can_sideline: bool = False) -> chess.Move:
-    result = book_reader.from_fen(opening, board.fen())
+
+def cancel_prefetch(key: str):
+    prefetcher.cancel(key)
+
+
+async def assess_reached_position(
+        board: chess.Board,
+        opening: str,
+        move_assessment: MoveAssessment | None,
+        budget: AnalysisBudget = DEFAULT_BUDGET,
+        game: str | None = None) -> PositionAssessment:
+    """
+    Assesses the position reached by a move without searching it again.
+
+    Unless the position is evaluated already, the score comes from the
+    search that assessed the move, and stays None after a book move that
+    was not searched. Deeper scores are sent by `stream_analysis`. The book
+    moves come from the batched lookup of `assess_position_and_moves` when
+    it looked them up.
+    """
+    evaluation, = await lookup_evaluations([board], opening, budget)
+    if evaluation is None and move_assessment is None:
+        return await assess_position(board, opening, budget, game)
+    if evaluation is None and move_assessment.score is not None:
+        evaluation = CachedEvaluation(move_assessment.score,
+                                      move_assessment.pv,
+                                      move_assessment.depth)
+    if move_assessment is not None and move_assessment.book_result is not None:
+        result = move_assessment.book_result
+    else:
+        result = await lookup_book(board, opening, game)
+    return get_position_assessment(board, evaluation, result)
+
+
+def stream_analysis(board: chess.Board,
+                    opening: str,
+                    player_color: str,
+                    budget: AnalysisBudget,
+                    game: str | None = None) -> Iterator[str]:
+    """
+    Yields server-sent events with the evaluation of the position.
+
+    A known evaluation is sent at once. Otherwise the position is searched
+    and an event is sent for every completed depth. The stream ends with a
+    `done` event.
+    """
+
+    def event(evaluation: CachedEvaluation) -> str:
+        data = {
+            'score':
+                get_absolute_score(board, PositionAssessment(evaluation.score),
+                                   player_color),
+            'depth':
+                evaluation.depth,
+            'pv': [move.uci() for move in evaluation.pv],
+        }
+        return f'data: {json.dumps(data)}\n\n'
+
+    evaluation = lookup_evaluation(board, opening, budget)
+    if evaluation is not None:
+        yield event(evaluation)
+    elif not board.is_game_over():
+        updates: queue.Queue[CachedEvaluation | None] = queue.Queue()
+        future = event_loop.submit(
+            engine_pool.run(ANALYSIS_PROFILE,
+                            analyse_with_budget,
+                            board.copy(),
+                            budget,
+                            1,
+                            None,
+                            lambda lines: updates.put(
+                                evaluation_from_line(lines[0])),
+                            time=budget.time,
+                            game=game))
+        future.add_done_callback(lambda _: updates.put(None))
+        while (update := updates.get()) is not None:
+            evaluation = update
+            yield event(evaluation)
+        if future.exception() is not None:
+            logger.warning('Streamed analysis failed: %r', future.exception())
+        else:
+            final = evaluation_from_line(future.result()[0])
+            if evaluation is None or final.depth > evaluation.depth:
+                yield event(final)
+            evaluation_cache.put(board, ANALYSIS_PROFILE.name, final)
+    yield 'event: done\ndata: {}\n\n'
+
+
+def analysis_stream_response(board: chess.Board,
+                             budget: AnalysisBudget) -> Response:
+    """
+    Streams the analysis of the current position of the session's game.
+
+    Only that position is searched. The client sends the FEN it shows, a
+    position the game has moved on from is answered with 409 rather than
+    searched.
+    """
+    fen = request.args.get('fen')
+    if fen is not None and fen != board.fen():
+        abort(409)
+    return Response(stream_analysis(board, session['current_book_path'],
+                                    session['color'], budget, session.sid),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+async def find_best_move(board: chess.Board,
+                         lvl: int,
+                         opening: str,
+                         can_sideline: bool = False) -> chess.Move:
+    result = await book_reader.from_fen(opening, board.fen())
     if result.edges:
         if can_sideline:
             sidelines = get_sidelines(result)
             if random.random() < 0.5 and sidelines:
                 return random.choice(sidelines)[0]
         return result.edges[0].move
-    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-    # engine.configure({'Skill level': lvl, 'Hash': ENGINE_MEMORY_LIMIT})
-    engine.configure({
-        'UCI_LimitStrength': True,
-        'UCI_Elo': lvl,
-        'Hash': ENGINE_MEMORY_LIMIT
-    })
-
-    result = engine.play(board, chess.engine.Limit(time=0.2))
-    engine.quit()
+    result = await engine_pool.play(bot_profile(lvl), board,
+                                    chess.engine.Limit(time=0.2))
     return result.move
 
 
 def get_absolute_score(board: chess.Board, pos_info: PositionAssessment,
-                       player_color: str) -> int:
+                       player_color: str) -> int | None:
+    if pos_info.score is None:
+        return None
     if (board.turn == chess.WHITE and
             player_color == 'white') or (board.turn == chess.BLACK and
                                          player_color == 'black'):
@@ -1,4 +1,58 @@
-from ..book_reader_protocol import BookReader
-from .paths import BOOK_READER_PATH
+import atexit
+from ..book_evaluations import BookEvaluationStore
+from ..book_cursors import BookCursors
+from ..book_reader_pool import BookReaderPool
+from ..book_warm_up import BookWarmUp
+from ..engine_pool import EnginePool
+from ..evaluation_cache import EvaluationCache
+from ..event_loop import EventLoopThread
+from ..mapped_book import MappedBookReader
+from ..prefetcher import Prefetcher
+from ..single_flight import SingleFlight
+from .paths import BOOK_READER_PATH, BOOKS_DIR, STOCKFISH_PATH
+from .paths import EVALUATION_CACHE_PATH
 
-book_reader = BookReader.popen(BOOK_READER_PATH)
+# Number of Stockfish processes kept alive by the application
+ENGINE_POOL_SIZE = 4
+# Number of evaluations kept in memory, the rest is read from disk
+EVALUATION_CACHE_SIZE = 100000
+# Speculative analyses queued at most and run at once
+PREFETCH_QUEUE_SIZE = 64
+PREFETCH_WORKERS = 2
+# Books are mapped into the application instead of read by book_reader
+MAPPED_BOOKS = True
+# Number of book_reader processes and worker threads in each of them
+BOOK_READER_POOL_SIZE = 2
+BOOK_READER_THREADS = 2
+# Games whose book cursors are kept
+BOOK_CURSORS = 1024
+# Books preloaded at startup (None for all books of config.json) and
+# preloaded at once
+WARM_UP_BOOKS: list[str] | None = None
+WARM_UP_PARALLELISM = 2
+
+# Engines and the book reader live on one event loop shared by all requests
+event_loop = EventLoopThread()
+if MAPPED_BOOKS:
+    book_reader = MappedBookReader()
+else:
+    book_reader = event_loop.run_sync(
+        BookReaderPool.popen(BOOK_READER_PATH,
+                             BOOK_READER_POOL_SIZE,
+                             str(BOOK_READER_THREADS),
+                             binary=True))
+# Lookups of a game move its cursor instead of sending a FEN
+book_cursors = BookCursors(book_reader, BOOK_CURSORS)
+book_warm_up = BookWarmUp.from_config(BOOKS_DIR, WARM_UP_BOOKS)
+event_loop.submit(book_warm_up.run(book_reader, WARM_UP_PARALLELISM))
+engine_pool = EnginePool(STOCKFISH_PATH, ENGINE_POOL_SIZE, event_loop.loop)
+# Identical concurrent searches share one engine search
+analysis_flights = SingleFlight(event_loop.loop)
+prefetcher = Prefetcher(event_loop.loop, PREFETCH_QUEUE_SIZE,
+                        PREFETCH_WORKERS)
+atexit.register(engine_pool.close)
+atexit.register(prefetcher.close)
+atexit.register(lambda: event_loop.run_sync(book_reader.quit(), timeout=5))
+book_evaluations = BookEvaluationStore()
+evaluation_cache = EvaluationCache(EVALUATION_CACHE_PATH,
+                                   EVALUATION_CACHE_SIZE)
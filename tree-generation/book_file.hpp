@@ -0,0 +1,369 @@
+/*
+ * book_file.hpp
+ * reading and writing of the book files of make_book and merge_books
+ * (formats v1 and v3, see make_book.cc and book_reader.cc)
+ *
+ * The moves of a book are read and merged as counts in the order of
+ * MoveKey: by position hash, then by source and destination square. That
+ * is the order of the entries of a v1 book. The moves of a v3 position are
+ * sorted back into it when read.
+ */
+#pragma once
+#include "./chess-library/include/chess.hpp"
+#include <algorithm>
+#include <cstdint>
+#include <fstream>
+#include <functional>
+#include <iostream>
+#include <queue>
+#include <string>
+#include <utility>
+#include <vector>
+
+// Moves played fewer times are left out of the books
+const int POPULARITY_LIMIT = 5;
+
+struct Entry {
+  uint64_t zobrist;
+  chess::Square source_square;
+  chess::Square destination_square;
+  bool promotion;
+  chess::PieceType promotion_piece;
+};
+
+// A move in a position, ordered like the entries of a book
+struct MoveKey {
+  uint64_t zobrist;
+  // source << 10 | destination << 4 | promotion piece + 1 (0 without
+  // promotion)
+  uint16_t move;
+
+  static MoveKey FromEntry(const Entry &entry) {
+    return MoveKey{entry.zobrist,
+                   (uint16_t)(entry.source_square.index() << 10 |
+                              entry.destination_square.index() << 4 |
+                              (entry.promotion ? (int)entry.promotion_piece + 1
+                                               : 0))};
+  }
+  Entry toEntry() const {
+    int promotion = move & 0xf;
+    return Entry{zobrist, chess::Square(move >> 10),
+                 chess::Square(move >> 4 & 0x3f), promotion != 0,
+                 promotion != 0
+                     ? chess::PieceType(
+                           static_cast<chess::PieceType::underlying>(
+                               promotion - 1))
+                     : chess::PieceType::PAWN};
+  }
+  bool operator==(const MoveKey &other) const {
+    return zobrist == other.zobrist && move == other.move;
+  }
+  bool operator<(const MoveKey &other) const {
+    return zobrist < other.zobrist ||
+           (zobrist == other.zobrist && move < other.move);
+  }
+};
+
+struct BookRecord {
+  Entry entry;
+  uint32_t count;
+};
+
+// Counts of moves in the order of MoveKey
+class CountSource {
+public:
+  virtual ~CountSource() = default;
+  // Reads the next count, false at the end
+  virtual bool next() = 0;
+
+  MoveKey key{};
+  uint32_t count{0};
+};
+
+// Counts sorted in memory
+class VectorSource : public CountSource {
+public:
+  explicit VectorSource(std::vector<std::pair<MoveKey, uint32_t>> counts)
+      : counts(std::move(counts)) {}
+
+  bool next() override {
+    if (position == counts.size()) {
+      return false;
+    }
+    key = counts[position].first;
+    count = counts[position].second;
+    position++;
+    return true;
+  }
+
+private:
+  std::vector<std::pair<MoveKey, uint32_t>> counts;
+  size_t position{0};
+};
+
+// Counts of the moves of a book file, read one entry (v1) or one position
+// (v3) at a time
+class BookFileReader : public CountSource {
+public:
+  explicit BookFileReader(const std::string &path)
+      : path(path), file(path, std::ios::binary),
+        moves_file(path, std::ios::binary) {
+    if (!file.is_open()) {
+      std::cerr << "Cannot open book " << path << std::endl;
+      exit(1);
+    }
+    char magic[4];
+    if (file.read(magic, sizeof(magic)) &&
+        std::string(magic, sizeof(magic)) == "CTBK") {
+      version = readValue<uint8_t>(file);
+      file.ignore(3);
+      positions_left = readValue<uint64_t>(file);
+      move_bytes = readValue<uint64_t>(file);
+      if (!file || version != 3) {
+        std::cerr << "Unsupported book " << path << std::endl;
+        exit(1);
+      }
+      moves_file.seekg(HEADER_BYTES + positions_left * POSITION_BYTES);
+      if (positions_left > 0) {
+        readRecord();
+      }
+    } else {
+      file.clear();
+      file.seekg(0);
+    }
+  }
+
+  bool next() override {
+    if (version == 1) {
+      return readEntry();
+    }
+    while (pending_index == pending.size()) {
+      if (!readPosition()) {
+        return false;
+      }
+    }
+    key = pending[pending_index].first;
+    count = pending[pending_index].second;
+    pending_index++;
+    return true;
+  }
+
+private:
+  static const uint64_t HEADER_BYTES = 24;
+  static const uint64_t POSITION_BYTES = 16;
+  std::string path;
+  std::ifstream file;
+  // The moves of a v3 book, read along with the positions
+  std::ifstream moves_file;
+  int version{1};
+  uint64_t positions_left{0};
+  uint64_t move_bytes{0};
+  uint64_t moves_read{0};
+  // The position record read ahead, its offset ends the moves of the
+  // position before it
+  uint64_t next_zobrist{0};
+  uint32_t next_offset{0};
+  // Moves of the v3 position being read
+  std::vector<std::pair<MoveKey, uint32_t>> pending;
+  size_t pending_index{0};
+
+  template <typename T> static T readValue(std::ifstream &stream) {
+    T value{};
+    stream.read(reinterpret_cast<char *>(&value), sizeof(value));
+    return value;
+  }
+
+  bool readEntry() {
+    uint64_t zobrist = readValue<uint64_t>(file);
+    uint8_t source_square = readValue<uint8_t>(file);
+    uint8_t destination_square = readValue<uint8_t>(file);
+    uint8_t promotion = readValue<uint8_t>(file);
+    uint8_t promotion_piece = readValue<uint8_t>(file);
+    uint32_t cnt = readValue<uint32_t>(file);
+    if (!file) {
+      return false;
+    }
+    key = MoveKey{zobrist,
+                  (uint16_t)(source_square << 10 | destination_square << 4 |
+                             (promotion ? promotion_piece + 1 : 0))};
+    count = cnt;
+    return true;
+  }
+
+  void readRecord() {
+    next_zobrist = readValue<uint64_t>(file);
+    next_offset = readValue<uint32_t>(file);
+    readValue<uint32_t>(file); // total
+  }
+
+  bool readPosition() {
+    if (positions_left == 0) {
+      return false;
+    }
+    positions_left--;
+    uint64_t zobrist = next_zobrist;
+    uint64_t end = move_bytes;
+    if (positions_left > 0) {
+      readRecord();
+      end = next_offset;
+    }
+    pending.clear();
+    pending_index = 0;
+    while (moves_read < end && moves_file) {
+      uint16_t code = readValue<uint16_t>(moves_file);
+      moves_read += 2;
+      uint32_t cnt = 0;
+      for (int shift = 0;; shift += 7) {
+        uint8_t byte = readValue<uint8_t>(moves_file);
+        moves_read++;
+        cnt |= (uint32_t)(byte & 0x7f) << shift;
+        if (!(byte & 0x80) || !moves_file) {
+          break;
+        }
+      }
+      // python-chess numbers the piece types from 1
+      pending.push_back(
+          {MoveKey{zobrist, (uint16_t)((code & 0x3f) << 10 |
+                                       (code >> 6 & 0x3f) << 4 | code >> 12)},
+           cnt});
+    }
+    if (!file || !moves_file || moves_read != end) {
+      std::cerr << "Truncated book " << path << std::endl;
+      exit(1);
+    }
+    std::sort(pending.begin(), pending.end());
+    return true;
+  }
+};
+
+// Merges the sources, calls emit(key, count) with the sum of the counts of
+// every move in the order of MoveKey
+template <typename Emit>
+void MergeCounts(const std::vector<CountSource *> &sources, Emit emit) {
+  // Sources by their next key, the smallest first
+  using Head = std::pair<MoveKey, size_t>;
+  std::priority_queue<Head, std::vector<Head>, std::greater<Head>> heads;
+  for (size_t i = 0; i < sources.size(); i++) {
+    if (sources[i]->next()) {
+      heads.push({sources[i]->key, i});
+    }
+  }
+  while (!heads.empty()) {
+    MoveKey key = heads.top().first;
+    uint64_t count = 0;
+    while (!heads.empty() && heads.top().first == key) {
+      size_t i = heads.top().second;
+      heads.pop();
+      count += sources[i]->count;
+      if (sources[i]->next()) {
+        heads.push({sources[i]->key, i});
+      }
+    }
+    emit(key, count);
+  }
+}
+
+// Number of games of a book from its summary file, 0 without one
+inline int ReadGames(const std::string &summary_path) {
+  std::ifstream summary(summary_path);
+  std::string field;
+  int games = 0;
+  while (summary >> field) {
+    if (field == "Games:") {
+      summary >> games;
+    }
+  }
+  return games;
+}
+
+template <typename T> void WriteValue(std::ofstream &file, T value) {
+  file.write(reinterpret_cast<char *>(&value), sizeof(value));
+}
+
+inline void WriteBookV1(std::ofstream &file,
+                        const std::vector<BookRecord> &records) {
+  for (const auto &record : records) {
+    const Entry &entry = record.entry;
+    WriteValue<uint64_t>(file, entry.zobrist);
+    WriteValue<uint8_t>(file, entry.source_square.index());
+    WriteValue<uint8_t>(file, entry.destination_square.index());
+    WriteValue<uint8_t>(file, entry.promotion);
+    WriteValue<uint8_t>(file, entry.promotion_piece);
+    WriteValue<uint32_t>(file, record.count);
+  }
+}
+
+// Records are sorted by zobrist hash and by move. The offsets into the move
+// table are 4 bytes, a larger book is not written.
+inline void WriteBookV3(std::ofstream &file,
+                        std::vector<BookRecord> &records) {
+  std::stable_sort(records.begin(), records.end(),
+                   [](const BookRecord &a, const BookRecord &b) {
+                     if (a.entry.zobrist != b.entry.zobrist) {
+                       return a.entry.zobrist < b.entry.zobrist;
+                     }
+                     return a.count > b.count;
+                   });
+  std::vector<uint8_t> moves;
+  std::vector<size_t> starts;
+  for (size_t i = 0; i < records.size(); i++) {
+    const Entry &entry = records[i].entry;
+    if (i == 0 || entry.zobrist != records[i - 1].entry.zobrist) {
+      starts.push_back(i);
+    }
+    // python-chess numbers the piece types from 1
+    uint16_t code = entry.source_square.index() |
+                    entry.destination_square.index() << 6 |
+                    (entry.promotion ? (int)entry.promotion_piece + 1 : 0)
+                        << 12;
+    moves.push_back(code & 0xff);
+    moves.push_back(code >> 8);
+    uint32_t count = records[i].count;
+    while (count >= 0x80) {
+      moves.push_back((count & 0x7f) | 0x80);
+      count >>= 7;
+    }
+    moves.push_back(count);
+  }
+  if (moves.size() > UINT32_MAX) {
+    std::cerr << "Move table of " << moves.size()
+              << " bytes does not fit the v3 format" << std::endl;
+    exit(1);
+  }
+  file.write("CTBK", 4);
+  WriteValue<uint8_t>(file, 3);
+  WriteValue<uint8_t>(file, 0);
+  WriteValue<uint16_t>(file, 0);
+  WriteValue<uint64_t>(file, starts.size());
+  WriteValue<uint64_t>(file, moves.size());
+  uint32_t offset = 0;
+  for (size_t p = 0; p < starts.size(); p++) {
+    size_t end = p + 1 < starts.size() ? starts[p + 1] : records.size();
+    uint32_t total = 0;
+    for (size_t i = starts[p]; i < end; i++) {
+      total += records[i].count;
+    }
+    WriteValue<uint64_t>(file, records[starts[p]].entry.zobrist);
+    WriteValue<uint32_t>(file, offset);
+    WriteValue<uint32_t>(file, total);
+    for (size_t i = starts[p]; i < end; i++) {
+      uint32_t count = records[i].count;
+      offset += 3;
+      while (count >= 0x80) {
+        offset++;
+        count >>= 7;
+      }
+    }
+  }
+  file.write(reinterpret_cast<char *>(moves.data()), moves.size());
+}
+
+// Writes the records, sorted by MoveKey, as a book of the format
+inline void WriteBookRecords(std::ofstream &file, int format,
+                             std::vector<BookRecord> &records) {
+  if (format == 3) {
+    WriteBookV3(file, records);
+  } else {
+    WriteBookV1(file, records);
+  }
+}
@@ -1,7 +1,8 @@
 /*
  * book_reader.cc
- * Reads a book (binary file). The format of the file is:
- * The sequence of 16 byte entries.
+ * Reads books (binary files) mapped into memory. There are two formats.
+ *
+ * v1: The sequence of 16 byte entries sorted by hash.
  * One entry consists of:
  * 8 byte zobrist hash of the position
  * 1 byte number of source square of the move
@@ -10,25 +11,107 @@
  * 1 byte number indicating the promotion piece
  * 4 byte number of apperances of the move in that position
  *
+ * v3: A 24 byte header:
+ * 4 byte magic "CTBK"
+ * 1 byte format version (3)
+ * 3 byte padding
+ * 8 byte number of positions
+ * 8 byte size of the move table in bytes
+ * The position table sorted by hash. One position consists of:
+ * 8 byte zobrist hash of the position
+ * 4 byte offset of the first move of the position in the move table
+ * 4 byte number of apperances of the position
+ * The moves of a position end at the offset of the next position, or at the
+ * end of the move table for the last one. The move table. The moves of a position are sorted by the number of
+ * appearances, one move consists of:
+ * 2 byte move (from | to << 6 | promotion << 12, python-chess piece types)
+ * varint (LEB128) number of apperances of the move in that position
+ * Castling is stored as the king capturing its rook in both formats.
+ *
+ * When a book is loaded, an index of the entries (v1) or positions (v3) by
+ * the top bits of the hash is built, so a lookup only searches the few
+ * entries of one bucket.
+ *
  * Arguments:
+ * 1. Number of worker threads answering tagged commands (optional,
+ *    default 4).
  *
  * Handles the following commands:
  * 1. fromfen bookname <fen>
- *    Responds with the number of moves from the position and the moves
- *    sorted by the number of appearances in the book.
- * 2. exit
- * 3. quit
+ *    Responds with "positionmoves <n> total <t>": the number of moves from
+ *    the position and the number of appearances of the position, followed
+ *    by the moves sorted by the number of appearances in the book.
+ * 2. fromfens n bookname_1 <fen_1> ... bookname_n <fen_n>
+ *    Responds with "positions n" followed by the response of fromfen for
+ *    every position, in the order of the arguments.
+ * 3. binary on|off
+ *    Switches the responses of fromfen and fromfens to a binary mode: every
+ *    position is answered with "positionbytes <8 * n> total <t>" followed
+ *    by n records of 8 bytes (from square, to square, python-chess
+ *    promotion piece type or 0, padding, little endian uint32 count).
+ *    Castling moves are sent as the king moving two squares. Takes effect
+ *    for the commands read after it, commands read before it are answered
+ *    in the previous mode even when they are still queued.
+ * 4. stats
+ *    Responds with "stats books <n> bytes <b> budget <b> hits <n>
+ *    misses <n> evictions <n>": the books mapped at the moment, their size
+ *    and the budget in bytes, and the counters of book lookups.
+ * 5. bench bookname n
+ *    Times n lookups of positions from the book and n lookups of random
+ *    hashes, once with the index and once with a binary search of the whole
+ *    book. Responds with "bench entries <n> index_bits <k> indexed_ns <t>
+ *    binary_search_ns <t>", the times are the average per lookup.
+ * 6. open cursor bookname <fen> [moves]
+ *    Opens a cursor with the given name on the position after the moves
+ *    (in UCI) from the FEN, replacing an open cursor of that name.
+ *    Responds like fromfen for the position of the cursor.
+ * 7. push cursor [moves]
+ *    Makes the moves on the cursor, the hash of the position is updated
+ *    move by move. Responds like fromfen for the new position.
+ * 8. pop cursor [n]
+ *    Takes back the last n moves (1 by default) of the cursor. Responds like
+ *    fromfen for the new position.
+ * 9. edges cursor
+ *    Responds like fromfen for the position of the cursor.
+ * 10. close cursor
+ *    Closes the cursor, without a response.
+ *    Cursors unused for 10 minutes are closed. If the cursor is not open or
+ *    cannot make the moves (which closes it), open, push, pop and edges
+ *    respond with "nocursor".
+ * 11. exit
+ * 12. quit
+ *
+ * A command can be tagged with a request id: "#<id> fromfen bookname <fen>".
+ * Tagged commands are answered by worker threads, possibly out of order,
+ * and the first line of the response carries the same tag:
+ * "#<id> positionmoves <n>". The lines of one response are always written
+ * together. Untagged commands are answered in order by the main thread.
+ * exit and quit wait for the answers of tagged commands in flight.
  */
 #include "./chess-library/include/chess.hpp"
+#include <chrono>
+#include <condition_variable>
+#include <cstdlib>
+#include <cstring>
 #include <fstream>
 #include <iomanip>
-#include <map>
+#include <list>
+#include <memory>
+#include <mutex>
 #include <queue>
 #include <random>
 #include <set>
 #include <sstream>
 #include <string>
+#include <thread>
+#include <unordered_map>
 #include <vector>
+#ifndef _WIN32
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
 using std::cerr;
 using std::cin;
 using std::cout;
@@ -48,8 +131,12 @@ struct BookEntry {
 };
 
 struct Command {
+  string tag;
   string name;
   vector<string> args;
+  // Response mode when the command was read, tagged commands are answered
+  // later by the workers
+  bool binary{false};
 };
 
 struct Edge {
@@ -57,167 +144,760 @@ struct Edge {
   uint32_t count;
 };
 
-// static vector<BookEntry> book;
+// Record of the binary response mode
+struct BinaryEdge {
+  uint8_t src;
+  uint8_t dst;
+  uint8_t promotion_piece;
+  uint8_t padding;
+  uint32_t count;
+};
+static_assert(sizeof(BinaryEdge) == 8, "BinaryEdge must be packed");
+
+// Header of a v3 book
+struct BookHeader {
+  char magic[4];
+  uint8_t version;
+  uint8_t padding[3];
+  uint64_t positions;
+  uint64_t move_bytes;
+};
+static_assert(sizeof(BookHeader) == 24, "BookHeader must be packed");
+
+// Position of a v3 book
+struct PositionEntry {
+  uint64_t hash;
+  uint32_t offset;
+  uint32_t total;
+};
+static_assert(sizeof(PositionEntry) == 16, "PositionEntry must be packed");
+
+const char BOOK_MAGIC[4] = {'C', 'T', 'B', 'K'};
+
+// A book mapped into memory. The mapping is shared with the lookups in
+// flight, so an evicted book is unmapped after them.
+struct MappedBook {
+  int version = 1;
+  // Entries of a v1 book
+  const BookEntry *entries = nullptr;
+  // Positions and moves of a v3 book
+  const PositionEntry *positions = nullptr;
+  const uint8_t *moves = nullptr;
+  size_t move_bytes = 0;
+  // Number of entries of a v1 book or positions of a v3 book
+  size_t size = 0;
+  size_t bytes = 0;
+  void *addr = nullptr;
+  // index[p] is the first entry or position whose hash starts with a
+  // prefix >= p
+  vector<uint32_t> index;
+  int index_bits = 0;
+#ifdef _WIN32
+  vector<char> data;
+#endif
+
+  MappedBook() = default;
+  MappedBook(const MappedBook &) = delete;
+  MappedBook &operator=(const MappedBook &) = delete;
+  ~MappedBook() {
+#ifndef _WIN32
+    if (addr != nullptr) {
+      munmap(addr, bytes);
+    }
+#endif
+  }
+
+  uint64_t hash(size_t idx) const {
+    return version == 3 ? positions[idx].hash : entries[idx].hash;
+  }
+  size_t resident_bytes() const {
+    return bytes + index.size() * sizeof(uint32_t);
+  }
+};
+
+using BookBuffer = std::shared_ptr<const MappedBook>;
+
+// Tagged commands waiting for a worker thread
 static queue<Command> command_queue;
+static std::mutex command_mutex;
+static std::condition_variable command_cv;
+static bool stopping = false;
 
-const long long TOTAL_BUFFER_SIZE_ALLOWED = 1 << 24;
-static long long total_buffer_size = 0;
-std::vector<std::vector<BookEntry>> book_buffers;
-static long long time_point = 0;
+// Responses are written as a whole
+static std::mutex output_mutex;
 
-struct Book {
-  std::string filename;
-  long long last_accessed;
-  int buffer_idx;
+// Response mode of the commands read from now on, only used by the main
+// thread
+static bool binary_responses = false;
+
+// Mapped bytes of the resident books. The pages themselves live in the page
+// cache and are shared with other readers, the budget bounds the mappings.
+const size_t MAPPED_BYTES_ALLOWED = 1ULL << 28;
+
+struct ResidentBook {
+  BookBuffer buffer;
+  std::list<string>::iterator lru_position;
 };
 
-std::map<std::string, Book> name_to_book;
+// Guarded by books_mutex. lru_order starts with the most recently used book.
+static std::unordered_map<string, ResidentBook> name_to_book;
+static std::list<string> lru_order;
+static size_t mapped_bytes = 0;
+static long long book_hits = 0;
+static long long book_misses = 0;
+static long long book_evictions = 0;
+static std::mutex books_mutex;
 
-static void ReadBook(const string &filename, vector<BookEntry> *book) {
-  std::ifstream in(filename, std::ios::binary);
-  if (!in) {
-    cerr << "Cannot open file " << filename << std::endl;
-    return;
+// Entries of one bucket of the index on average
+const size_t ENTRIES_PER_BUCKET = 4;
+const int MAX_INDEX_BITS = 22;
+
+static void BuildIndex(MappedBook *book) {
+  int bits = 1;
+  while (bits < MAX_INDEX_BITS && (book->size >> bits) > ENTRIES_PER_BUCKET) {
+    bits++;
   }
-  BookEntry entry;
-  while (in.read(reinterpret_cast<char *>(&entry), sizeof(entry))) {
-    book->push_back(entry);
+  size_t buckets = size_t{1} << bits;
+  book->index_bits = bits;
+  book->index.resize(buckets + 1);
+  size_t entry = 0;
+  for (size_t prefix = 0; prefix < buckets; prefix++) {
+    while (entry < book->size && (book->hash(entry) >> (64 - bits)) < prefix) {
+      entry++;
+    }
+    book->index[prefix] = static_cast<uint32_t>(entry);
   }
+  book->index[buckets] = static_cast<uint32_t>(book->size);
 }
 
-static int ApplyLRU() {
-  int min_time = time_point;
-  std::string min_name;
-  for (const auto &entry : name_to_book) {
-    if (entry.second.last_accessed < min_time) {
-      min_time = entry.second.last_accessed;
-      min_name = entry.first;
+// Points the book into its bytes. A v3 book starts with a header, a v1 book
+// is just the entries. A malformed book has no entries.
+static void SetLayout(MappedBook *book, const char *data, size_t bytes,
+                      const string &filename) {
+  const auto *header = reinterpret_cast<const BookHeader *>(data);
+  if (bytes >= sizeof(BookHeader) &&
+      std::memcmp(header->magic, BOOK_MAGIC, sizeof(BOOK_MAGIC)) == 0) {
+    size_t body = bytes - sizeof(BookHeader);
+    if (header->version != 3 ||
+        body / sizeof(PositionEntry) < header->positions ||
+        body - header->positions * sizeof(PositionEntry) < header->move_bytes) {
+      cerr << "Malformed book " << filename << std::endl;
+      return;
     }
+    book->version = 3;
+    book->positions =
+        reinterpret_cast<const PositionEntry *>(data + sizeof(BookHeader));
+    book->size = header->positions;
+    book->moves =
+        reinterpret_cast<const uint8_t *>(book->positions + book->size);
+    book->move_bytes = header->move_bytes;
+    return;
   }
-  int buffer_idx = name_to_book[min_name].buffer_idx;
-  total_buffer_size -= book_buffers[buffer_idx].size();
-  book_buffers[buffer_idx].clear();
-  name_to_book.erase(min_name);
-  for (auto &entry : name_to_book) {
-    if (entry.second.buffer_idx + 1 == (int)book_buffers.size()) {
-      entry.second.buffer_idx = buffer_idx;
-      std::swap(book_buffers[buffer_idx], book_buffers.back());
-      book_buffers.pop_back();
-      break;
+  book->entries = reinterpret_cast<const BookEntry *>(data);
+  book->size = bytes / sizeof(BookEntry);
+}
+
+// A book that cannot be mapped has no entries
+static BookBuffer MapBook(const string &filename) {
+  auto book = std::make_shared<MappedBook>();
+#ifdef _WIN32
+  std::ifstream in(filename, std::ios::binary);
+  if (!in) {
+    cerr << "Cannot open file " << filename << std::endl;
+    return book;
+  }
+  book->data.assign(std::istreambuf_iterator<char>(in),
+                    std::istreambuf_iterator<char>());
+  book->bytes = book->data.size();
+  SetLayout(book.get(), book->data.data(), book->bytes, filename);
+  BuildIndex(book.get());
+#else
+  int fd = open(filename.c_str(), O_RDONLY);
+  if (fd == -1) {
+    cerr << "Cannot open file " << filename << std::endl;
+    return book;
+  }
+  struct stat st;
+  if (fstat(fd, &st) == 0 && st.st_size > 0) {
+    size_t bytes = st.st_size;
+    void *addr = mmap(nullptr, bytes, PROT_READ, MAP_SHARED, fd, 0);
+    if (addr == MAP_FAILED) {
+      cerr << "Cannot map file " << filename << std::endl;
+    } else {
+      book->addr = addr;
+      book->bytes = bytes;
+      SetLayout(book.get(), static_cast<const char *>(addr), bytes, filename);
+      // The index is built in one pass, lookups then touch few pages far
+      // apart and readahead is wasted
+      madvise(addr, bytes, MADV_SEQUENTIAL);
+      BuildIndex(book.get());
+      madvise(addr, bytes, MADV_RANDOM);
     }
   }
-  return buffer_idx;
+  // The mapping stays valid after the file is closed
+  close(fd);
+#endif
+  return book;
 }
 
-static std::vector<BookEntry> &GetBookBuffer(const std::string &filename) {
-  if (name_to_book.find(filename) == name_to_book.end()) {
-    name_to_book[filename] = Book{filename, time_point, -1};
+// Evicts the least recently used books, the most recently used one stays
+// even if it does not fit into the budget alone
+static void ApplyLRU() {
+  while (mapped_bytes > MAPPED_BYTES_ALLOWED && lru_order.size() > 1) {
+    auto victim = name_to_book.find(lru_order.back());
+    mapped_bytes -= victim->second.buffer->resident_bytes();
+    name_to_book.erase(victim);
+    lru_order.pop_back();
+    book_evictions++;
   }
-  time_point++;
-  name_to_book[filename].last_accessed = time_point;
-  if (name_to_book[filename].buffer_idx == -1) {
-    name_to_book[filename].buffer_idx = book_buffers.size();
-    book_buffers.push_back({});
-    ReadBook(filename, &book_buffers.back());
-    total_buffer_size += book_buffers.back().size();
-    if (total_buffer_size > TOTAL_BUFFER_SIZE_ALLOWED) {
-      ApplyLRU();
-    }
+}
+
+static BookBuffer GetBookBuffer(const std::string &filename) {
+  std::lock_guard<std::mutex> lock(books_mutex);
+  auto it = name_to_book.find(filename);
+  if (it != name_to_book.end()) {
+    book_hits++;
+    lru_order.splice(lru_order.begin(), lru_order, it->second.lru_position);
+    return it->second.buffer;
   }
-  return book_buffers[name_to_book[filename].buffer_idx];
+  book_misses++;
+  BookBuffer buffer = MapBook(filename);
+  lru_order.push_front(filename);
+  name_to_book.emplace(filename, ResidentBook{buffer, lru_order.begin()});
+  mapped_bytes += buffer->resident_bytes();
+  ApplyLRU();
+  return buffer;
 }
 
-static void ParseCommand(const string &line) {
+static Command ParseCommand(const string &line) {
   Command command;
+  command.binary = binary_responses;
   std::istringstream iss(line);
   iss >> command.name;
+  if (!command.name.empty() && command.name[0] == '#') {
+    command.tag = command.name;
+    iss >> command.name;
+  }
   string arg;
   while (iss >> arg) {
     command.args.push_back(arg);
   }
-  command_queue.push(command);
+  return command;
 }
 
-static vector<Edge> FindEdgesFromPosition(const std::string &bookname,
-                                          uint64_t pos_hash) {
-  vector<Edge> edges;
-  auto &book = GetBookBuffer(bookname);
-  auto it = std::lower_bound(
-      book.begin(), book.end(), pos_hash,
-      [](const BookEntry &entry, uint64_t hash) { return entry.hash < hash; });
-  while (it != book.end() && it->hash == pos_hash) {
-    chess::Move move;
-    chess::Square src(it->src);
-    chess::Square dst(it->dst);
-    chess::PieceType promotion_piece(
-        static_cast<chess::PieceType::underlying>(it->promotion_piece));
-    if (it->promotion) {
-      move =
-          chess::Move::make<chess::Move::PROMOTION>(src, dst, promotion_piece);
-    } else {
-      move = chess::Move::make(src, dst);
-    }
-    edges.push_back({move, it->count});
+static void WriteResponse(const Command &command, const string &response) {
+  std::lock_guard<std::mutex> lock(output_mutex);
+  if (!command.tag.empty()) {
+    cout << command.tag << ' ';
+  }
+  cout << response;
+  cout.flush();
+}
+
+// Range of the entries or positions [first, last) a hash can be in
+static std::pair<size_t, size_t> KeyRange(const MappedBook &book,
+                                          uint64_t pos_hash, bool use_index) {
+  if (!use_index || book.index.empty()) {
+    return {0, book.size};
+  }
+  size_t prefix = pos_hash >> (64 - book.index_bits);
+  return {book.index[prefix], book.index[prefix + 1]};
+}
+
+// First entry or position with the hash, nullptr if there is none
+template <typename Entry>
+static const Entry *FindFirst(const Entry *entries,
+                              std::pair<size_t, size_t> range,
+                              uint64_t pos_hash) {
+  const Entry *last = entries + range.second;
+  const Entry *it = std::lower_bound(
+      entries + range.first, last, pos_hash,
+      [](const Entry &entry, uint64_t hash) { return entry.hash < hash; });
+  return it != last && it->hash == pos_hash ? it : nullptr;
+}
+
+static bool ContainsPosition(const MappedBook &book, uint64_t pos_hash,
+                             bool use_index) {
+  auto range = KeyRange(book, pos_hash, use_index);
+  if (book.version == 3) {
+    return FindFirst(book.positions, range, pos_hash) != nullptr;
+  }
+  return FindFirst(book.entries, range, pos_hash) != nullptr;
+}
+
+static chess::Move MakeMove(uint8_t src, uint8_t dst, bool promotion,
+                            uint8_t promotion_piece) {
+  if (promotion) {
+    return chess::Move::make<chess::Move::PROMOTION>(
+        chess::Square(src), chess::Square(dst),
+        chess::PieceType(
+            static_cast<chess::PieceType::underlying>(promotion_piece)));
+  }
+  return chess::Move::make(chess::Square(src), chess::Square(dst));
+}
+
+static void FindEdgesV1(const MappedBook &book, uint64_t pos_hash,
+                        vector<Edge> *edges, uint64_t *total) {
+  const BookEntry *it =
+      FindFirst(book.entries, KeyRange(book, pos_hash, true), pos_hash);
+  const BookEntry *last = book.entries + book.size;
+  while (it != nullptr && it != last && it->hash == pos_hash) {
+    edges->push_back({MakeMove(it->src, it->dst, it->promotion,
+                               it->promotion_piece),
+                      it->count});
+    *total += it->count;
     it++;
   }
-  std::sort(edges.begin(), edges.end(),
+  std::sort(edges->begin(), edges->end(),
             [](const Edge &a, const Edge &b) { return a.count > b.count; });
+}
+
+// Edges of a v3 book are stored sorted, every edge is a 2 byte move
+// (from | to << 6 | promotion << 12, python-chess piece types) followed by
+// the count as a varint. They end where the edges of the next position
+// start.
+static void FindEdgesV3(const MappedBook &book, uint64_t pos_hash,
+                        vector<Edge> *edges, uint64_t *total) {
+  const PositionEntry *position =
+      FindFirst(book.positions, KeyRange(book, pos_hash, true), pos_hash);
+  if (position == nullptr) {
+    return;
+  }
+  size_t end = position + 1 != book.positions + book.size
+                   ? position[1].offset
+                   : book.move_bytes;
+  if (position->offset > end || end > book.move_bytes) {
+    return;
+  }
+  *total = position->total;
+  const uint8_t *it = book.moves + position->offset;
+  const uint8_t *last = book.moves + end;
+  while (last - it >= 2) {
+    uint16_t code = it[0] | it[1] << 8;
+    it += 2;
+    uint32_t count = 0;
+    for (int shift = 0; it != last; shift += 7) {
+      uint8_t byte = *it++;
+      count |= static_cast<uint32_t>(byte & 0x7f) << shift;
+      if (!(byte & 0x80)) {
+        break;
+      }
+    }
+    uint8_t promotion = code >> 12;
+    edges->push_back({MakeMove(code & 63, code >> 6 & 63, promotion != 0,
+                               promotion != 0 ? promotion - 1 : 0),
+                      count});
+  }
+}
+
+// Edges sorted by the number of appearances and the number of appearances
+// of the position
+static vector<Edge> FindEdgesFromPosition(const std::string &bookname,
+                                          uint64_t pos_hash, uint64_t *total) {
+  vector<Edge> edges;
+  *total = 0;
+  BookBuffer buffer = GetBookBuffer(bookname);
+  if (buffer->version == 3) {
+    FindEdgesV3(*buffer, pos_hash, &edges, total);
+  } else {
+    FindEdgesV1(*buffer, pos_hash, &edges, total);
+  }
   return edges;
 }
 
-static void ExecuteQuitCommand(const Command &command) {
-  if (command.name == "quit") {
-    exit(0);
+static void AppendBinaryEdges(const Board &board, const vector<Edge> &edges,
+                              uint64_t total, std::ostringstream *response) {
+  *response << "positionbytes " << edges.size() * sizeof(BinaryEdge)
+            << " total " << total << '\n';
+  for (const Edge &edge : edges) {
+    Square src = edge.move.from();
+    Square dst = edge.move.to();
+    // The book stores castling as the king capturing its rook
+    if (board.at<PieceType>(src) == PieceType::KING &&
+        std::abs(src.file() - dst.file()) > 1) {
+      dst = Square(dst > src ? File::FILE_G : File::FILE_C, src.rank());
+    }
+    BinaryEdge record{};
+    record.src = static_cast<uint8_t>(src.index());
+    record.dst = static_cast<uint8_t>(dst.index());
+    if (edge.move.typeOf() == Move::PROMOTION) {
+      // python-chess numbers the piece types from 1
+      record.promotion_piece =
+          static_cast<uint8_t>(edge.move.promotionType()) + 1;
+    }
+    record.count = edge.count;
+    response->write(reinterpret_cast<const char *>(&record), sizeof(record));
   }
 }
-static void ExecuteExitCommand(const Command &command) {
-  if (command.name == "exit") {
-    exit(0);
+
+// Appends the edges of the position on the board
+static void AppendEdges(const std::string &bookname, const Board &board,
+                        bool binary, std::ostringstream *response) {
+  uint64_t total;
+  vector<Edge> edges = FindEdgesFromPosition(bookname, board.hash(), &total);
+  if (binary) {
+    AppendBinaryEdges(board, edges, total, response);
+    return;
+  }
+  *response << "positionmoves " << edges.size() << " total " << total << '\n';
+  for (const Edge &edge : edges) {
+    *response << edge.move << " " << edge.count << '\n';
+  }
+}
+
+// Number of arguments describing one position: bookname and 6 FEN fields
+const size_t POSITION_ARGS = 7;
+
+// FEN given by the 6 arguments from args[first]
+static std::string JoinFen(const vector<string> &args, size_t first) {
+  std::string fen;
+  for (size_t i = 0; i < POSITION_ARGS - 1; i++) {
+    fen += args[first + i];
+    if (i != 4) {
+      fen += " ";
+    }
   }
+  return fen;
+}
+
+// Appends the edges of the position given by args[first..first + 7)
+static void AppendPositionMoves(const vector<string> &args, size_t first,
+                                bool binary, std::ostringstream *response) {
+  AppendEdges(args[first], Board(JoinFen(args, first + 1)), binary, response);
 }
 
 static void ExecuteFromFenCommand(const Command &command) {
-  if (command.name == "fromfen") {
-    if (command.args.empty() || command.args.size() != 7) {
-      cerr << "Usage: fromfen <fen>\n";
-      return;
+  if (command.args.size() != POSITION_ARGS) {
+    cerr << "Usage: fromfen bookname <fen>\n";
+    // The caller still waits for an answer
+    WriteResponse(command, command.binary ? "positionbytes 0 total 0\n"
+                                          : "positionmoves 0 total 0\n");
+    return;
+  }
+  std::ostringstream response;
+  AppendPositionMoves(command.args, 0, command.binary, &response);
+  WriteResponse(command, response.str());
+}
+
+static void ExecuteFromFensCommand(const Command &command) {
+  size_t n = command.args.empty()
+                 ? 0
+                 : std::strtoul(command.args[0].c_str(), nullptr, 10);
+  if (command.args.size() != 1 + n * POSITION_ARGS) {
+    cerr << "Usage: fromfens n bookname_1 <fen_1> ... bookname_n <fen_n>\n";
+    // The caller still waits for an answer for every position
+    std::ostringstream response;
+    response << "positions " << n << '\n';
+    for (size_t i = 0; i < n; i++) {
+      response << (command.binary ? "positionbytes 0 total 0\n"
+                                  : "positionmoves 0 total 0\n");
     }
-    const std::string &bookname = command.args[0];
-    std::string fen;
-    for (int i = 1; i < 7; i++) {
-      fen += command.args[i];
-      if (i != 5) {
-        fen += " ";
-      }
+    WriteResponse(command, response.str());
+    return;
+  }
+  std::ostringstream response;
+  response << "positions " << n << '\n';
+  for (size_t i = 0; i < n; i++) {
+    AppendPositionMoves(command.args, 1 + i * POSITION_ARGS, command.binary,
+                        &response);
+  }
+  WriteResponse(command, response.str());
+}
+
+// A game kept open by the caller. Moves are made on the board, so its hash
+// is updated incrementally instead of parsing a FEN for every lookup.
+struct Cursor {
+  string bookname;
+  Board board;
+  vector<Move> moves;
+  std::chrono::steady_clock::time_point last_used;
+  // Commands on one cursor come one after another, the mutex only guards
+  // against misbehaving callers
+  std::mutex mutex;
+};
+using CursorPtr = std::shared_ptr<Cursor>;
+
+// Cursors unused for longer are closed
+const auto CURSOR_IDLE_TIMEOUT = std::chrono::minutes(10);
+
+// Guarded by cursors_mutex
+static std::unordered_map<string, CursorPtr> name_to_cursor;
+static std::chrono::steady_clock::time_point last_cursor_sweep;
+static std::mutex cursors_mutex;
+
+static const char *const NO_CURSOR_RESPONSE = "nocursor\n";
+
+// Closes idle cursors, at most once per minute. Called with cursors_mutex.
+static void SweepCursors(std::chrono::steady_clock::time_point now) {
+  if (now - last_cursor_sweep < std::chrono::minutes(1)) {
+    return;
+  }
+  last_cursor_sweep = now;
+  for (auto it = name_to_cursor.begin(); it != name_to_cursor.end();) {
+    if (now - it->second->last_used > CURSOR_IDLE_TIMEOUT) {
+      it = name_to_cursor.erase(it);
+    } else {
+      ++it;
+    }
+  }
+}
+
+static CursorPtr FindCursor(const string &name) {
+  auto now = std::chrono::steady_clock::now();
+  std::lock_guard<std::mutex> lock(cursors_mutex);
+  SweepCursors(now);
+  auto it = name_to_cursor.find(name);
+  if (it == name_to_cursor.end()) {
+    return nullptr;
+  }
+  it->second->last_used = now;
+  return it->second;
+}
+
+static void CloseCursor(const string &name) {
+  std::lock_guard<std::mutex> lock(cursors_mutex);
+  name_to_cursor.erase(name);
+}
+
+// Legal move of the board given in UCI, castling as the king moving two
+// squares. Move::NO_MOVE if there is none.
+static Move ParseUciMove(const Board &board, const string &uci) {
+  if (uci.size() != 4 && uci.size() != 5) {
+    return Move::NO_MOVE;
+  }
+  for (size_t i = 0; i < 4; i += 2) {
+    if (uci[i] < 'a' || uci[i] > 'h' || uci[i + 1] < '1' || uci[i + 1] > '8') {
+      return Move::NO_MOVE;
     }
-    Board board(fen);
-    uint64_t pos_hash = board.hash();
-    vector<Edge> edges = FindEdgesFromPosition(bookname, pos_hash);
-    cout << "positionmoves " << edges.size() << '\n';
-    for (const Edge &edge : edges) {
-      cout << edge.move << " " << edge.count << '\n';
+  }
+  Move move = uci::uciToMove(board, uci);
+  Movelist legal_moves;
+  movegen::legalmoves(legal_moves, board);
+  if (std::find(legal_moves.begin(), legal_moves.end(), move) ==
+      legal_moves.end()) {
+    return Move::NO_MOVE;
+  }
+  return move;
+}
+
+// Makes the moves args[first..] on the cursor. A cursor that cannot make
+// them no longer follows the caller's game and is closed.
+static bool PushMoves(const string &name, Cursor *cursor,
+                      const vector<string> &args, size_t first) {
+  for (size_t i = first; i < args.size(); i++) {
+    Move move = ParseUciMove(cursor->board, args[i]);
+    if (move == Move::NO_MOVE) {
+      CloseCursor(name);
+      return false;
     }
-    cout.flush();
+    cursor->board.makeMove(move);
+    cursor->moves.push_back(move);
   }
+  return true;
+}
+
+static void WriteCursorEdges(const Command &command, const Cursor &cursor) {
+  std::ostringstream response;
+  AppendEdges(cursor.bookname, cursor.board, command.binary, &response);
+  WriteResponse(command, response.str());
+}
+
+// open cursor bookname <fen> [moves]
+static void ExecuteOpenCommand(const Command &command) {
+  if (command.args.size() < 1 + POSITION_ARGS) {
+    cerr << "Usage: open cursor bookname <fen> [moves]\n";
+    WriteResponse(command, NO_CURSOR_RESPONSE);
+    return;
+  }
+  const string &name = command.args[0];
+  auto cursor = std::make_shared<Cursor>();
+  cursor->bookname = command.args[1];
+  cursor->board = Board(JoinFen(command.args, 2));
+  cursor->last_used = std::chrono::steady_clock::now();
+  {
+    std::lock_guard<std::mutex> lock(cursors_mutex);
+    SweepCursors(cursor->last_used);
+    name_to_cursor[name] = cursor;
+  }
+  std::lock_guard<std::mutex> lock(cursor->mutex);
+  if (!PushMoves(name, cursor.get(), command.args, 1 + POSITION_ARGS)) {
+    WriteResponse(command, NO_CURSOR_RESPONSE);
+    return;
+  }
+  WriteCursorEdges(command, *cursor);
+}
+
+// push cursor [moves], pop cursor [n], edges cursor
+static void ExecuteCursorCommand(const Command &command) {
+  CursorPtr cursor =
+      command.args.empty() ? nullptr : FindCursor(command.args[0]);
+  if (cursor == nullptr) {
+    WriteResponse(command, NO_CURSOR_RESPONSE);
+    return;
+  }
+  const string &name = command.args[0];
+  std::lock_guard<std::mutex> lock(cursor->mutex);
+  if (command.name == "push" &&
+      !PushMoves(name, cursor.get(), command.args, 1)) {
+    WriteResponse(command, NO_CURSOR_RESPONSE);
+    return;
+  }
+  if (command.name == "pop") {
+    size_t n = command.args.size() > 1
+                   ? std::strtoul(command.args[1].c_str(), nullptr, 10)
+                   : 1;
+    if (n > cursor->moves.size()) {
+      CloseCursor(name);
+      WriteResponse(command, NO_CURSOR_RESPONSE);
+      return;
+    }
+    for (size_t i = 0; i < n; i++) {
+      cursor->board.unmakeMove(cursor->moves.back());
+      cursor->moves.pop_back();
+    }
+  }
+  WriteCursorEdges(command, *cursor);
+}
+
+static void ExecuteStatsCommand(const Command &command) {
+  std::ostringstream response;
+  {
+    std::lock_guard<std::mutex> lock(books_mutex);
+    response << "stats books " << name_to_book.size() << " bytes "
+             << mapped_bytes << " budget " << MAPPED_BYTES_ALLOWED << " hits "
+             << book_hits << " misses " << book_misses << " evictions "
+             << book_evictions << '\n';
+  }
+  WriteResponse(command, response.str());
+}
+
+// Average nanoseconds of a lookup of every hash
+static double TimeLookups(const MappedBook &book,
+                          const vector<uint64_t> &hashes, bool use_index) {
+  auto start = std::chrono::steady_clock::now();
+  size_t found = 0;
+  for (uint64_t hash : hashes) {
+    found += ContainsPosition(book, hash, use_index);
+  }
+  std::chrono::duration<double, std::nano> elapsed =
+      std::chrono::steady_clock::now() - start;
+  // Keeps the lookups from being optimised away
+  if (found > hashes.size()) {
+    cerr << found << '\n';
+  }
+  return hashes.empty() ? 0 : elapsed.count() / hashes.size();
+}
+
+static void ExecuteBenchCommand(const Command &command) {
+  if (command.args.size() != 2) {
+    cerr << "Usage: bench bookname n\n";
+    WriteResponse(command, "bench entries 0\n");
+    return;
+  }
+  BookBuffer buffer = GetBookBuffer(command.args[0]);
+  size_t n = std::strtoul(command.args[1].c_str(), nullptr, 10);
+  std::mt19937_64 gen(42);
+  vector<uint64_t> hashes;
+  for (size_t i = 0; i < n && buffer->size > 0; i++) {
+    hashes.push_back(buffer->hash(gen() % buffer->size));
+  }
+  for (size_t i = 0; i < n; i++) {
+    hashes.push_back(gen());
+  }
+  std::shuffle(hashes.begin(), hashes.end(), gen);
+  std::ostringstream response;
+  response << "bench entries " << buffer->size << " index_bits "
+           << buffer->index_bits << " indexed_ns "
+           << TimeLookups(*buffer, hashes, true) << " binary_search_ns "
+           << TimeLookups(*buffer, hashes, false) << '\n';
+  WriteResponse(command, response.str());
 }
 
 static void ExecuteCommand(const Command &command) {
-  ExecuteQuitCommand(command);
-  ExecuteExitCommand(command);
-  ExecuteFromFenCommand(command);
+  if (command.name == "fromfen") {
+    ExecuteFromFenCommand(command);
+  } else if (command.name == "fromfens") {
+    ExecuteFromFensCommand(command);
+  } else if (command.name == "stats") {
+    ExecuteStatsCommand(command);
+  } else if (command.name == "bench") {
+    ExecuteBenchCommand(command);
+  } else if (command.name == "open") {
+    ExecuteOpenCommand(command);
+  } else if (command.name == "push" || command.name == "pop" ||
+             command.name == "edges") {
+    ExecuteCursorCommand(command);
+  } else if (command.name == "close" && !command.args.empty()) {
+    CloseCursor(command.args[0]);
+  }
+}
+
+static void RunWorker() {
+  while (true) {
+    Command command;
+    {
+      std::unique_lock<std::mutex> lock(command_mutex);
+      command_cv.wait(lock,
+                      [] { return stopping || !command_queue.empty(); });
+      if (command_queue.empty()) {
+        return;
+      }
+      command = std::move(command_queue.front());
+      command_queue.pop();
+    }
+    ExecuteCommand(command);
+  }
+}
+
+static void StopWorkers(vector<std::thread> *workers) {
+  {
+    std::lock_guard<std::mutex> lock(command_mutex);
+    stopping = true;
+  }
+  command_cv.notify_all();
+  for (std::thread &worker : *workers) {
+    worker.join();
+  }
 }
 
-int main() {
+int main(int argc, char *argv[]) {
   std::ios_base::sync_with_stdio(false);
   std::cin.tie(nullptr);
 
+  int num_threads = argc > 1 ? std::atoi(argv[1]) : 0;
+  if (num_threads <= 0) {
+    num_threads = 4;
+  }
+  vector<std::thread> workers;
+  for (int i = 0; i < num_threads; i++) {
+    workers.emplace_back(RunWorker);
+  }
+
   while (true) {
     string line;
-    std::getline(cin, line);
-    ParseCommand(line);
-    while (!command_queue.empty()) {
-      ExecuteCommand(command_queue.front());
-      command_queue.pop();
+    // End of input, the parent process is gone
+    if (!std::getline(cin, line)) {
+      break;
+    }
+    Command command = ParseCommand(line);
+    if (command.name == "quit" || command.name == "exit") {
+      break;
+    }
+    // Commands read before the switch keep the mode they were read with
+    if (command.name == "binary") {
+      binary_responses = !command.args.empty() && command.args[0] == "on";
+      continue;
+    }
+    if (command.tag.empty()) {
+      ExecuteCommand(command);
+      continue;
+    }
+    {
+      std::lock_guard<std::mutex> lock(command_mutex);
+      command_queue.push(std::move(command));
     }
+    command_cv.notify_one();
   }
+  StopWorkers(&workers);
+  return 0;
 }
\ No newline at end of file
@@ -1,7 +1,7 @@
 /*
  * make_book.cc
  * reads pgn file from standard input and generates a book (binary file)
- * format of the generated file:
+ * format of the generated file (v1):
  * The sequence of 16 byte entries.
  * One entry consists of:
  * 8 byte zobrist hash of the position
@@ -11,6 +11,10 @@
  * 1 byte number indicating the promotion piece
  * 4 byte number of apperances of the move in that position
  *
+ * v3 (see book_reader.cc): a header, a table of positions with the number
+ * of apperances of every position and a table of moves, the moves of every
+ * position sorted by the number of apperances.
+ *
  * Arguments:
  *  book filename
  *  number of games in the input pgn file
@@ -20,18 +24,66 @@
  *  last eco code in accepted interval
  *  random generator seed
  *
+ * Or, to build several books in one pass over the input:
+ *  --manifest <manifest file>
+ *  number of games in the input pgn file
+ * where every line of the manifest is a book: the book filename, expected
+ * number of accepted games, max depth, first and last eco code and seed
+ * (see src/make_manifest.py). Every game is sampled into all books of its
+ * eco code, and its moves are parsed once.
+ *
+ * Options:
+ *  --format <1|3>    book format (default 1)
+ *  --threads <n>     parse the games on n worker threads
+ *  --memory <MB>     count the moves in at most MB megabytes
+ *  --temp-dir <dir>  directory of the temporary files of --memory
+ *                    (default $TMPDIR or /tmp)
+ *  --merge           add the counts of the existing books to the counts of
+ *                    the new games (see merge_books.cc)
+ *
+ * By default the games are parsed on one thread and sampled by reservoir
+ * sampling in the order of the input. With --threads the reading thread
+ * cuts the input into chunks of whole games and the workers filter and
+ * parse the chunks. Every game then gets a random key from the seed and its
+ * place in the input, and the games with the smallest keys are kept: a
+ * uniform sample that is the same for any number of threads.
+ *
+ * The sampled games are kept as their moves only, the positions are found
+ * again when the book is written. By default all moves of all games are then
+ * sorted in memory. With --memory the moves are counted in a hash map of at
+ * most that size instead, and whenever it is full its counts are sorted and
+ * written to a temporary file. The files are merged into the book. The games
+ * themselves cannot be counted while reading, as reservoir sampling may still
+ * replace any of them.
+ *
  * Example usage:
  *  zstdcat ../data/lichess_db_standard_rated_2024-04.pgn.zst | \
- *  ./make_book semi_slav 91383489 100000 30 D43 D49 73632
+ *  ./make_book semi_slav 91383489 100000 30 D43 D49 73632 --threads 8
+ *  zstdcat ../data/lichess_db_standard_rated_2024-04.pgn.zst | \
+ *  ./make_book --manifest books.txt 91383489 --threads 8
  */
+#include "./book_file.hpp"
 #include "./chess-library/include/chess.hpp"
+#include <algorithm>
+#include <atomic>
 #include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
 #include <fstream>
 #include <iomanip>
 #include <memory>
+#include <mutex>
+#include <queue>
 #include <random>
 #include <set>
+#include <sstream>
 #include <string>
+#include <thread>
+#include <unistd.h>
+#include <unordered_map>
 #include <vector>
 using std::cerr;
 using std::cin;
@@ -63,10 +115,12 @@ public:
     PrintProgress();
   }
   void startMoves(int ac) { accepted_games = ac; }
+  // Parallel builds count the accepted games of all workers
+  void addAccepted() { accepted_games++; }
 
 private:
   const int NUMBER_OF_GAMES;
-  int accepted_games{0};
+  std::atomic<int> accepted_games{0};
   int processed_games{0};
   Clock internal_clock;
 
@@ -148,23 +202,266 @@ struct DumpInfo {
   int n_edges;
 };
 
-class BookCreator {
+// The moves of a game as chess::Move codes, the positions are found again
+// by replaying them
+struct Game {
+  std::vector<uint16_t> moves;
+};
+
+const string STARTING_FEN =
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1";
+
+// Calls visit(hash, move) for every move of the game, with the hash of the
+// position the move is played in
+template <typename Visit> void ReplayGame(const Game &game, Visit visit) {
+  Board board(STARTING_FEN);
+  for (uint16_t code : game.moves) {
+    chess::Move move(code);
+    visit(board.hash(), move);
+    board.makeMove(move);
+  }
+}
+
+static Entry MakeEntry(uint64_t hash, chess::Move move) {
+  if (move.typeOf() == move.PROMOTION) {
+    return Entry{hash, move.from(), move.to(), true, move.promotionType()};
+  }
+  return Entry{hash, move.from(), move.to(), false, chess::PieceType::PAWN};
+}
+
+struct MoveKeyHash {
+  size_t operator()(const MoveKey &key) const {
+    return key.zobrist ^ (uint64_t)key.move * 0x9e3779b97f4a7c15ULL;
+  }
+};
+
+// Creates a temporary file in dir, removed once closed
+static FILE *TempFile(const string &dir) {
+  string path = dir + "/make_book.XXXXXX";
+  int fd = mkstemp(path.data());
+  FILE *file = fd < 0 ? nullptr : fdopen(fd, "w+b");
+  if (file == nullptr) {
+    cerr << "Cannot create a temporary file in " << dir << std::endl;
+    exit(1);
+  }
+  unlink(path.c_str());
+  return file;
+}
+
+// Move counts sorted by MoveKey, spilled to a temporary file
+class SortedRun : public CountSource {
+public:
+  SortedRun(const string &dir,
+            const std::vector<std::pair<MoveKey, uint32_t>> &counts)
+      : file(TempFile(dir)) {
+    setvbuf(file, nullptr, _IOFBF, BUFFER_BYTES);
+    for (const auto &[key, count] : counts) {
+      fwrite(&key.zobrist, sizeof(key.zobrist), 1, file);
+      fwrite(&key.move, sizeof(key.move), 1, file);
+      fwrite(&count, sizeof(count), 1, file);
+    }
+    if (fflush(file) != 0) {
+      cerr << "Cannot write a temporary file in " << dir << std::endl;
+      exit(1);
+    }
+    rewind(file);
+  }
+  ~SortedRun() { fclose(file); }
+
+  bool next() override {
+    return fread(&key.zobrist, sizeof(key.zobrist), 1, file) == 1 &&
+           fread(&key.move, sizeof(key.move), 1, file) == 1 &&
+           fread(&count, sizeof(count), 1, file) == 1;
+  }
+
+private:
+  static const size_t BUFFER_BYTES = 1 << 16;
+  FILE *file;
+};
+
+struct WriterOptions {
+  int format{1};
+  // Bytes of the hash map counting the moves, 0 to sort all moves in memory
+  size_t memory_limit{0};
+  string temp_dir{"/tmp"};
+  // Whether the counts of the existing book are added
+  bool merge{false};
+};
+
+// Writes the moves of the sampled games as the book <filename>.bin. By
+// default all moves are sorted in memory. With a memory limit the moves are
+// counted in a hash map of bounded size, spilled to sorted runs in temporary
+// files when full and the runs are merged. When merging, the counts of the
+// existing book are added to the counts of the games. The book is written to
+// a temporary file that replaces the book at the end.
+class BookWriter {
 public:
-  BookCreator(const string &filename, int expected_size, int seed)
-      : file(filename, std::ios::binary), ACCEPTED_LIMIT(expected_size),
-        gen(seed), distribution(0, expected_size - 1), real_coin(0, 1) {
+  BookWriter(const string &filename, const WriterOptions &options)
+      : path(filename + ".bin"), temp_path(path + ".tmp"),
+        file(temp_path, std::ios::binary), OPTIONS(options) {
     if (!file.is_open()) {
-      cerr << "Cannot open file " + std::string(filename) << std::endl;
+      cerr << "Cannot open file " + temp_path << std::endl;
+      exit(1);
+    }
+    if (OPTIONS.merge) {
+      if (std::ifstream(path).is_open()) {
+        existing_book = std::make_unique<BookFileReader>(path);
+        existing_games = ReadGames(filename + ".txt");
+      } else {
+        cerr << "No book " << path << " to merge, writing a new one"
+             << std::endl;
+      }
+    }
+  }
+
+  DumpInfo dumpBook(const std::vector<Game> &games) {
+    DumpInfo info;
+    info.n_accepted_games = existing_games + (int)games.size();
+    std::vector<BookRecord> records;
+    auto keep = [&records](const Entry &entry, uint64_t count) {
+      if ((int64_t)count >= POPULARITY_LIMIT) {
+        records.push_back(BookRecord{entry, (uint32_t)count});
+      }
+    };
+    if (OPTIONS.memory_limit > 0) {
+      countMovesExternal(games, keep);
+    } else {
+      countMoves(games, keep);
+    }
+    info.n_edges = (int)records.size();
+    WriteBookRecords(file, OPTIONS.format, records);
+    file.close();
+    existing_book.reset();
+    if (!file || std::rename(temp_path.c_str(), path.c_str()) != 0) {
+      cerr << "Cannot write book " << path << std::endl;
       exit(1);
     }
+    return info;
   }
 
+private:
+  const string path;
+  const string temp_path;
+  std::ofstream file;
+  // Estimated bytes of a count in the hash map, with the node and bucket
+  const size_t COUNT_BYTES{64};
+  const WriterOptions OPTIONS;
+  std::unique_ptr<BookFileReader> existing_book;
+  int existing_games{0};
+
+  // Calls emit(entry, count) for every move in the order of MoveKey
+  template <typename Emit>
+  void countMoves(const std::vector<Game> &games, Emit emit) {
+    // Promotions to different pieces are different moves
+    std::vector<MoveKey> keys;
+    for (const auto &game : games) {
+      ReplayGame(game, [&keys](uint64_t hash, chess::Move move) {
+        keys.push_back(MoveKey::FromEntry(MakeEntry(hash, move)));
+      });
+    }
+    std::sort(keys.begin(), keys.end());
+    std::vector<std::pair<MoveKey, uint32_t>> counts;
+    for (int i = 0; i < (int)keys.size(); i++) {
+      int count = 1;
+      while (i + 1 < (int)keys.size() && keys[i] == keys[i + 1]) {
+        count++;
+        i++;
+      }
+      if (existing_book) {
+        counts.push_back({keys[i], (uint32_t)count});
+      } else {
+        emit(keys[i].toEntry(), count);
+      }
+    }
+    if (existing_book) {
+      std::vector<MoveKey>().swap(keys);
+      VectorSource source(std::move(counts));
+      merge({&source}, emit);
+    }
+  }
+
+  template <typename Emit>
+  void countMovesExternal(const std::vector<Game> &games, Emit emit) {
+    const size_t max_counts =
+        std::max<size_t>(OPTIONS.memory_limit / COUNT_BYTES, 1);
+    std::unordered_map<MoveKey, uint32_t, MoveKeyHash> counts;
+    counts.reserve(max_counts);
+    std::vector<std::unique_ptr<CountSource>> runs;
+    auto spill = [&]() {
+      runs.push_back(
+          std::make_unique<SortedRun>(OPTIONS.temp_dir, sortCounts(counts)));
+      counts.clear();
+    };
+    for (const auto &game : games) {
+      ReplayGame(game, [&](uint64_t hash, chess::Move move) {
+        counts[MoveKey::FromEntry(MakeEntry(hash, move))]++;
+        if (counts.size() >= max_counts) {
+          spill();
+        }
+      });
+    }
+    if (runs.empty()) {
+      runs.push_back(std::make_unique<VectorSource>(sortCounts(counts)));
+    } else {
+      spill();
+      cout << "\nMerging " << runs.size() << " sorted runs";
+    }
+    std::unordered_map<MoveKey, uint32_t, MoveKeyHash>().swap(counts);
+    std::vector<CountSource *> sources;
+    for (auto &run : runs) {
+      sources.push_back(run.get());
+    }
+    merge(sources, emit);
+  }
+
+  // Merges the sources and the existing book
+  template <typename Emit>
+  void merge(std::vector<CountSource *> sources, Emit emit) {
+    if (existing_book) {
+      sources.push_back(existing_book.get());
+    }
+    MergeCounts(sources, [&emit](const MoveKey &key, uint64_t count) {
+      emit(key.toEntry(), count);
+    });
+  }
+
+  static std::vector<std::pair<MoveKey, uint32_t>> sortCounts(
+      const std::unordered_map<MoveKey, uint32_t, MoveKeyHash> &counts) {
+    std::vector<std::pair<MoveKey, uint32_t>> sorted(counts.begin(),
+                                                     counts.end());
+    std::sort(sorted.begin(), sorted.end(),
+              [](const auto &a, const auto &b) { return a.first < b.first; });
+    return sorted;
+  }
+};
+
+// Random key of the index-th game of a chunk of the input. It does not
+// depend on the thread parsing the chunk, so neither does the sample.
+static uint64_t SplitMix64(uint64_t x) {
+  x += 0x9e3779b97f4a7c15ULL;
+  x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+  x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+  return x ^ (x >> 31);
+}
+
+static uint64_t GameKey(uint64_t seed, uint64_t chunk, uint64_t index) {
+  return SplitMix64(SplitMix64(seed ^ SplitMix64(chunk)) + index);
+}
+
+class BookCreator {
+public:
+  BookCreator(int expected_size, int seed)
+      : ACCEPTED_LIMIT(expected_size), gen(seed),
+        distribution(0, expected_size - 1), real_coin(0, 1) {}
+
   int acceptedGames() const { return (int)games.size(); }
 
+  // Reservoir sampling in the order of the input
   bool shouldSkip() {
     game_count++;
     if ((int)games.size() < ACCEPTED_LIMIT) {
       games.push_back(Game{});
+      current = games.size() - 1;
       return false;
     }
     if (real_coin(gen) > ACCEPTED_LIMIT / (double)game_count) {
@@ -172,119 +469,60 @@ public:
     }
     int index = distribution(gen);
     std::swap(games[index], games.back());
-    games.back().game_moves.clear();
+    games.back().moves.clear();
+    current = games.size() - 1;
     return false;
   }
 
-  void startMoves() {
-    board = Board("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1");
+  // Keeps the games with the smallest keys. Samples of disjoint parts of
+  // the input merge into the sample of the whole input.
+  bool shouldSkip(uint64_t key) {
+    game_count++;
+    if ((int)games.size() < ACCEPTED_LIMIT) {
+      key_heap.push_back({key, games.size()});
+      std::push_heap(key_heap.begin(), key_heap.end());
+      games.push_back(Game{});
+      current = games.size() - 1;
+      return false;
+    }
+    if (key_heap.empty() || key >= key_heap.front().first) {
+      return true;
+    }
+    std::pop_heap(key_heap.begin(), key_heap.end());
+    key_heap.back().first = key;
+    current = key_heap.back().second;
+    std::push_heap(key_heap.begin(), key_heap.end());
+    games[current].moves.clear();
+    return false;
   }
 
-  void move(std::string_view move, std::string_view comment) {
-    chess::Move move_repr = uci::parseSan(board, move);
-    registerMove(move_repr);
-    board.makeMove(move_repr);
-  }
+  std::vector<Game> &sampledGames() { return games; }
 
-  DumpInfo dumpBook() {
-    std::vector<Entry> entries;
-    for (const auto &game : games) {
-      for (const auto &entry : game.game_moves) {
-        entries.push_back(entry);
-      }
-    }
-    DumpInfo info;
-    info.n_accepted_games = (int)games.size();
-    info.n_edges = 0;
-    std::sort(
-        entries.begin(), entries.end(), [](const Entry &a, const Entry &b) {
-          if (a.zobrist == b.zobrist && a.source_square == b.source_square) {
-            return a.destination_square < b.destination_square;
-          }
-          return a.zobrist < b.zobrist ||
-                 (a.zobrist == b.zobrist && a.source_square < b.source_square);
-        });
-    for (int i = 0; i < (int)entries.size(); i++) {
-      int count = 1;
-      while (i + 1 < (int)entries.size() &&
-             entries[i].zobrist == entries[i + 1].zobrist &&
-             entries[i].source_square == entries[i + 1].source_square &&
-             entries[i].destination_square ==
-                 entries[i + 1].destination_square) {
-        count++;
-        i++;
-      }
-      if (count >= POPULARITY_LIMIT) {
-      	info.n_edges++;
-      	writeMove(entries[i], count);
-      }
+  // Moves the games sampled by key to the end of sample
+  void takeKeyedSample(std::vector<std::pair<uint64_t, Game>> *sample) {
+    for (const auto &[key, slot] : key_heap) {
+      sample->emplace_back(key, std::move(games[slot]));
     }
-    file.flush();
-    entries.clear();
-    return info;
+    key_heap.clear();
+    games.clear();
+  }
+
+  // Adds the move to the game being read
+  void registerMove(chess::Move move) {
+    games[current].moves.push_back(move.move());
   }
 
 private:
-  Board board;
-  std::ofstream file;
-  struct Entry {
-    uint64_t zobrist;
-    chess::Square source_square;
-    chess::Square destination_square;
-    bool promotion;
-    chess::PieceType promotion_piece;
-  };
-  struct Game {
-    std::vector<Entry> game_moves;
-  };
   std::vector<Game> games;
+  // Max-heap of the keys of the sampled games and their index in games
+  std::vector<std::pair<uint64_t, size_t>> key_heap;
+  // Index in games of the game being read
+  size_t current{0};
   const int ACCEPTED_LIMIT;
-  const int POPULARITY_LIMIT{5};
   std::mt19937 gen;
   std::uniform_int_distribution<int> distribution;
   std::uniform_real_distribution<double> real_coin;
   int game_count{0};
-
-  void registerMove(chess::Move move) {
-    Entry entry;
-    if (move.typeOf() == move.PROMOTION) {
-      entry = Entry{board.hash(), move.from(), move.to(), true,
-                    move.promotionType()};
-    } else {
-      entry = Entry{board.hash(), move.from(), move.to(), false,
-                    chess::PieceType::PAWN};
-    }
-    games.back().game_moves.push_back(entry);
-  }
-
-  void writeMove(const Entry &entry, int count) {
-    uint64_t zobrist = entry.zobrist;
-    uint8_t source_square = entry.source_square.index();
-    uint8_t destination_square = entry.destination_square.index();
-    uint8_t promotion = entry.promotion;
-    uint8_t promotion_piece = entry.promotion_piece;
-    uint32_t cnt = count;
-    file.write(reinterpret_cast<char *>(&zobrist), sizeof(zobrist));
-    file.write(reinterpret_cast<char *>(&source_square), sizeof(source_square));
-    file.write(reinterpret_cast<char *>(&destination_square),
-               sizeof(destination_square));
-    file.write(reinterpret_cast<char *>(&promotion), sizeof(promotion));
-    file.write(reinterpret_cast<char *>(&promotion_piece),
-               sizeof(promotion_piece));
-    file.write(reinterpret_cast<char *>(&cnt), sizeof(cnt));
-  }
-};
-
-class DepthFilter {
-public:
-  DepthFilter(int max_depth) : max_depth(max_depth) {}
-  void startMoves() { depth = 0; }
-  void move(std::string_view move, std::string_view comment) { depth++; }
-  bool shouldSkip() { return depth > max_depth; }
-
-private:
-  const int max_depth;
-  int depth;
 };
 
 class EcoFilter {
@@ -304,106 +542,654 @@ private:
   string eco;
 };
 
+vector<string> genEcoCodes(const string &start, const string &end) {
+  vector<string> codes;
+  string code = start;
+  while (code != end) {
+    codes.push_back(code);
+    code[2]++;
+    if (code[2] > '9') {
+      code[2] = '0';
+      code[1]++;
+    }
+    if (code[1] > '9') {
+      code[1] = '0';
+      code[0]++;
+    }
+  }
+  codes.push_back(end);
+  return codes;
+}
+
+// One book to build, written to <filename>.bin and <filename>.txt
+struct BookSpec {
+  string filename;
+  int n_accepted_games;
+  int max_depth;
+  string start_eco_code;
+  string end_eco_code;
+  int seed;
+};
+
+// Reads a manifest with a book per line:
+//  <filename> <n_accepted_games> <max_depth> <start_eco> <end_eco> <seed>
+// Empty lines and lines starting with # are ignored.
+static vector<BookSpec> ReadManifest(const string &path) {
+  std::ifstream file(path);
+  if (!file.is_open()) {
+    cerr << "Cannot open manifest " << path << std::endl;
+    exit(1);
+  }
+  vector<BookSpec> specs;
+  string line;
+  int line_number = 0;
+  while (std::getline(file, line)) {
+    line_number++;
+    std::istringstream fields(line);
+    BookSpec spec;
+    if (!(fields >> spec.filename) || spec.filename[0] == '#') {
+      continue;
+    }
+    if (!(fields >> spec.n_accepted_games >> spec.max_depth >>
+          spec.start_eco_code >> spec.end_eco_code >> spec.seed) ||
+        spec.n_accepted_games <= 0 || spec.start_eco_code.size() != 3 ||
+        spec.end_eco_code.size() != 3 ||
+        spec.start_eco_code > spec.end_eco_code) {
+      cerr << "Invalid book in " << path << " line " << line_number << ": "
+           << line << std::endl;
+      exit(1);
+    }
+    specs.push_back(spec);
+  }
+  if (specs.empty()) {
+    cerr << "No books in manifest " << path << std::endl;
+    exit(1);
+  }
+  return specs;
+}
+
+// The sample of one book: the games of its eco codes, with the moves up to
+// its max depth
+struct BookTrack {
+  explicit BookTrack(const BookSpec &spec)
+      : eco_filter(genEcoCodes(spec.start_eco_code, spec.end_eco_code)),
+        book_creator(spec.n_accepted_games, spec.seed),
+        max_depth(spec.max_depth), seed(spec.seed) {}
+
+  EcoFilter eco_filter;
+  BookCreator book_creator;
+  const int max_depth;
+  const uint64_t seed;
+  // Whether the game being read is sampled into this book
+  bool active{false};
+};
+
+// Routes every game to the samples of all books accepting it. The moves of
+// a game are parsed once, up to the largest max depth of those books.
 class BookVisitor : public pgn::Visitor {
 public:
-  explicit BookVisitor(int n_games, int seed, int expected_size,
-                       const string &filename, int max_depth,
-                       const vector<string> &valid_codes)
+  // With keyed sampling (parallel builds) the games are sampled by their
+  // key and the progress printer only counts the accepted games
+  explicit BookVisitor(ProgressPrinter *progress_printer,
+                       const vector<BookSpec> &specs, bool keyed)
       : header_filter(std::make_unique<HeaderFilter>()),
-        progress_printer(std::make_unique<ProgressPrinter>(n_games)),
-        book_creator(
-            std::make_unique<BookCreator>(filename, expected_size, seed)),
-        depth_filter(std::make_unique<DepthFilter>(max_depth)),
-        eco_filter(std::make_unique<EcoFilter>(valid_codes)) {}
+        progress_printer(progress_printer), keyed(keyed) {
+    for (const BookSpec &spec : specs) {
+      tracks.push_back(std::make_unique<BookTrack>(spec));
+    }
+  }
   void startPgn() {
     header_filter->startPgn();
-    progress_printer->startPgn();
-    eco_filter->startPgn();
+    if (keyed) {
+      game_index++;
+    } else {
+      progress_printer->startPgn();
+    }
+    for (auto &track : tracks) {
+      track->eco_filter.startPgn();
+    }
   }
   void startMoves() {
-    if (header_filter->shouldSkip() || eco_filter->shouldSkip()) {
+    if (header_filter->shouldSkip()) {
       skipPgn(true);
       return;
     }
-    // Important that this is the last filter called
-    if (book_creator->shouldSkip()) {
+    parse_depth = -1;
+    int accepted_games = 0;
+    for (auto &track : tracks) {
+      BookCreator &creator = track->book_creator;
+      // Important that the book creator is the last filter called
+      track->active =
+          !track->eco_filter.shouldSkip() &&
+          !(keyed ? creator.shouldSkip(GameKey(track->seed, chunk, game_index))
+                  : creator.shouldSkip());
+      if (track->active) {
+        parse_depth = std::max(parse_depth, track->max_depth);
+      }
+      accepted_games += creator.acceptedGames();
+    }
+    if (parse_depth < 0) {
       skipPgn(true);
       return;
     }
-    progress_printer->startMoves(book_creator->acceptedGames());
-    book_creator->startMoves();
-    depth_filter->startMoves();
+    if (keyed) {
+      progress_printer->addAccepted();
+    } else {
+      progress_printer->startMoves(accepted_games);
+    }
+    board = Board(STARTING_FEN);
+    depth = 0;
   }
   void header(std::string_view key, std::string_view value) {
     header_filter->header(key, value);
-    eco_filter->header(key, value);
+    for (auto &track : tracks) {
+      track->eco_filter.header(key, value);
+    }
   }
-  void move(std::string_view move, std::string_view comment) {
-    depth_filter->move(move, comment);
-    if (depth_filter->shouldSkip()) {
+  void move(std::string_view move, std::string_view) {
+    depth++;
+    if (depth > parse_depth) {
+      skipPgn(true);
       return;
     }
-    book_creator->move(move, comment);
+    chess::Move move_repr = uci::parseSan(board, move);
+    for (auto &track : tracks) {
+      if (track->active && depth <= track->max_depth) {
+        track->book_creator.registerMove(move_repr);
+      }
+    }
+    board.makeMove(move_repr);
+    // The rest of the game is not read
+    if (depth == parse_depth) {
+      skipPgn(true);
+    }
   }
   void endPgn() {}
-  DumpInfo dumpBook() { return book_creator->dumpBook(); }
+  // The games of the chunk get keys of their own
+  void startChunk(uint64_t chunk_id) {
+    chunk = chunk_id;
+    game_index = 0;
+  }
+  BookCreator &creator(size_t book) { return tracks[book]->book_creator; }
 
 private:
   std::unique_ptr<HeaderFilter> header_filter;
-  std::unique_ptr<ProgressPrinter> progress_printer;
-  std::unique_ptr<BookCreator> book_creator;
-  std::unique_ptr<DepthFilter> depth_filter;
-  std::unique_ptr<EcoFilter> eco_filter;
+  ProgressPrinter *progress_printer;
+  vector<std::unique_ptr<BookTrack>> tracks;
+  Board board;
+  // Halfmoves of the game read so far, only the first parse_depth of them
+  // are parsed
+  int depth{0};
+  int parse_depth{0};
+  const bool keyed;
+  uint64_t chunk{0};
+  uint64_t game_index{0};
 };
 
-vector<string> genEcoCodes(const string &start, const string &end) {
-  vector<string> codes;
-  string code = start;
-  while (code != end) {
-    codes.push_back(code);
-    code[2]++;
-    if (code[2] > '9') {
-      code[2] = '0';
-      code[1]++;
+// Lines of the input, read in large blocks. A line is valid until the next
+// one is read.
+class LineReader {
+public:
+  explicit LineReader(std::istream &input)
+      : input(input), buffer(BLOCK_BYTES) {}
+
+  // Reads the next line without its line break, false at the end
+  bool next(std::string_view *line) {
+    while (true) {
+      const char *begin = buffer.data() + start;
+      const char *newline =
+          static_cast<const char *>(memchr(begin, '\n', end - start));
+      if (newline != nullptr) {
+        *line = withoutCarriageReturn(begin, newline - begin);
+        start += newline - begin + 1;
+        return true;
+      }
+      if (at_end) {
+        if (start == end) {
+          return false;
+        }
+        *line = withoutCarriageReturn(begin, end - start);
+        start = end;
+        return true;
+      }
+      fill();
     }
-    if (code[1] > '9') {
-      code[1] = '0';
-      code[0]++;
+  }
+
+private:
+  static const size_t BLOCK_BYTES = 1 << 20;
+  std::istream &input;
+  std::vector<char> buffer;
+  // The unread bytes of the buffer
+  size_t start{0};
+  size_t end{0};
+  bool at_end{false};
+
+  static std::string_view withoutCarriageReturn(const char *begin,
+                                                size_t length) {
+    if (length > 0 && begin[length - 1] == '\r') {
+      length--;
     }
+    return std::string_view(begin, length);
   }
-  codes.push_back(end);
-  return codes;
+
+  // Keeps the unread bytes and reads more, the buffer grows for long lines
+  void fill() {
+    size_t unread = end - start;
+    memmove(buffer.data(), buffer.data() + start, unread);
+    start = 0;
+    end = unread;
+    if (end == buffer.size()) {
+      buffer.resize(2 * buffer.size());
+    }
+    input.read(buffer.data() + end, buffer.size() - end);
+    end += input.gcount();
+    at_end = !input;
+  }
+};
+
+// Comments and variations of the moves that continue on the next line. A
+// line starting with '[' inside them is not a tag line: wrapped comments
+// often start with a command like [%clk 0:03:00].
+struct MovetextNesting {
+  bool in_comment{false};
+  int variation_depth{0};
+
+  bool nested() const { return in_comment || variation_depth > 0; }
+
+  // Follows the comments and variations of the line from i, passing over
+  // the moves
+  void skip(std::string_view line, size_t i = 0) {
+    for (; i < line.size(); i++) {
+      if (in_comment) {
+        const char *close = static_cast<const char *>(
+            memchr(line.data() + i, '}', line.size() - i));
+        if (close == nullptr) {
+          return;
+        }
+        in_comment = false;
+        i = close - line.data();
+        continue;
+      }
+      char c = line[i];
+      if (c == '{') {
+        in_comment = true;
+      } else if (c == '(') {
+        variation_depth++;
+      } else if (c == ')' && variation_depth > 0) {
+        variation_depth--;
+      } else if (c == ';') {
+        return;
+      }
+    }
+  }
+};
+
+// Reads the games of a pgn input for a pgn::Visitor, like pgn::StreamParser,
+// one line at a time. A game starts with a tag line that follows the moves
+// of the previous game. The moves are only tokenised while the visitor reads
+// them: of the moves of a skipped game, and of the rest of a game once the
+// visitor skips it, only the comments and variations are followed.
+class PgnScanner {
+public:
+  explicit PgnScanner(std::istream &input) : lines(input) {}
+
+  void readGames(pgn::Visitor &visitor) {
+    std::string_view line;
+    bool in_game = false;
+    bool in_moves = false;
+    while (lines.next(&line)) {
+      if (!line.empty() && line[0] == '[' && !nesting.nested()) {
+        if (!in_game || in_moves) {
+          if (in_game) {
+            endGame(visitor);
+          }
+          visitor.skipPgn(false);
+          visitor.startPgn();
+          in_game = true;
+          in_moves = false;
+        }
+        if (!visitor.skip()) {
+          readTag(line, visitor);
+        }
+        continue;
+      }
+      if (!in_game) {
+        continue;
+      }
+      if (!in_moves) {
+        in_moves = true;
+        game_over = false;
+        if (!visitor.skip()) {
+          visitor.startMoves();
+        }
+      }
+      if (!game_over) {
+        readMoves(line, visitor);
+      }
+    }
+    if (in_game) {
+      endGame(visitor);
+    }
+  }
+
+private:
+  LineReader lines;
+  // State of the moves of the game, comments and variations may span lines
+  MovetextNesting nesting;
+  bool game_over{false};
+
+  static void endGame(pgn::Visitor &visitor) {
+    visitor.endPgn();
+    visitor.skipPgn(false);
+  }
+
+  static void readTag(std::string_view line, pgn::Visitor &visitor) {
+    size_t key_end = line.find(' ');
+    size_t value_start = line.find('"');
+    size_t value_end = line.rfind('"');
+    if (key_end == std::string_view::npos ||
+        value_start == std::string_view::npos || value_end <= value_start) {
+      return;
+    }
+    visitor.header(line.substr(1, key_end - 1),
+                   line.substr(value_start + 1, value_end - value_start - 1));
+  }
+
+  static bool isResult(std::string_view token) {
+    return token == "1-0" || token == "0-1" || token == "1/2-1/2" ||
+           token == "*";
+  }
+
+  // Passes the moves of the line to the visitor, skipping move numbers,
+  // comments, variations and annotations, until the visitor skips the game
+  void readMoves(std::string_view line, pgn::Visitor &visitor) {
+    size_t i = 0;
+    while (i < line.size()) {
+      char c = line[i];
+      if (visitor.skip()) {
+        nesting.skip(line, i);
+        return;
+      } else if (nesting.in_comment) {
+        size_t close = line.find('}', i);
+        if (close == std::string_view::npos) {
+          return;
+        }
+        nesting.in_comment = false;
+        i = close + 1;
+      } else if (nesting.variation_depth > 0) {
+        if (c == '(') {
+          nesting.variation_depth++;
+        } else if (c == ')') {
+          nesting.variation_depth--;
+        } else if (c == '{') {
+          nesting.in_comment = true;
+        } else if (c == ';') {
+          return;
+        }
+        i++;
+      } else if (c == ' ' || c == '\t') {
+        i++;
+      } else if (c == '{') {
+        nesting.in_comment = true;
+        i++;
+      } else if (c == '(') {
+        nesting.variation_depth = 1;
+        i++;
+      } else if (c == ';') {
+        return;
+      } else {
+        size_t token_end = line.find_first_of(" \t{(;", i);
+        if (token_end == std::string_view::npos) {
+          token_end = line.size();
+        }
+        std::string_view token = line.substr(i, token_end - i);
+        i = token_end;
+        if (isResult(token)) {
+          game_over = true;
+          return;
+        }
+        // Move numbers, also when written together with the move (1.e4)
+        size_t digits = token.find_first_not_of("0123456789");
+        if (digits != std::string_view::npos && digits > 0 &&
+            token[digits] == '.') {
+          size_t move_start = token.find_first_not_of('.', digits);
+          token = move_start == std::string_view::npos
+                      ? std::string_view()
+                      : token.substr(move_start);
+        }
+        if (token.empty() || token[0] == '$') {
+          continue;
+        }
+        visitor.move(token, "");
+      }
+    }
+  }
+};
+
+// Games of the input read in one piece by a worker thread
+struct Chunk {
+  uint64_t id;
+  string data;
+};
+
+// Chunks are cut at the first game starting after this many bytes
+const size_t CHUNK_BYTES = 1 << 22;
+
+// Chunks read but not parsed yet, bounded so reading does not run ahead
+class ChunkQueue {
+public:
+  explicit ChunkQueue(size_t capacity) : capacity(capacity) {}
+
+  void push(Chunk chunk) {
+    std::unique_lock<std::mutex> lock(mutex);
+    not_full.wait(lock, [this] { return chunks.size() < capacity; });
+    chunks.push(std::move(chunk));
+    not_empty.notify_one();
+  }
+
+  // False once the queue is closed and empty
+  bool pop(Chunk *chunk) {
+    std::unique_lock<std::mutex> lock(mutex);
+    not_empty.wait(lock, [this] { return closed || !chunks.empty(); });
+    if (chunks.empty()) {
+      return false;
+    }
+    *chunk = std::move(chunks.front());
+    chunks.pop();
+    not_full.notify_one();
+    return true;
+  }
+
+  void close() {
+    std::lock_guard<std::mutex> lock(mutex);
+    closed = true;
+    not_empty.notify_all();
+  }
+
+private:
+  const size_t capacity;
+  std::queue<Chunk> chunks;
+  bool closed{false};
+  std::mutex mutex;
+  std::condition_variable not_empty;
+  std::condition_variable not_full;
+};
+
+// Splits the input into chunks of whole games. A game starts with a header
+// line that follows the moves of the previous game, outside their comments
+// and variations.
+static void ReadChunks(std::istream &input, ChunkQueue *queue,
+                       ProgressPrinter *progress_printer) {
+  Chunk chunk{0, {}};
+  LineReader lines(input);
+  std::string_view line;
+  bool in_headers = false;
+  MovetextNesting nesting;
+  while (lines.next(&line)) {
+    bool header = !line.empty() && line[0] == '[' && !nesting.nested();
+    if (header && !in_headers) {
+      if (chunk.data.size() >= CHUNK_BYTES) {
+        uint64_t next_id = chunk.id + 1;
+        queue->push(std::move(chunk));
+        chunk = Chunk{next_id, {}};
+      }
+      progress_printer->startPgn();
+    }
+    if (!line.empty()) {
+      in_headers = header;
+    }
+    if (!header) {
+      nesting.skip(line);
+    }
+    chunk.data += line;
+    chunk.data += '\n';
+  }
+  if (!chunk.data.empty()) {
+    queue->push(std::move(chunk));
+  }
+  queue->close();
+}
+
+// Samples the games of every book with n_threads workers parsing chunks of
+// the input. Every worker keeps the games with the smallest keys of its
+// chunks, the sample of a book is the games with the smallest keys of all
+// workers.
+static vector<vector<Game>> SampleParallel(std::istream &input,
+                                           ProgressPrinter *progress_printer,
+                                           int n_threads,
+                                           const vector<BookSpec> &specs) {
+  ChunkQueue queue(2 * n_threads);
+  vector<std::unique_ptr<BookVisitor>> visitors;
+  vector<std::thread> workers;
+  for (int i = 0; i < n_threads; i++) {
+    visitors.push_back(
+        std::make_unique<BookVisitor>(progress_printer, specs, true));
+    workers.emplace_back([&queue, visitor = visitors.back().get()] {
+      Chunk chunk;
+      while (queue.pop(&chunk)) {
+        visitor->startChunk(chunk.id);
+        std::istringstream stream(std::move(chunk.data));
+        PgnScanner scanner(stream);
+        scanner.readGames(*visitor);
+      }
+    });
+  }
+  ReadChunks(input, &queue, progress_printer);
+  for (std::thread &worker : workers) {
+    worker.join();
+  }
+  vector<vector<Game>> books(specs.size());
+  for (size_t book = 0; book < specs.size(); book++) {
+    std::vector<std::pair<uint64_t, Game>> sample;
+    for (auto &visitor : visitors) {
+      visitor->creator(book).takeKeyedSample(&sample);
+    }
+    std::sort(sample.begin(), sample.end(),
+              [](const auto &a, const auto &b) { return a.first < b.first; });
+    if ((int)sample.size() > specs[book].n_accepted_games) {
+      sample.resize(specs[book].n_accepted_games);
+    }
+    for (auto &[key, game] : sample) {
+      books[book].push_back(std::move(game));
+    }
+  }
+  return books;
+}
+
+// Writes the book and its summary, then frees the games
+static void WriteBook(const BookSpec &spec, BookWriter *writer,
+                      vector<Game> *games) {
+  DumpInfo dump_info = writer->dumpBook(*games);
+  vector<Game>().swap(*games);
+  std::ofstream ofs(spec.filename + ".txt");
+  ofs << "Games: " << dump_info.n_accepted_games << '\n'
+      << "Moves: " << dump_info.n_edges << '\n';
+  ofs.flush();
+  ofs.close();
+  cout << "\nDumped " << dump_info.n_edges << " edges from "
+       << dump_info.n_accepted_games << " games to " << spec.filename
+       << std::endl;
 }
 
 int main(int argc, char *argv[]) {
   std::ios_base::sync_with_stdio(false);
   std::cin.tie(nullptr);
-  if (argc < 8) {
+  bool manifest = argc >= 2 && string(argv[1]) == "--manifest";
+  if (argc < (manifest ? 4 : 8)) {
     cerr << "Usage: " << argv[0]
          << " <output file> <n_games> <n_accepted_games> <max_depth> "
-            "<start_eco_code> <end_eco_code> <seed>\n";
+            "<start_eco_code> <end_eco_code> <seed> [options]\n"
+         << "       " << argv[0]
+         << " --manifest <manifest file> <n_games> [options]\n"
+         << "Options: --format <1|3> --threads <n> --memory <MB> "
+            "--temp-dir <dir> --merge\n";
     return 1;
   }
-  std::string filename = argv[1];
-  int n_games = std::stoi(argv[2]);
-  int n_accepted_games = std::stoi(argv[3]);
-  int max_depth = std::stoi(argv[4]);
-  string start_eco_code = argv[5];
-  string end_eco_code = argv[6];
-  int seed = std::stoi(argv[7]);
-  vector<string> valid_codes = genEcoCodes(start_eco_code, end_eco_code);
-  auto vis =
-      std::make_unique<BookVisitor>(n_games, seed, n_accepted_games,
-                                    filename + ".bin", max_depth, valid_codes);
-
-  pgn::StreamParser parser(std::cin);
-  parser.readGames(*vis);
-  const auto dump_info = vis->dumpBook();
-  std::ofstream ofs(filename + ".txt");
-  ofs << "Games: " << dump_info.n_accepted_games << '\n'
-      << "Moves: " << dump_info.n_edges << '\n';
-  ofs.flush();
-  ofs.close();
-  cout << "\nDumped " << dump_info.n_edges << " edges from "
-       << dump_info.n_accepted_games << " games" << std::endl;
+  vector<BookSpec> specs;
+  int n_games;
+  int first_option;
+  if (manifest) {
+    specs = ReadManifest(argv[2]);
+    n_games = std::stoi(argv[3]);
+    first_option = 4;
+  } else {
+    specs.push_back(BookSpec{argv[1], std::stoi(argv[3]), std::stoi(argv[4]),
+                             argv[5], argv[6], std::stoi(argv[7])});
+    n_games = std::stoi(argv[2]);
+    first_option = 8;
+  }
+  WriterOptions options;
+  options.temp_dir = std::getenv("TMPDIR") ? std::getenv("TMPDIR") : "/tmp";
+  int n_threads = 0;
+  for (int i = first_option; i < argc; i++) {
+    string option = argv[i];
+    if (option == "--merge") {
+      options.merge = true;
+      continue;
+    }
+    if (i + 1 == argc) {
+      cerr << "Missing value of option " << option << '\n';
+      return 1;
+    }
+    string value = argv[++i];
+    if (option == "--format") {
+      options.format = std::stoi(value);
+    } else if (option == "--threads") {
+      n_threads = std::stoi(value);
+    } else if (option == "--memory") {
+      options.memory_limit = std::stoull(value) << 20;
+    } else if (option == "--temp-dir") {
+      options.temp_dir = value;
+    } else {
+      cerr << "Unknown option " << option << '\n';
+      return 1;
+    }
+  }
+  if (options.format != 1 && options.format != 3) {
+    cerr << "Unknown book format " << options.format << '\n';
+    return 1;
+  }
+  ProgressPrinter progress_printer(n_games);
+  // Opened before reading the input, so a wrong path does not waste a pass
+  vector<std::unique_ptr<BookWriter>> writers;
+  for (const BookSpec &spec : specs) {
+    writers.push_back(std::make_unique<BookWriter>(spec.filename, options));
+  }
+
+  if (n_threads > 0) {
+    vector<vector<Game>> books =
+        SampleParallel(std::cin, &progress_printer, n_threads, specs);
+    for (size_t book = 0; book < specs.size(); book++) {
+      WriteBook(specs[book], writers[book].get(), &books[book]);
+    }
+  } else {
+    BookVisitor vis(&progress_printer, specs, false);
+    PgnScanner scanner(std::cin);
+    scanner.readGames(vis);
+    for (size_t book = 0; book < specs.size(); book++) {
+      WriteBook(specs[book], writers[book].get(),
+                &vis.creator(book).sampledGames());
+    }
+  }
 }
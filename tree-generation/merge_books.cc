@@ -0,0 +1,93 @@
+/*
+ * merge_books.cc
+ * merges books generated by make_book into one book, summing the counts of
+ * every move. The books (v1 or v3) are read along in the order of their
+ * positions, so only the merged book is kept in memory. Moves with a summed
+ * count below the popularity limit are left out of the merged book.
+ *
+ * A book leaves out the moves played fewer times than the popularity limit
+ * in its games, so a merged count may be lower than the count in a book
+ * built from all the games at once.
+ *
+ * Arguments:
+ *  merged book filename
+ *  book filenames
+ * The books are <filename>.bin, the number of games of a book is read from
+ * <filename>.txt if there is one.
+ *
+ * Options:
+ *  --format <1|3>  format of the merged book (default 1)
+ *
+ * Example usage:
+ *  ./merge_books ruy_lopez ruy_lopez_2024-04 ruy_lopez_2024-05 --format 3
+ */
+#include "./book_file.hpp"
+#include <cstdio>
+#include <iostream>
+#include <memory>
+#include <string>
+#include <vector>
+using std::cerr;
+using std::cout;
+using std::string;
+using std::vector;
+
+int main(int argc, char *argv[]) {
+  std::ios_base::sync_with_stdio(false);
+  vector<string> filenames;
+  int format = 1;
+  for (int i = 1; i < argc; i++) {
+    string argument = argv[i];
+    if (argument == "--format" && i + 1 < argc) {
+      format = std::stoi(argv[++i]);
+    } else {
+      filenames.push_back(argument);
+    }
+  }
+  if (filenames.size() < 2) {
+    cerr << "Usage: " << argv[0]
+         << " <merged book> <book>... [--format <1|3>]\n";
+    return 1;
+  }
+  if (format != 1 && format != 3) {
+    cerr << "Unknown book format " << format << '\n';
+    return 1;
+  }
+  const string merged = filenames[0];
+  vector<std::unique_ptr<BookFileReader>> books;
+  vector<CountSource *> sources;
+  int n_games = 0;
+  for (size_t i = 1; i < filenames.size(); i++) {
+    books.push_back(std::make_unique<BookFileReader>(filenames[i] + ".bin"));
+    sources.push_back(books.back().get());
+    n_games += ReadGames(filenames[i] + ".txt");
+  }
+
+  vector<BookRecord> records;
+  MergeCounts(sources, [&records](const MoveKey &key, uint64_t count) {
+    if ((int64_t)count >= POPULARITY_LIMIT) {
+      records.push_back(BookRecord{key.toEntry(), (uint32_t)count});
+    }
+  });
+  books.clear();
+
+  // Written aside and renamed, a merged book may replace one of the books
+  const string path = merged + ".bin";
+  const string temp_path = path + ".tmp";
+  std::ofstream file(temp_path, std::ios::binary);
+  if (!file.is_open()) {
+    cerr << "Cannot open file " << temp_path << std::endl;
+    return 1;
+  }
+  WriteBookRecords(file, format, records);
+  file.close();
+  if (!file || std::rename(temp_path.c_str(), path.c_str()) != 0) {
+    cerr << "Cannot write book " << path << std::endl;
+    return 1;
+  }
+  std::ofstream ofs(merged + ".txt");
+  ofs << "Games: " << n_games << '\n' << "Moves: " << records.size() << '\n';
+  ofs.close();
+  cout << "Merged " << records.size() << " edges from " << n_games
+       << " games of " << filenames.size() - 1 << " books" << std::endl;
+}